@@ -1,17 +1,54 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from flask_cors import CORS
 from dotenv import load_dotenv
 import os
 from datetime import datetime, timezone, timedelta
 
 from functools import wraps
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import base64
+import contextvars
+import copy
+import bisect
+import hashlib
+import heapq
+import html
+import re
+import gzip
+import json
+import logging
+import logging.handlers
+import sqlite3
+import hmac
+import jwt
 import requests
+from requests.adapters import HTTPAdapter
+from werkzeug.middleware.proxy_fix import ProxyFix
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
+import threading
+import math
 import time
 import random
+import secrets
 import traceback
+import zlib
 import openai
 from openai import OpenAI
 
+try:
+    import brotli
+except ImportError:  # optional: responses are gzip-only without it
+    brotli = None
+
+try:
+    # Import after PROMETHEUS_MULTIPROC_DIR is set (gunicorn.conf.py) so workers share one view
+    import prometheus_client
+    from prometheus_client import multiprocess as prometheus_multiprocess
+except ImportError:  # optional: /metrics answers 503 without it
+    prometheus_client = None
+
 # Load environment variables
 load_dotenv()
 
@@ -20,7 +57,7 @@ app = Flask(__name__)
 
 
 INTASEND_SECRET_KEY = os.getenv("INTASEND_SECRET_KEY")
-API_BASE = "https://api.intasend.com/api/v1"
+API_BASE = os.getenv("INTASEND_API_BASE", "https://api.intasend.com/api/v1")
 
 
 # Environment config
@@ -38,7 +75,8 @@ CORS(
         ]
     }},
     supports_credentials=True,
-    allow_headers=["Content-Type", "Authorization"],
+    allow_headers=["Content-Type", "Authorization", "If-None-Match", "If-Modified-Since"],
+    expose_headers=["ETag", "Last-Modified", "Server-Timing", "Retry-After"],
     methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"]
 )
 
@@ -50,184 +88,1273 @@ SUPABASE_SERVICE_KEY = os.getenv('SUPABASE_SERVICE_KEY')
 # AI Configuration
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 HF_API_KEY = os.getenv('HF_API_KEY')
+# Override only to point at a proxy or the local stand-ins in benchmarks/
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL')
+HF_API_BASE = os.getenv('HF_API_BASE', 'https://api-inference.huggingface.co')
+
+# Local state (SQLite stores, created on first use); relative store paths below resolve against it
+DATA_DIR = os.getenv('DATA_DIR') or app.instance_path
+
+# Outbound HTTP pool config
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 20))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 2))
+HTTP_KEEPALIVE = os.getenv('HTTP_KEEPALIVE', 'True').lower() == 'true'
+
+# Access token verification config
+SUPABASE_JWT_SECRET = os.getenv('SUPABASE_JWT_SECRET')
+SUPABASE_JWT_AUDIENCE = os.getenv('SUPABASE_JWT_AUDIENCE', 'authenticated')
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 5000))
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', 300))
+JWKS_CACHE_TTL = int(os.getenv('JWKS_CACHE_TTL', 3600))
+# Logouts and password resets, shared by every worker on the host; a reset keeps rejecting
+# older tokens for REVOCATION_TTL seconds, so it must cover the longest access-token lifetime
+REVOCATION_STORE = os.path.join(DATA_DIR, os.getenv('REVOCATION_STORE', 'revocations.sqlite3'))
+REVOCATION_TTL = int(os.getenv('REVOCATION_TTL', 86400))
+
+# AI response cache config (AI_CACHE_DB enables the shared on-disk tier; a purge
+# bumps a generation counter in CACHE_GENERATIONS that every worker checks on each hit)
+AI_CACHE_SIZE = int(os.getenv('AI_CACHE_SIZE', 1000))
+AI_CACHE_TTL = int(os.getenv('AI_CACHE_TTL', 86400))
+AI_CACHE_DB = os.path.join(DATA_DIR, os.getenv('AI_CACHE_DB')) if os.getenv('AI_CACHE_DB') else None
+AI_CACHE_DISK_MAX_ENTRIES = int(os.getenv('AI_CACHE_DISK_MAX_ENTRIES', 50000))
+CACHE_GENERATIONS = os.path.join(DATA_DIR, os.getenv('CACHE_GENERATIONS', 'cache_generations.sqlite3'))
+
+# Hugging Face fallback mode: 'sequential', 'staggered' (hedge after HF_HEDGE_DELAY s) or 'concurrent'
+HF_HEDGE_MODE = os.getenv('HF_HEDGE_MODE', 'staggered')
+HF_HEDGE_DELAY = float(os.getenv('HF_HEDGE_DELAY', 2.0))
+HF_HEDGE_TIMEOUT = float(os.getenv('HF_HEDGE_TIMEOUT', 30))
+HF_MAX_CONCURRENCY = int(os.getenv('HF_MAX_CONCURRENCY', 8))
+
+# Circuit breakers for AI providers
+BREAKER_WINDOW = int(os.getenv('BREAKER_WINDOW', 20))
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', 5))
+BREAKER_ERROR_THRESHOLD = float(os.getenv('BREAKER_ERROR_THRESHOLD', 0.5))
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv('BREAKER_SLOW_CALL_SECONDS', 8))
+BREAKER_SLOW_CALL_THRESHOLD = float(os.getenv('BREAKER_SLOW_CALL_THRESHOLD', 0.8))
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', 30))
+
+# Medical knowledge base file, re-read when it changes on disk
+KNOWLEDGE_BASE_PATH = os.getenv(
+    'KNOWLEDGE_BASE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'medical_knowledge.json')
+)
+KB_RELOAD_INTERVAL = int(os.getenv('KB_RELOAD_INTERVAL', 30))
+
+# Shared pool for concurrent upstream calls made on behalf of a request
+IO_MAX_WORKERS = int(os.getenv('IO_MAX_WORKERS', 16))
+COMMUNITY_STATS_REFRESH = int(os.getenv('COMMUNITY_STATS_REFRESH', 60))
+# Shared deadline for a route's concurrent upstream calls (requests themselves time out at 10s)
+FANOUT_DEADLINE = float(os.getenv('FANOUT_DEADLINE', 12))
+
+# In-process forum search index
+SEARCH_INDEX_ENABLED = os.getenv('SEARCH_INDEX_ENABLED', 'True').lower() == 'true'
+SEARCH_RECONCILE_INTERVAL = int(os.getenv('SEARCH_RECONCILE_INTERVAL', 300))
+SEARCH_REBUILD_INTERVAL = int(os.getenv('SEARCH_REBUILD_INTERVAL', 3600))
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 1000))
+
+# Published module catalog is re-validated against Supabase at most this often
+MODULE_CATALOG_TTL = int(os.getenv('MODULE_CATALOG_TTL', 30))
+
+# Request coalescing: how long followers wait on an in-flight identical call
+SINGLEFLIGHT_TIMEOUT = float(os.getenv('SINGLEFLIGHT_TIMEOUT', 15))
+AI_SINGLEFLIGHT_TIMEOUT = float(os.getenv('AI_SINGLEFLIGHT_TIMEOUT', 45))
+
+# Rate limiting (token buckets): per-minute limit is the burst size, per-hour the sustained budget
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'True').lower() == 'true'
+RATE_LIMIT_PER_MINUTE = int(os.getenv('RATE_LIMIT_PER_MINUTE', 60))
+RATE_LIMIT_PER_HOUR = int(os.getenv('RATE_LIMIT_PER_HOUR', 1000))
+AI_RATE_LIMIT_PER_MINUTE = int(os.getenv('AI_RATE_LIMIT_PER_MINUTE', 10))
+AI_RATE_LIMIT_PER_HOUR = int(os.getenv('AI_RATE_LIMIT_PER_HOUR', 100))
+AUTH_RATE_LIMIT_PER_MINUTE = int(os.getenv('AUTH_RATE_LIMIT_PER_MINUTE', 10))
+AUTH_RATE_LIMIT_PER_HOUR = int(os.getenv('AUTH_RATE_LIMIT_PER_HOUR', 100))
+# Signed-in users behind one clinic NAT share an IP, so their IP bucket is this many times larger
+RATE_LIMIT_IP_FACTOR = int(os.getenv('RATE_LIMIT_IP_FACTOR', 5))
+# SQLite file shared by every worker on the host; unset keeps buckets per worker in memory
+RATE_LIMIT_STORE = os.path.join(DATA_DIR, os.getenv('RATE_LIMIT_STORE')) if os.getenv('RATE_LIMIT_STORE') else None
+# Reverse proxies in front of the app whose X-Forwarded-For is trusted. Only set this behind
+# a proxy that overwrites or appends the header (Render: 1); with no proxy a client could
+# pick its own address for every request and dodge the per-IP limits
+TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', 0))
+
+# IntaSend webhooks: durable journal applied by a background consumer
+WEBHOOK_JOURNAL = os.path.join(DATA_DIR, os.getenv('WEBHOOK_JOURNAL', 'webhook_journal.sqlite3'))
+# The challenge string set on the IntaSend dashboard, sent back in every webhook body;
+# deliveries without it are refused before they reach the journal
+INTASEND_WEBHOOK_CHALLENGE = os.getenv('INTASEND_WEBHOOK_CHALLENGE')
+WEBHOOK_MAX_BYTES = int(os.getenv('WEBHOOK_MAX_BYTES', 64 * 1024))
+WEBHOOK_POLL_INTERVAL = float(os.getenv('WEBHOOK_POLL_INTERVAL', 1.0))
+WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', 200))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 8))
+WEBHOOK_RETRY_BASE = float(os.getenv('WEBHOOK_RETRY_BASE', 2.0))
+WEBHOOK_RETENTION_DAYS = int(os.getenv('WEBHOOK_RETENTION_DAYS', 7))
+
+# Background jobs for side effects kept off the response path
+JOB_QUEUE_DB = os.path.join(DATA_DIR, os.getenv('JOB_QUEUE_DB', 'jobs.sqlite3'))
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 1.0))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 6))
+JOB_RETRY_BASE = float(os.getenv('JOB_RETRY_BASE', 5.0))
+
+# Subscription entitlements: per-worker cache, invalidated across the workers of one host through
+# a SQLite file they share (workers on other hosts or dynos only see changes after the TTL)
+ENTITLEMENT_CACHE_TTL = int(os.getenv('ENTITLEMENT_CACHE_TTL', 300))
+ENTITLEMENT_STORE = os.path.join(DATA_DIR, os.getenv('ENTITLEMENT_STORE', 'entitlements.sqlite3'))
+
+# Largest accepted /api/training/progress/batch payload
+PROGRESS_BATCH_MAX = int(os.getenv('PROGRESS_BATCH_MAX', 200))
+
+# Response compression
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_GZIP_LEVEL = int(os.getenv('COMPRESS_GZIP_LEVEL', 6))
+COMPRESS_BROTLI_QUALITY = int(os.getenv('COMPRESS_BROTLI_QUALITY', 5))
+COMPRESS_CACHE_SIZE = int(os.getenv('COMPRESS_CACHE_SIZE', 256))
+
+# Admin endpoints are disabled unless this is set
+ADMIN_API_KEY = os.getenv('ADMIN_API_KEY')
+
+# Prometheus /metrics; when METRICS_TOKEN is set scrapers must send it as a Bearer token
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True').lower() == 'true' and prometheus_client is not None
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# Per-request span tracing: Server-Timing header and a rotating log of slow requests
+# (relative SLOW_REQUEST_LOG paths resolve under DATA_DIR; '-' logs to stderr instead)
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'True').lower() == 'true'
+SERVER_TIMING_ENABLED = os.getenv('SERVER_TIMING_ENABLED', 'True').lower() == 'true'
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 1000))
+SLOW_REQUEST_LOG = os.getenv('SLOW_REQUEST_LOG') or 'slow_requests.log'
+if SLOW_REQUEST_LOG != '-':
+    SLOW_REQUEST_LOG = os.path.join(DATA_DIR, SLOW_REQUEST_LOG)
+SLOW_REQUEST_LOG_MAX_BYTES = int(os.getenv('SLOW_REQUEST_LOG_MAX_BYTES', 5 * 1024 * 1024))
+SLOW_REQUEST_LOG_BACKUPS = int(os.getenv('SLOW_REQUEST_LOG_BACKUPS', 3))
 
 
-# Replace the existing hf_api_request function with this enhanced version
-def ai_request_with_fallback(prompt, max_length=200):
+# ----------------------
+# Metrics
+# ----------------------
+
+if METRICS_ENABLED:
+    HTTP_REQUEST_SECONDS = prometheus_client.Histogram(
+        'http_request_duration_seconds', 'Time to build the response, by route template',
+        ['method', 'route'], buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+    )
+    HTTP_RESPONSES = prometheus_client.Counter(
+        'http_responses_total', 'Responses by route template and status code', ['method', 'route', 'status']
+    )
+    UPSTREAM_SECONDS = prometheus_client.Histogram(
+        'upstream_request_duration_seconds',
+        'Upstream call latency by target (supabase:<table>, auth, openai, hf:<model>, intasend)',
+        ['target'], buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+    )
+    UPSTREAM_CALLS = prometheus_client.Counter(
+        'upstream_requests_total', 'Upstream calls by target and outcome', ['target', 'outcome']
+    )
+    AI_ANSWER_PATH = prometheus_client.Counter(
+        'ai_answer_path_total', 'Which step produced each AI answer', ['path']
+    )
+    CACHE_LOOKUPS = prometheus_client.Counter(
+        'cache_lookups_total', 'Cache lookups by cache and result (hit/miss)', ['cache', 'result']
+    )
+    COALESCED_CALLS = prometheus_client.Counter(
+        'singleflight_calls_total', 'Calls through a single-flight group (leader, coalesced, timeout)',
+        ['group', 'result']
+    )
+    BACKGROUND_JOBS = prometheus_client.Counter(
+        'background_jobs_total', 'Background job runs by kind and outcome (done, retry, dead)', ['kind', 'outcome']
+    )
+    RATE_LIMITED = prometheus_client.Counter(
+        'rate_limited_total', 'Requests rejected with 429, by route class and bucket scope', ['route_class', 'scope']
+    )
+
+
+def observe_upstream(target, seconds, outcome):
+    if METRICS_ENABLED:
+        UPSTREAM_SECONDS.labels(target).observe(seconds)
+        UPSTREAM_CALLS.labels(target, outcome).inc()
+
+
+def count_ai_answer_path(path):
+    if METRICS_ENABLED:
+        AI_ANSWER_PATH.labels(path).inc()
+
+
+def cache_lookup_counters(name):
+    """(hit, miss) counters bound once per cache so a lookup costs one increment; None when disabled"""
+    if not (METRICS_ENABLED and name):
+        return None
+    return CACHE_LOOKUPS.labels(name, 'hit'), CACHE_LOOKUPS.labels(name, 'miss')
+
+
+def _upstream_target(url):
+    """Label for an outgoing URL: supabase:<table>, auth, intasend, hf:<model>, or the host"""
+    if SUPABASE_URL and url.startswith(SUPABASE_URL):
+        path = url[len(SUPABASE_URL):]
+        if path.startswith('/rest/v1/'):
+            return 'supabase:' + re.split(r'[?/]', path[len('/rest/v1/'):], 1)[0]
+        if path.startswith('/auth/v1/'):
+            return 'auth'
+        return 'supabase'
+    if url.startswith(API_BASE):
+        return 'intasend'
+    if url.startswith(f"{HF_API_BASE}/models/"):
+        return 'hf:' + url[len(f"{HF_API_BASE}/models/"):]
+    return url.split('/')[2] if '://' in url else 'http'
+
+
+class _InstrumentedSession(requests.Session):
+    """requests.Session that records latency and outcome of every call per upstream target"""
+
+    def request(self, method, url, *args, **kwargs):
+        if not (METRICS_ENABLED or _current_trace.get() is not None):
+            return super().request(method, url, *args, **kwargs)
+
+        target = _upstream_target(url)
+        # HF models are measured by their circuit breakers, like OpenAI
+        measured = METRICS_ENABLED and not target.startswith('hf:')
+        start = time.perf_counter()
+        with trace_span(target):
+            try:
+                resp = super().request(method, url, *args, **kwargs)
+            except requests.RequestException:
+                if measured:
+                    observe_upstream(target, time.perf_counter() - start, 'exception')
+                raise
+        if measured:
+            outcome = 'ok' if resp.status_code < 400 else f'http_{resp.status_code // 100}xx'
+            observe_upstream(target, time.perf_counter() - start, outcome)
+        return resp
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def _record_request_metrics(response):
+    # Registered before compress_response, so it runs after it and the timing includes compression
+    started = g.get('request_started')
+    if METRICS_ENABLED and started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_REQUEST_SECONDS.labels(request.method, route).observe(time.perf_counter() - started)
+        HTTP_RESPONSES.labels(request.method, route, str(response.status_code)).inc()
+    return response
+
+
+# ----------------------
+# Request tracing
+# ----------------------
+
+class RequestTrace:
+    """Spans recorded while serving one request: [name, parent index, start, end] in perf_counter seconds"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def open(self, name, parent):
+        with self._lock:
+            self.spans.append([name, parent, time.perf_counter(), None])
+            return len(self.spans) - 1
+
+    def close(self, index):
+        self.spans[index][3] = time.perf_counter()
+
+    def server_timing(self, total_ms):
+        """Server-Timing value: total, then finished spans summed per name in first-seen order"""
+        totals = {}
+        for name, _, start, end in self.spans:
+            if end is not None:
+                entry = totals.setdefault(name, [0.0, 0])
+                entry[0] += end - start
+                entry[1] += 1
+        parts = [f'total;dur={total_ms:.1f}']
+        for name, (seconds, calls) in totals.items():
+            token = re.sub(r"[^A-Za-z0-9!#$%&'*+.^_`|~-]", '-', name)
+            desc = f'{name} x{calls}' if calls > 1 else name
+            parts.append(f'{token};dur={seconds * 1000:.1f}' if desc == token
+                         else f'{token};desc="{desc}";dur={seconds * 1000:.1f}')
+        return ', '.join(parts)
+
+    def tree(self):
+        """Nested spans with offsets from the request start, for the slow-request log"""
+        nodes = [{
+            'name': name,
+            'start_ms': round((start - self.started) * 1000, 1),
+            'duration_ms': round((end - start) * 1000, 1) if end is not None else None,
+            'children': []
+        } for name, _, start, end in self.spans]
+        roots = []
+        for node, (_, parent, _, _) in zip(nodes, self.spans):
+            (nodes[parent]['children'] if parent is not None else roots).append(node)
+        return roots
+
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'index', 'token')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.index = self.trace.open(self.name, _current_span.get())
+        self.token = _current_span.set(self.index)
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.close(self.index)
+        _current_span.reset(self.token)
+        return False
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def trace_span(name):
+    """Time a block as a child of the current span; a no-op outside a traced request"""
+    trace = _current_trace.get()
+    return _NO_SPAN if trace is None else _Span(trace, name)
+
+
+def in_current_context(fn, *args, **kwargs):
+    """Wrap fn to run in a copy of the caller's context, so executor threads add spans to the same trace"""
+    context = contextvars.copy_context()
+    return lambda: context.run(fn, *args, **kwargs)
+
+
+_slow_request_log = logging.getLogger('healthguide.slow_requests')
+_slow_request_log.propagate = False
+
+
+def _slow_request_handler():
+    if not _slow_request_log.handlers:
+        if SLOW_REQUEST_LOG != '-':
+            # Each worker process appends (and rotates) on its own; lines carry the pid
+            os.makedirs(os.path.dirname(SLOW_REQUEST_LOG), exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                SLOW_REQUEST_LOG, maxBytes=SLOW_REQUEST_LOG_MAX_BYTES, backupCount=SLOW_REQUEST_LOG_BACKUPS, delay=True
+            )
+        else:
+            handler = logging.StreamHandler()  # e.g. hosts with an ephemeral disk that collect stderr
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        _slow_request_log.addHandler(handler)
+        _slow_request_log.setLevel(logging.INFO)
+    return _slow_request_log
+
+
+@app.before_request
+def _start_trace():
+    if TRACING_ENABLED:
+        g.trace = RequestTrace()
+        g.trace_token = _current_trace.set(g.trace)
+
+
+@app.after_request
+def _finish_trace(response):
+    trace = g.get('trace')
+    if trace is None:
+        return response
+    total_ms = (time.perf_counter() - trace.started) * 1000
+    if SERVER_TIMING_ENABLED:
+        response.headers['Server-Timing'] = trace.server_timing(total_ms)
+    if total_ms >= SLOW_REQUEST_MS:
+        _slow_request_handler().info(json.dumps({
+            'time': datetime.now(timezone.utc).isoformat(),
+            'pid': os.getpid(),
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'route': request.url_rule.rule if request.url_rule else None,
+            'status': response.status_code,
+            'duration_ms': round(total_ms, 1),
+            'spans': trace.tree()
+        }))
+    return response
+
+
+@app.teardown_request
+def _end_trace(exc):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        _current_trace.reset(token)
+
+
+# ----------------------
+# Pooled HTTP session
+# ----------------------
+
+_http_session = None
+_http_session_pid = None
+_http_session_lock = threading.Lock()
+
+
+class _ResetRetry(Retry):
     """
-    Enhanced AI request system with multiple fallback options:
-    1. First check medical knowledge base
-    2. Try OpenAI API if available
-    3. Fall back to Hugging Face if OpenAI fails
-    4. Use local knowledge base as final fallback
+    Retry that never retries a read timeout: a slow upstream already used the caller's
+    whole timeout once, and the caller should see requests' Timeout, not a retry storm.
+    Read errors that are retried are connections dropped before any response, i.e.
+    resets on stale keep-alive sockets.
     """
-    
-    # Check for common medical questions in knowledge base first
-    prompt_lower = prompt.lower()
-    
-    # Enhanced medical knowledge base for common questions
-    medical_responses = {
-        "malaria": """Malaria is a serious mosquito-borne disease caused by Plasmodium parasites.
 
-**Key Facts:**
-• Transmitted by infected female Anopheles mosquitoes
-• Symptoms: fever, chills, headache, muscle aches, fatigue, nausea, vomiting
-• Can be life-threatening without prompt treatment
-• Most prevalent in sub-Saharan Africa
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if isinstance(error, ReadTimeoutError):
+            raise error
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+def _build_http_session():
+    """Create a requests session with a sized connection pool and connect-level retries"""
+    session = _InstrumentedSession()
+    # Retries cover resets on stale keep-alive sockets; non-idempotent methods are
+    # only retried when the failure happened before the request was sent.
+    retry = _ResetRetry(
+        total=HTTP_MAX_RETRIES,
+        connect=HTTP_MAX_RETRIES,
+        read=HTTP_MAX_RETRIES,
+        status=0,
+        backoff_factor=0.1,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not HTTP_KEEPALIVE:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def get_http_session():
+    """Return this worker's shared session, rebuilding it after a fork so sockets are never shared"""
+    global _http_session, _http_session_pid
+    pid = os.getpid()
+    if _http_session is None or _http_session_pid != pid:
+        with _http_session_lock:
+            if _http_session is None or _http_session_pid != pid:
+                _http_session = _build_http_session()
+                _http_session_pid = pid
+    return _http_session
+
+
+_io_executor = None
+_io_executor_pid = None
+_io_executor_lock = threading.Lock()
+
+
+def get_io_executor():
+    """This worker's bounded pool for running independent upstream calls concurrently"""
+    global _io_executor, _io_executor_pid
+    pid = os.getpid()
+    if _io_executor is None or _io_executor_pid != pid:
+        with _io_executor_lock:
+            if _io_executor is None or _io_executor_pid != pid:
+                _io_executor = ThreadPoolExecutor(max_workers=IO_MAX_WORKERS, thread_name_prefix='io')
+                _io_executor_pid = pid
+    return _io_executor
+
+
+def fan_out(calls, deadline=None, default=None):
+    """
+    Run independent zero-argument callables concurrently on the IO pool, so latency is
+    the slowest call rather than the sum. `calls` maps names to callables and the result
+    maps the same names to return values. Every call shares one deadline; a call that
+    misses it or raises contributes `default`.
+    """
+    executor = get_io_executor()
+    futures = {executor.submit(in_current_context(fn)): name for name, fn in calls.items()}
+    done, pending = wait(futures, timeout=FANOUT_DEADLINE if deadline is None else deadline)
 
-**Prevention:**
-• Use insecticide-treated bed nets
-• Apply mosquito repellent
-• Take antimalarial medication if traveling to endemic areas
-• Eliminate standing water around homes
+    results = {name: default for name in calls}
+    for future in done:
+        try:
+            results[futures[future]] = future.result()
+        except Exception as e:
+            print(f"Fan-out call {futures[future]} failed: {e}")
+    for future in pending:
+        future.cancel()
+        print(f"Fan-out call {futures[future]} missed the deadline")
+    return results
 
-**When to seek help:** Immediate medical attention for fever in malaria-endemic areas
 
-⚠️ Disclaimer: This is educational information only. Consult a healthcare professional for medical advice.""",
-        
-        "fever": """Fever is the body's natural response to infection and helps fight illness.
-
-**Normal vs Fever:**
-• Normal body temperature: 98.6°F (37°C)
-• Low-grade fever: 99-100.4°F (37.2-38°C)
-• Fever: Above 100.4°F (38°C)
-• High fever: Above 103°F (39.4°C)
-
-**Management:**
-• Stay hydrated with water, clear broths
-• Rest in a cool, comfortable environment
-• Use light clothing and blankets
-• Tepid sponge baths for comfort
-
-**Seek immediate care if:**
-• Fever above 104°F (40°C)
-• Signs of dehydration
-• Difficulty breathing
-• Severe headache or neck stiffness
-• Fever lasting more than 3 days
-
-⚠️ Disclaimer: This is educational information only. Consult a healthcare professional for medical advice.""",
-        
-        "diabetes": """Diabetes is a chronic condition affecting how your body processes blood sugar (glucose).
-
-**Types:**
-• Type 1: Body produces little/no insulin (autoimmune)
-• Type 2: Body doesn't use insulin effectively
-• Gestational: Develops during pregnancy
-
-**Common symptoms:**
-• Increased thirst and frequent urination
-• Extreme fatigue
-• Blurred vision
-• Slow-healing cuts/bruises
-• Unexpected weight loss
-
-**Management:**
-• Regular blood sugar monitoring
-• Healthy diet with controlled carbohydrates
-• Regular physical activity
-• Medication as prescribed
-• Regular medical check-ups
-
-**Complications if unmanaged:**
-• Heart disease, stroke, kidney damage, nerve damage, vision problems
-
-⚠️ Disclaimer: This is educational information only. Consult a healthcare professional for medical advice.""",
-        
-        "diarrhea": """Diarrhea is characterized by loose, watery stools occurring more frequently than normal.
-
-**Common causes:**
-• Viral infections (most common)
-• Bacterial infections
-• Food poisoning
-• Medications
-• Digestive disorders
-
-**Management:**
-• Stay hydrated - drink clear fluids, ORS
-• BRAT diet: Bananas, Rice, Applesauce, Toast
-• Avoid dairy, fatty, spicy foods
-• Rest
-
-**Seek medical help if:**
-• Blood in stools
-• High fever (above 102°F/39°C)
-• Severe dehydration
-• Lasting more than 3 days
-• Severe abdominal pain
-
-**Prevention:**
-• Wash hands frequently
-• Safe food handling
-• Clean drinking water
-• Proper sanitation
-
-⚠️ Disclaimer: This is educational information only. Consult a healthcare professional for medical advice.""",
-        
-        "cough": """Cough is a reflex action to clear airways of irritants, mucus, or foreign particles.
-
-**Types:**
-• Dry cough: No mucus produced
-• Wet cough: Produces mucus/phlegm
-• Acute: Less than 3 weeks
-• Chronic: More than 8 weeks
-
-**Common causes:**
-• Viral infections (colds, flu)
-• Bacterial infections
-• Allergies
-• Asthma
-• GERD
-
-**Home management:**
-• Stay hydrated
-• Honey (for children over 1 year)
-• Warm salt water gargling
-• Humidifier or steam inhalation
-• Avoid smoke and irritants
-
-**Seek medical care if:**
-• Blood in sputum
-• High fever
-• Difficulty breathing
-• Chest pain
-• Cough lasting more than 3 weeks
-
-⚠️ Disclaimer: This is educational information only. Consult a healthcare professional for medical advice."""
+# ----------------------
+# Caching helpers
+# ----------------------
+
+class TTLCache:
+    """Thread-safe, size-bounded LRU cache whose entries expire after a TTL"""
+
+    def __init__(self, maxsize=1024, ttl=300, name=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = cache_lookup_counters(name)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    if self._counters:
+                        self._counters[0].inc()
+                    return value
+                del self._data[key]
+            self.misses += 1
+            if self._counters:
+                self._counters[1].inc()
+            return default
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[0] if item is not None else default
+
+    def pop_where(self, predicate):
+        """Drop every entry for which predicate(key, value) is true; returns the count"""
+        with self._lock:
+            doomed = [k for k, (v, _) in self._data.items() if predicate(k, v)]
+            for k in doomed:
+                del self._data[k]
+        return len(doomed)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def connect_sqlite(path, **kwargs):
+    """Open a local store, creating its directory (DATA_DIR) on first use"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    return sqlite3.connect(path, **kwargs)
+
+
+class SQLiteCache:
+    """Size-bounded key/value store with expiry, shared by every worker process on the host"""
+
+    def __init__(self, path, max_entries=50000, ttl=86400):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+
+    def _conn(self):
+        # sqlite connections can't cross threads or forks, so keep one per thread per process
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = connect_sqlite(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        try:
+            with self._conn() as conn:
+                row = conn.execute(
+                    "SELECT value FROM cache WHERE key = ? AND expires_at > ?", (key, now)
+                ).fetchone()
+                if row:
+                    conn.execute("UPDATE cache SET last_access = ? WHERE key = ?", (now, key))
+            return json.loads(row[0]) if row else None
+        except sqlite3.Error as e:
+            print(f"SQLite cache read error: {e}")
+            return None
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        try:
+            with self._conn() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value), now + (self.ttl if ttl is None else ttl), now)
+                )
+                self._writes += 1
+                if self._writes % 100 == 0:
+                    self._evict(conn, now)
+        except sqlite3.Error as e:
+            print(f"SQLite cache write error: {e}")
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+        conn.execute(
+            "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_access ASC "
+            "LIMIT max(0, (SELECT COUNT(*) FROM cache) - ?))",
+            (self.max_entries,)
+        )
+
+    def clear(self):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM cache")
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+class CacheGenerations:
+    """
+    Named counters in a SQLite file shared by every worker on the host. A cache tags its
+    in-memory entries with the counter it read, so bumping it in one worker (an admin
+    purge) makes every worker's memory tier stale without cross-process messaging.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = connect_sqlite(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS generations (name TEXT PRIMARY KEY, generation INTEGER NOT NULL)")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, name):
+        """Current counter (0 if never bumped); None if the store is unreadable, meaning don't trust memory"""
+        try:
+            row = self._conn().execute("SELECT generation FROM generations WHERE name = ?", (name,)).fetchone()
+            return row[0] if row else 0
+        except sqlite3.Error as e:
+            print(f"Cache generation read error: {e}")
+            return None
+
+    def bump(self, name):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO generations (name, generation) VALUES (?, 1) "
+                "ON CONFLICT(name) DO UPDATE SET generation = generation + 1",
+                (name,)
+            )
+
+
+class TieredCache:
+    """
+    In-memory LRU tier in front of an optional SQLiteCache, with hit/miss counters.
+    With `generations`, clear() reaches the memory tier of every worker on the host.
+    """
+
+    def __init__(self, memory, disk=None, name=None, generations=None):
+        self.memory = memory
+        self.disk = disk
+        self.disk_hits = 0
+        self.stale_hits = 0
+        self.name = name
+        self.generations = generations
+        self._counters = cache_lookup_counters(name)
+
+    def _generation(self):
+        return self.generations.get(self.name) if self.generations is not None else 0
+
+    def get(self, key):
+        generation = self._generation()
+        item = self.memory.get(key)
+        value = None
+        if item is not None and generation is not None and item[0] == generation:
+            value = item[1]
+        elif item is not None:
+            self.stale_hits += 1
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.disk_hits += 1
+                self.memory.set(key, (generation, value))
+        if self._counters:
+            self._counters[0 if value is not None else 1].inc()
+        return value
+
+    def set(self, key, value):
+        self.memory.set(key, (self._generation(), value))
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def clear(self):
+        if self.generations is not None:
+            self.generations.bump(self.name)
+        if self.disk is not None:
+            self.disk.clear()
+        self.memory.clear()
+
+    def stats(self):
+        """Memory-tier numbers are this worker's; /metrics aggregates hits across workers"""
+        misses = self.memory.misses + self.stale_hits - self.disk_hits
+        lookups = self.memory.hits + self.memory.misses
+        return {
+            'worker_pid': os.getpid(),
+            'generation': self._generation(),
+            'memory_hits': self.memory.hits - self.stale_hits,
+            'disk_hits': self.disk_hits,
+            'misses': misses,
+            'hit_ratio': round((lookups - misses) / lookups, 4) if lookups else 0.0,
+            'memory_entries': len(self.memory),
+            'disk_entries': len(self.disk) if self.disk is not None else None
+        }
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Collapse concurrent identical calls into one: the first caller for a key runs fn,
+    callers arriving while it is in flight wait for and share its result. A follower
+    that waits longer than the timeout gives up and makes its own call.
+    """
+
+    def __init__(self, timeout=15, name=None):
+        self.timeout = timeout
+        self._metrics = {
+            result: COALESCED_CALLS.labels(name, result) for result in ('leader', 'coalesced', 'timeout')
+        } if METRICS_ENABLED and name else None
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, timeout=None):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        if self._metrics:
+            self._metrics['leader' if leader else 'coalesced'].inc()
+
+        if leader:
+            try:
+                flight.result = fn()
+                return flight.result
+            except Exception as e:
+                flight.error = e
+                raise
+            finally:
+                with self._lock:
+                    self._flights.pop(key, None)
+                flight.done.set()
+
+        if not flight.done.wait(self.timeout if timeout is None else timeout):
+            with self._lock:
+                self.timeouts += 1
+            if self._metrics:
+                self._metrics['timeout'].inc()
+            return fn()
+        if flight.error is not None:
+            raise flight.error
+        # Followers get their own copy so a handler mutating its rows can't touch another's
+        return copy.deepcopy(flight.result)
+
+    def stats(self):
+        with self._lock:
+            calls = self.leaders + self.coalesced
+            return {
+                'upstream_calls': self.leaders,
+                'coalesced': self.coalesced,
+                'coalesced_ratio': round(self.coalesced / calls, 4) if calls else 0.0,
+                'timeouts': self.timeouts,
+                'in_flight': len(self._flights)
+            }
+
+
+AI_DISCLAIMER = "\n\n⚠️ Disclaimer: This information is for educational purposes only. Always consult a licensed healthcare professional for medical advice."
+
+# Enhanced prompt for health context
+OPENAI_SYSTEM_PROMPT = """You are a knowledgeable health education assistant helping community health workers. 
+            Provide accurate, helpful medical information while emphasizing the importance of professional medical consultation. 
+            Keep responses concise and practical for field use."""
+
+# List of models to try (best for free tier, ordered by preference)
+HF_MODELS = [
+    "mistralai/Mistral-7B-Instruct-v0.2",  # Good for conversations
+    "google/flan-t5-base",  # Original choice
+    "HuggingFaceH4/zephyr-7b-beta",  # Smaller, faster
+    "tiiuae/falcon-7b-instruct-v2",  # Larger but might have rate limits
+]
+
+
+# ----------------------
+# Medical knowledge base
+# ----------------------
+
+class KnowledgeBase:
+    """
+    Whole-word phrase matcher over the knowledge-base topics and their synonyms.
+    Phrases live in a dict keyed by word tuples, so a lookup costs
+    O(words in prompt x longest phrase) no matter how many topics are loaded.
+    """
+    _WORD_RE = re.compile(r"[a-z0-9]+")
+
+    def __init__(self, topics):
+        self.topics = topics
+        self._phrases = {}
+        self._max_words = 1
+        for order, topic in enumerate(topics):
+            entry = (-int(topic.get('priority', 0)), order, topic['response'])
+            for term in [topic['topic'], *topic.get('synonyms', [])]:
+                words = tuple(self._WORD_RE.findall(term.lower()))
+                if not words:
+                    continue
+                # On duplicate phrases the higher-priority topic wins
+                if words not in self._phrases or entry < self._phrases[words]:
+                    self._phrases[words] = entry
+                self._max_words = max(self._max_words, len(words))
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f)['topics'])
+
+    def match(self, prompt):
+        """Response of the highest-priority topic mentioned in the prompt, or None"""
+        words = self._WORD_RE.findall(prompt.lower())
+        best = None
+        for i in range(len(words)):
+            for n in range(1, min(self._max_words, len(words) - i) + 1):
+                entry = self._phrases.get(tuple(words[i:i + n]))
+                if entry is not None and (best is None or entry < best):
+                    best = entry
+        return best[2] if best else None
+
+
+_knowledge_base = KnowledgeBase([])
+_kb_mtime = None
+_kb_checked_at = 0
+_kb_lock = threading.Lock()
+
+
+def load_knowledge_base(force=False):
+    """(Re)load the knowledge base if the file changed; a broken file keeps the previous version live"""
+    global _knowledge_base, _kb_mtime, _kb_checked_at
+    with _kb_lock:
+        _kb_checked_at = time.monotonic()
+        try:
+            mtime = os.path.getmtime(KNOWLEDGE_BASE_PATH)
+            if force or mtime != _kb_mtime:
+                _knowledge_base = KnowledgeBase.from_file(KNOWLEDGE_BASE_PATH)
+                _kb_mtime = mtime
+                print(f"Loaded {len(_knowledge_base.topics)} knowledge base topics")
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Knowledge base load error: {e}")
+    return _knowledge_base
+
+
+def knowledge_base_answer(prompt):
+    """Return the canned answer for the highest-priority knowledge-base topic in the prompt, if any"""
+    kb = _knowledge_base
+    if time.monotonic() - _kb_checked_at > KB_RELOAD_INTERVAL:
+        kb = load_knowledge_base()
+    return kb.match(prompt)
+
+
+load_knowledge_base()
+
+
+def fallback_answer(prompt):
+    """Generic guidance used when no AI provider produced an answer"""
+    return f"""I understand you're asking about: "{prompt[:100]}{'...' if len(prompt) > 100 else ''}"
+
+**For health-related questions, I recommend:**
+• Consulting with a qualified healthcare professional
+• Visiting your local health facility
+• Calling your country's health helpline
+• Using official health organization resources (WHO, CDC, local health ministry)
+
+**Common health topics I can help with:**
+• Malaria prevention and symptoms
+• Fever management
+• Diabetes basics
+• Diarrhea treatment
+• Cough care
+• Basic first aid
+• Nutrition guidelines
+• Hygiene practices
+
+**To enable AI-powered responses:**
+1. Set OPENAI_API_KEY in your .env file for OpenAI (primary)
+2. Set HF_API_KEY in your .env file for Hugging Face (fallback)
+
+⚠️ Disclaimer: This is educational information only. Always consult a licensed healthcare professional for medical advice."""
+
+
+def _hf_enhanced_prompt(prompt):
+    # Enhance prompt for health context
+    return f"""As a health education assistant, respond to this health-related question with accurate, helpful information: {prompt}
+
+Please provide clear, actionable guidance while emphasizing the importance of professional medical consultation."""
+
+
+def _hf_request(model, enhanced_prompt, max_length, stream=False):
+    url = f"{HF_API_BASE}/models/{model}"
+    headers = {
+        "Authorization": f"Bearer {HF_API_KEY}",
+        "Content-Type": "application/json"
     }
+    payload = {
+        "inputs": enhanced_prompt,
+        "parameters": {
+            "max_length": max_length,
+            "temperature": 0.7,
+            "do_sample": True,
+            "return_full_text": False,
+            "pad_token_id": 50256
+        },
+        "options": {
+            "wait_for_model": True,
+            "use_cache": False
+        }
+    }
+    if stream:
+        payload["stream"] = True
+    return get_http_session().post(url, headers=headers, json=payload, timeout=30, stream=stream)
+
+
+def _hf_extract_text(result, enhanced_prompt):
+    ai_text = None
+    if isinstance(result, list) and len(result) > 0:
+        ai_text = result[0].get("generated_text", "").strip()
+    elif isinstance(result, dict):
+        ai_text = result.get("generated_text", "").strip()
+
+    # Clean up the response
+    if ai_text and ai_text.startswith(enhanced_prompt):
+        ai_text = ai_text[len(enhanced_prompt):].strip()
+    return ai_text
+
+
+# ----------------------
+# Circuit breakers
+# ----------------------
+
+class CircuitBreaker:
+    """
+    closed -> open when, over the last BREAKER_WINDOW calls, the error rate or the
+    slow-call rate crosses its threshold; open -> half_open after the cool-down;
+    half_open admits a single probe call that either closes or re-opens the breaker.
+    """
+
+    def __init__(self, name, window=20, min_calls=5, error_threshold=0.5,
+                 slow_call_seconds=8.0, slow_call_threshold=0.8, cooldown=30.0):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_threshold = error_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_threshold = slow_call_threshold
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.opened_at = None
+        self._calls = deque(maxlen=window)  # (ok, slow)
+        self._probe_started = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True if a call may go out now; open breakers answer instantly with False"""
+        now = time.monotonic()
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open':
+                if now - self.opened_at < self.cooldown:
+                    return False
+                self.state = 'half_open'
+                self._probe_started = None
+            # half_open: one probe at a time (a stuck probe is replaced after the cool-down)
+            if self._probe_started is None or now - self._probe_started > self.cooldown:
+                self._probe_started = now
+                return True
+            return False
+
+    def record(self, ok, seconds=0.0):
+        # Breakers are named after their upstream, so this is also where AI calls are measured
+        observe_upstream(self.name, seconds, 'ok' if ok else 'error')
+        slow = seconds > self.slow_call_seconds
+        with self._lock:
+            if self.state == 'half_open':
+                if ok and not slow:
+                    self.state = 'closed'
+                    self._calls.clear()
+                else:
+                    self._calls.append((ok, slow))
+                    self._trip()
+                return
+
+            self._calls.append((ok, slow))
+            if len(self._calls) >= self.min_calls:
+                error_rate, slow_rate = self._rates()
+                if error_rate >= self.error_threshold or slow_rate >= self.slow_call_threshold:
+                    self._trip()
+
+    def _trip(self):
+        if self.state != 'open':
+            print(f"Circuit breaker '{self.name}' opened")
+        self.state = 'open'
+        self.opened_at = time.monotonic()
+        self._probe_started = None
+
+    def _rates(self):
+        if not self._calls:
+            return 0.0, 0.0
+        n = len(self._calls)
+        return (sum(1 for ok, _ in self._calls if not ok) / n,
+                sum(1 for _, slow in self._calls if slow) / n)
+
+    def snapshot(self):
+        with self._lock:
+            error_rate, slow_rate = self._rates()
+            retry_in = None
+            if self.state == 'open':
+                retry_in = round(max(0.0, self.cooldown - (time.monotonic() - self.opened_at)), 1)
+            return {
+                'state': self.state,
+                'health': round(1 - error_rate, 3),
+                'error_rate': round(error_rate, 3),
+                'slow_call_rate': round(slow_rate, 3),
+                'recent_calls': len(self._calls),
+                'retry_in_seconds': retry_in
+            }
+
+
+class CircuitBreakerRegistry:
+    """Lazily created breakers sharing one configuration"""
+
+    def __init__(self, **config):
+        self.config = config
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(name, CircuitBreaker(name, **self.config))
+        return breaker
+
+    def snapshot(self):
+        return {name: breaker.snapshot() for name, breaker in list(self._breakers.items())}
+
+
+ai_breakers = CircuitBreakerRegistry(
+    window=BREAKER_WINDOW,
+    min_calls=BREAKER_MIN_CALLS,
+    error_threshold=BREAKER_ERROR_THRESHOLD,
+    slow_call_seconds=BREAKER_SLOW_CALL_SECONDS,
+    slow_call_threshold=BREAKER_SLOW_CALL_THRESHOLD,
+    cooldown=BREAKER_COOLDOWN
+)
+
+
+def _hf_breaker_name(model):
+    return f"hf:{model}"
+
+
+# ----------------------
+# Hugging Face hedging
+# ----------------------
+
+class LatencyStats:
+    """Per-key EWMA latency and success rate, used to rank upstream candidates"""
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, key, seconds, ok):
+        with self._lock:
+            stat = self._stats.setdefault(key, {'latency': seconds, 'success_rate': 1.0 if ok else 0.0, 'calls': 0})
+            if ok:
+                stat['latency'] += self.alpha * (seconds - stat['latency'])
+            stat['success_rate'] += self.alpha * ((1.0 if ok else 0.0) - stat['success_rate'])
+            stat['calls'] += 1
+
+    def expected_cost(self, key):
+        """Latency inflated by the failure rate; None for keys never seen"""
+        stat = self._stats.get(key)
+        if stat is None:
+            return None
+        return stat['latency'] / max(stat['success_rate'], 0.05)
+
+    def snapshot(self):
+        with self._lock:
+            return {k: dict(v) for k, v in self._stats.items()}
+
+
+hf_model_stats = LatencyStats()
+
+_hf_executor = None
+_hf_executor_pid = None
+_hf_executor_lock = threading.Lock()
+
+
+def get_hf_executor():
+    """Bounded thread pool for hedged HF calls, rebuilt after a fork like the HTTP session"""
+    global _hf_executor, _hf_executor_pid
+    pid = os.getpid()
+    if _hf_executor is None or _hf_executor_pid != pid:
+        with _hf_executor_lock:
+            if _hf_executor is None or _hf_executor_pid != pid:
+                _hf_executor = ThreadPoolExecutor(max_workers=HF_MAX_CONCURRENCY, thread_name_prefix='hf-hedge')
+                _hf_executor_pid = pid
+    return _hf_executor
+
+
+def hf_model_order():
+    """Untried models first (in configured order), then fastest expected-cost first"""
+    def rank(indexed):
+        index, model = indexed
+        cost = hf_model_stats.expected_cost(model)
+        return (0, index) if cost is None else (1, cost)
+    return [model for _, model in sorted(enumerate(HF_MODELS), key=rank)]
+
+
+def _hf_try_model(model, enhanced_prompt, max_length):
+    """One HF model attempt; returns the cleaned answer text or None (instantly if its breaker is open)"""
+    breaker = ai_breakers.get(_hf_breaker_name(model))
+    if not breaker.allow():
+        print(f"Model {model} circuit open, skipping")
+        return None
+
+    start = time.monotonic()
+    ai_text = None
+    upstream_ok = False
+    try:
+        response = _hf_request(model, enhanced_prompt, max_length)
+
+        if response.status_code == 200:
+            upstream_ok = True
+            ai_text = _hf_extract_text(response.json(), enhanced_prompt)
+            if ai_text and len(ai_text) > 10:  # Valid response
+                print(f"Hugging Face API request successful with model {model}")
+            else:
+                ai_text = None
+        elif response.status_code == 503:
+            print(f"Model {model} loading, trying next...")
+        else:
+            print(f"Model {model} failed with {response.status_code}: {response.text}")
+
+    except requests.RequestException as e:
+        print(f"Request error with model {model}: {e}")
+
+    elapsed = time.monotonic() - start
+    hf_model_stats.record(model, elapsed, ok=bool(ai_text))
+    breaker.record(upstream_ok, elapsed)
+    return ai_text
+
+
+def _hf_hedged(enhanced_prompt, max_length):
+    """
+    Race HF models on the shared pool and return the first valid answer.
+    In 'staggered' mode the next model is launched HF_HEDGE_DELAY seconds after
+    the previous one (or as soon as every in-flight attempt has failed); in
+    'concurrent' mode all are launched at once. Losers are cancelled if still
+    queued and otherwise left to finish in the background, ignored.
+    """
+    executor = get_hf_executor()
+    delay = 0 if HF_HEDGE_MODE == 'concurrent' else HF_HEDGE_DELAY
+    remaining = hf_model_order()
+    pending = set()
+    deadline = time.monotonic() + HF_HEDGE_TIMEOUT
+    next_launch = time.monotonic()
+
+    try:
+        while remaining or pending:
+            now = time.monotonic()
+            if now >= deadline:
+                print("Hugging Face hedge deadline reached")
+                return None
+
+            if remaining and (now >= next_launch or not pending):
+                model = remaining.pop(0)
+                pending.add(executor.submit(in_current_context(_hf_try_model, model, enhanced_prompt, max_length)))
+                next_launch = now + delay
+                continue
+
+            wake_at = min(deadline, next_launch) if remaining else deadline
+            done, pending = wait(pending, timeout=max(0, wake_at - now), return_when=FIRST_COMPLETED)
+            for future in done:
+                ai_text = future.result()
+                if ai_text:
+                    return ai_text
+        return None
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _ai_answer_uncached(prompt, max_length=200):
+    """
+    Provider chain behind ai_request_with_fallback (steps 2-4).
+    Returns (answer, source) where source names the step that produced it.
+    """
     
-    # Step 1: Check if the prompt contains any medical terms in knowledge base
-    for term, response in medical_responses.items():
-        if term in prompt_lower:
-            return response
-    
-    # Step 2: Try OpenAI API if available
-    if OPENAI_API_KEY:
+    # Step 2: Try OpenAI API if available (skipped instantly while its breaker is open)
+    openai_breaker = ai_breakers.get('openai')
+    if OPENAI_API_KEY and openai_breaker.allow():
+        start = time.monotonic()
+        openai_ok = False
         try:
             print("Attempting OpenAI API request...")
-            client = OpenAI(api_key=OPENAI_API_KEY)
+            client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
             
-            # Enhanced prompt for health context
-            system_prompt = """You are a knowledgeable health education assistant helping community health workers. 
-            Provide accurate, helpful medical information while emphasizing the importance of professional medical consultation. 
-            Keep responses concise and practical for field use."""
-            
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",  # You can use "gpt-4" if you have access
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=max_length,
-                temperature=0.7,
-                timeout=10
-            )
+            with trace_span('openai'):
+                response = client.chat.completions.create(
+                    model="gpt-3.5-turbo",  # You can use "gpt-4" if you have access
+                    messages=[
+                        {"role": "system", "content": OPENAI_SYSTEM_PROMPT},
+                        {"role": "user", "content": prompt}
+                    ],
+                    max_tokens=max_length,
+                    temperature=0.7,
+                    timeout=10
+                )
+            openai_ok = True
             
             ai_text = response.choices[0].message.content.strip()
             
             if ai_text and len(ai_text) > 10:
                 print("OpenAI API request successful")
-                return ai_text + "\n\n⚠️ Disclaimer: This information is for educational purposes only. Always consult a licensed healthcare professional for medical advice."
+                return ai_text + AI_DISCLAIMER, 'openai'
                 
         except openai.APIError as e:
             print(f"OpenAI API error: {e}")
@@ -237,163 +1364,868 @@ def ai_request_with_fallback(prompt, max_length=200):
             print(f"OpenAI rate limit error: {e}")
         except Exception as e:
             print(f"Unexpected OpenAI error: {e}")
+        finally:
+            openai_breaker.record(openai_ok, time.monotonic() - start)
     
     # Step 3: Fall back to Hugging Face if OpenAI fails or is not available
     if HF_API_KEY:
         print("Falling back to Hugging Face API...")
-        
-        # List of models to try (best for free tier, ordered by preference)
-        models_to_try = [
-            "mistralai/Mistral-7B-Instruct-v0.2",  # Good for conversations
-            "google/flan-t5-base",  # Original choice
-            "HuggingFaceH4/zephyr-7b-beta",  # Smaller, faster
-            "tiiuae/falcon-7b-instruct-v2",  # Larger but might have rate limits
-        ]
-        
-        for model in models_to_try:
-            try:
-                url = f"https://api-inference.huggingface.co/models/{model}"
-                headers = {
-                    "Authorization": f"Bearer {HF_API_KEY}",
-                    "Content-Type": "application/json"
-                }
+        enhanced_prompt = _hf_enhanced_prompt(prompt)
+
+        if HF_HEDGE_MODE == 'sequential':
+            ai_text = next(
+                (text for text in (_hf_try_model(m, enhanced_prompt, max_length) for m in hf_model_order()) if text),
+                None
+            )
+        else:
+            ai_text = _hf_hedged(enhanced_prompt, max_length)
+
+        if ai_text:
+            # Add health disclaimer
+            return ai_text + AI_DISCLAIMER, 'huggingface'
+    
+    # Step 4: Final fallback - provide helpful generic response
+    print("All AI services unavailable, using fallback response")
+    return fallback_answer(prompt), 'fallback'
+
+
+# ----------------------
+# AI response cache
+# ----------------------
+
+ai_response_cache = TieredCache(
+    TTLCache(maxsize=AI_CACHE_SIZE, ttl=AI_CACHE_TTL),
+    SQLiteCache(AI_CACHE_DB, max_entries=AI_CACHE_DISK_MAX_ENTRIES, ttl=AI_CACHE_TTL) if AI_CACHE_DB else None,
+    name='ai_response',
+    generations=CacheGenerations(CACHE_GENERATIONS)
+)
+
+# Identical prompts asked at the same time share one provider call
+ai_singleflight = SingleFlight(timeout=AI_SINGLEFLIGHT_TIMEOUT, name='ai')
+
+
+def _ai_provider_chain():
+    return 'openai' if OPENAI_API_KEY else 'huggingface' if HF_API_KEY else 'none'
+
+
+def normalize_prompt(prompt):
+    """Case- and whitespace-insensitive form of a prompt, ignoring trailing punctuation"""
+    return ' '.join(prompt.lower().split()).rstrip('?.! ')
+
+
+def ai_cache_key(prompt, max_length):
+    raw = f"{_ai_provider_chain()}|{max_length}|{normalize_prompt(prompt)}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def ai_request_with_fallback(prompt, max_length=200):
+    """
+    Enhanced AI request system with multiple fallback options:
+    1. First check medical knowledge base
+    2. Try OpenAI API if available (repeat questions are served from the response cache)
+    3. Fall back to Hugging Face if OpenAI fails
+    4. Use a generic guidance response as final fallback
+    """
+    # Step 1: Check if the prompt contains any medical terms in knowledge base
+    kb_response = knowledge_base_answer(prompt)
+    if kb_response:
+        count_ai_answer_path('knowledge_base')
+        return kb_response
+
+    key = ai_cache_key(prompt, max_length)
+    cached = ai_response_cache.get(key)
+    if cached is not None:
+        count_ai_answer_path('cache')
+        return cached
+
+    sources = []
+
+    def compute():
+        with trace_span('ai_providers'):
+            answer, source = _ai_answer_uncached(prompt, max_length)
+        sources.append(source)
+        # Only paid/slow provider answers are worth caching; never cache the outage text
+        if source in ('openai', 'huggingface'):
+            ai_response_cache.set(key, answer)
+        return answer
+
+    answer = ai_singleflight.do(key, compute)
+    # No source recorded means this call shared another caller's in-flight answer
+    count_ai_answer_path(sources[0] if sources else 'coalesced')
+    return answer
+
+
+# ----------------------
+# Streaming AI responses
+# ----------------------
+
+def _openai_stream(prompt, max_length):
+    client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
+    stream = client.chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": OPENAI_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=max_length,
+        temperature=0.7,
+        timeout=10,
+        stream=True
+    )
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+def _hf_stream(model, prompt, max_length):
+    """Yield tokens from an HF model; models without streaming support yield their whole answer once"""
+    enhanced_prompt = _hf_enhanced_prompt(prompt)
+    with _hf_request(model, enhanced_prompt, max_length, stream=True) as response:
+        if response.status_code != 200:
+            raise RuntimeError(f"Model {model} failed with {response.status_code}")
+
+        if not response.headers.get("Content-Type", "").startswith("text/event-stream"):
+            yield _hf_extract_text(response.json(), enhanced_prompt)
+            return
+
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            token = json.loads(line[5:]).get("token") or {}
+            if not token.get("special"):
+                yield token.get("text", "")
+
+
+def ai_stream_with_fallback(prompt, max_length=200):
+    """
+    Streaming counterpart of ai_request_with_fallback, yielding (provider, text) pairs.
+    A provider that fails before its first token is skipped; once tokens have been
+    sent the answer is finished with the disclaimer, even if the stream broke off.
+    """
+    kb_response = knowledge_base_answer(prompt)
+    if kb_response:
+        count_ai_answer_path('knowledge_base')
+        yield "knowledge_base", kb_response
+        return
+
+    key = ai_cache_key(prompt, max_length)
+    cached = ai_response_cache.get(key)
+    if cached is not None:
+        count_ai_answer_path('cache')
+        yield "cache", cached
+        return
+
+    providers = []
+    if OPENAI_API_KEY:
+        providers.append(("openai", "openai", lambda: _openai_stream(prompt, max_length)))
+    if HF_API_KEY:
+        for model in hf_model_order():
+            providers.append(("huggingface", _hf_breaker_name(model),
+                              lambda model=model: _hf_stream(model, prompt, max_length)))
+
+    for provider, breaker_name, open_stream in providers:
+        breaker = ai_breakers.get(breaker_name)
+        if not breaker.allow():
+            continue
+
+        parts = []
+        completed = False
+        start = time.monotonic()
+        try:
+            for text in open_stream():
+                if text:
+                    if not parts:
+                        # Judge the provider on time-to-first-token, not total stream length
+                        breaker.record(True, time.monotonic() - start)
+                    parts.append(text)
+                    yield provider, text
+            completed = True
+        except Exception as e:
+            print(f"{provider} stream error: {e}")
+
+        if not parts:
+            breaker.record(False, time.monotonic() - start)
+
+        if parts:
+            if completed:
+                ai_response_cache.set(key, ''.join(parts) + AI_DISCLAIMER)
+            count_ai_answer_path(provider)
+            yield provider, AI_DISCLAIMER
+            return
+
+    print("All AI services unavailable, using fallback response")
+    count_ai_answer_path('fallback')
+    yield "fallback", fallback_answer(prompt)
+
+
+# Replace your existing supabase_request function with this enhanced version:
+
+def _supabase_headers(use_service_key=False, user_token=None):
+    if use_service_key:
+        # Use service key (bypasses RLS)
+        api_key = SUPABASE_SERVICE_KEY
+        headers = {
+            'apikey': api_key,
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json',
+            'Prefer': 'return=representation'
+        }
+    elif user_token:
+        # Use user JWT token (works with RLS policies)
+        headers = {
+            'apikey': SUPABASE_KEY,  # anon key
+            'Authorization': f'Bearer {user_token}',  # user's JWT token
+            'Content-Type': 'application/json',
+            'Prefer': 'return=representation'
+        }
+    else:
+        # Default behavior (unchanged from your original)
+        api_key = SUPABASE_KEY
+        headers = {
+            'apikey': api_key,
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json',
+            'Prefer': 'return=representation'
+        }
+    return headers
+
+
+# Identical concurrent GETs (same endpoint, params and auth scope) share one upstream call
+supabase_singleflight = SingleFlight(timeout=SINGLEFLIGHT_TIMEOUT, name='supabase')
+
+
+def _auth_scope(use_service_key, user_token):
+    if use_service_key:
+        return 'service'
+    if user_token:
+        # RLS can differ per user, so a user's token only ever shares with itself
+        return hashlib.sha256(user_token.encode()).hexdigest()
+    return 'anon'
+
+
+def supabase_request(method, endpoint, data=None, params=None, use_service_key=False, user_token=None, prefer=None):
+    """Enhanced Supabase request function that handles both service key and user token authentication"""
+    if method == 'GET':
+        key = (endpoint, json.dumps(params, sort_keys=True, default=str), _auth_scope(use_service_key, user_token), prefer)
+        return supabase_singleflight.do(
+            key, lambda: _supabase_request(method, endpoint, data, params, use_service_key, user_token, prefer)
+        )
+    return _supabase_request(method, endpoint, data, params, use_service_key, user_token, prefer)
+
+
+def _supabase_request(method, endpoint, data=None, params=None, use_service_key=False, user_token=None, prefer=None):
+    url = f"{SUPABASE_URL}/rest/v1/{endpoint}"
+    headers = _supabase_headers(use_service_key, user_token)
+    if prefer:
+        headers['Prefer'] = prefer
+
+    try:
+        if method == 'GET':
+            resp = get_http_session().get(url, headers=headers, params=params, timeout=10)
+        elif method == 'POST':
+            resp = get_http_session().post(url, headers=headers, json=data, timeout=10)
+        elif method == 'PATCH':
+            resp = get_http_session().patch(url, headers=headers, json=data, timeout=10)
+        elif method == 'DELETE':
+            resp = get_http_session().delete(url, headers=headers, timeout=10)
+        else:
+            return None
+
+        if resp.status_code < 400:
+            if resp.text.strip():
+                return resp.json()
+            return []
+        else:
+            print(f"Supabase error {resp.status_code}: {resp.text}")
+            return None
+    except requests.RequestException as e:
+        print(f"Supabase request error: {e}")
+        return None
+
+
+def supabase_upsert(table, rows, on_conflict, use_service_key=True):
+    """Bulk insert-or-merge on the given unique columns in a single request"""
+    return supabase_request(
+        'POST', f'{table}?on_conflict={on_conflict}', rows,
+        use_service_key=use_service_key,
+        prefer='resolution=merge-duplicates,return=representation'
+    )
+
+
+def supabase_get_with_total(endpoint, params=None, use_service_key=False, user_token=None, count='exact'):
+    """GET rows plus the total row count PostgREST reports for the filter; returns (rows, total)"""
+    url = f"{SUPABASE_URL}/rest/v1/{endpoint}"
+    headers = _supabase_headers(use_service_key, user_token)
+    headers['Prefer'] = f'count={count}'
+
+    try:
+        resp = get_http_session().get(url, headers=headers, params=params, timeout=10)
+        if resp.status_code >= 400:
+            print(f"Supabase error {resp.status_code}: {resp.text}")
+            return None, None
+        rows = resp.json() if resp.text.strip() else []
+        return rows, parse_content_range_total(resp.headers.get('Content-Range'))
+    except requests.RequestException as e:
+        print(f"Supabase request error: {e}")
+        return None, None
+
+
+def parse_content_range_total(content_range):
+    """Total from a PostgREST Content-Range header ('0-24/3573' or '*/3573'); None if unknown"""
+    total = (content_range or '').rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+
+def supabase_count(endpoint, use_service_key=False, user_token=None, count='exact'):
+    """Row count for a filtered table via a HEAD request, without downloading any rows"""
+    url = f"{SUPABASE_URL}/rest/v1/{endpoint}"
+    headers = _supabase_headers(use_service_key, user_token)
+    headers['Prefer'] = f'count={count}'
+
+    try:
+        resp = get_http_session().head(url, headers=headers, timeout=10)
+        if resp.status_code >= 400:
+            print(f"Supabase count error {resp.status_code} for {endpoint}")
+            return None
+        return parse_content_range_total(resp.headers.get('Content-Range'))
+    except requests.RequestException as e:
+        print(f"Supabase count error: {e}")
+        return None
+
+
+# ----------------------
+# Background jobs
+# ----------------------
+
+class JobQueue:
+    """
+    Persistent local queue (SQLite, WAL) of deferred side effects. Jobs are leased
+    when claimed, so a worker that dies mid-job has it picked up again by any worker
+    once the lease runs out. Failures back off exponentially and are dead-lettered
+    after JOB_MAX_ATTEMPTS. A dedupe_key allows only one pending job per key.
+    """
+
+    LEASE_SECONDS = 120
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = connect_sqlite(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS jobs ("
+                    "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, payload TEXT NOT NULL, "
+                    "dedupe_key TEXT, state TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+                    "next_attempt_at REAL NOT NULL DEFAULT 0, claimed_until REAL NOT NULL DEFAULT 0, "
+                    "created_at REAL NOT NULL, last_error TEXT)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (state, next_attempt_at)")
+                conn.execute(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS jobs_pending_dedupe ON jobs (dedupe_key) "
+                    "WHERE state = 'pending' AND dedupe_key IS NOT NULL"
+                )
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def enqueue(self, kind, payload, dedupe_key=None):
+        """Returns False when an identical job (same dedupe_key) is already pending"""
+        with self._conn() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO jobs (kind, payload, dedupe_key, created_at) VALUES (?, ?, ?, ?)",
+                (kind, json.dumps(payload), dedupe_key, time.time())
+            )
+        return cursor.rowcount == 1
+
+    def claim(self, limit):
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id, kind, payload, attempts FROM jobs WHERE state = 'pending' "
+                "AND next_attempt_at <= ? AND claimed_until <= ? ORDER BY id LIMIT ?",
+                (now, now, limit)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET claimed_until = ? WHERE id = ?",
+                [(now + self.LEASE_SECONDS, row[0]) for row in rows]
+            )
+        return [{'id': r[0], 'kind': r[1], 'payload': json.loads(r[2]), 'attempts': r[3]} for r in rows]
+
+    def complete(self, job):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job['id'],))
+
+    def fail(self, job, error):
+        """Schedule a retry; returns True if the job was dead-lettered instead"""
+        attempts = job['attempts'] + 1
+        dead = attempts >= JOB_MAX_ATTEMPTS
+        with self._conn() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = ?, attempts = ?, next_attempt_at = ?, claimed_until = 0, "
+                "last_error = ? WHERE id = ?",
+                ('dead' if dead else 'pending', attempts,
+                 time.time() + min(JOB_RETRY_BASE * 2 ** (attempts - 1), 3600), error[:1000], job['id'])
+            )
+        return dead
+
+    def retry_dead(self):
+        """
+        Requeue dead letters with fresh attempts. One whose dedupe_key already has a
+        pending job (or another dead letter requeued first) is dropped instead, as
+        that job does the same work.
+        """
+        with self._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.execute(
+                "UPDATE OR IGNORE jobs SET state = 'pending', attempts = 0, next_attempt_at = 0, claimed_until = 0 "
+                "WHERE state = 'dead'"
+            )
+            conn.execute("DELETE FROM jobs WHERE state = 'dead'")
+        return cursor.rowcount
+
+    def stats(self):
+        with self._conn() as conn:
+            pending = dict(conn.execute(
+                "SELECT kind, COUNT(*) FROM jobs WHERE state = 'pending' GROUP BY kind").fetchall())
+            dead = conn.execute(
+                "SELECT id, kind, attempts, last_error FROM jobs WHERE state = 'dead' ORDER BY id DESC LIMIT 20"
+            ).fetchall()
+            dead_total = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'dead'").fetchone()[0]
+        return {
+            'pending': pending,
+            'dead': dead_total,
+            'recent_dead': [dict(zip(('id', 'kind', 'attempts', 'last_error'), row)) for row in dead]
+        }
+
+
+JOB_HANDLERS = {}
+job_queue = JobQueue(JOB_QUEUE_DB)
+_job_runner_pid = None
+_job_runner_lock = threading.Lock()
+_job_wakeup = threading.Event()
+
+
+def background_job(kind):
+    """Register fn(payload) as the handler for `kind`; raising schedules a retry"""
+    def register(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+def enqueue_job(kind, payload, dedupe_key=None):
+    """Defer a side effect; if the queue itself is unusable, do it now rather than lose it"""
+    try:
+        job_queue.enqueue(kind, payload, dedupe_key)
+    except sqlite3.Error as e:
+        print(f"Job queue unavailable ({e}); running {kind} inline")
+        try:
+            JOB_HANDLERS[kind](payload)
+        except Exception as job_error:
+            print(f"Inline {kind} job failed: {job_error}")
+        return
+    ensure_job_runner()
+    _job_wakeup.set()
+
+
+def _run_job(job, slots):
+    kind = job['kind']
+    try:
+        JOB_HANDLERS[kind](job['payload'])
+        job_queue.complete(job)
+        outcome = 'done'
+    except Exception as e:
+        outcome = 'dead' if job_queue.fail(job, f"{type(e).__name__}: {e}") else 'retry'
+        print(f"Background job {kind}#{job['id']} failed ({outcome}): {e}")
+    finally:
+        slots.release()
+        _job_wakeup.set()  # a slot is free for the next due job
+    if METRICS_ENABLED:
+        BACKGROUND_JOBS.labels(kind, outcome).inc()
+
+
+def _job_runner():
+    executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+    slots = threading.BoundedSemaphore(JOB_WORKERS)
+    while True:
+        _job_wakeup.wait(JOB_POLL_INTERVAL)
+        _job_wakeup.clear()
+        try:
+            # Claim only what the pool can start now; the rest stays claimable by other workers
+            free = 0
+            while slots.acquire(blocking=False):
+                free += 1
+            jobs = job_queue.claim(free) if free else []
+            for _ in range(free - len(jobs)):
+                slots.release()
+            for job in jobs:
+                if job['kind'] not in JOB_HANDLERS:
+                    job_queue.fail(job, f"No handler for {job['kind']}")
+                    slots.release()
+                    continue
+                executor.submit(_run_job, job, slots)
+            if jobs:
+                _job_wakeup.set()  # there may be more due
+        except Exception as e:
+            print(f"Job runner error: {e}")
+
+
+def ensure_job_runner():
+    """Start this worker's job runner (once per process)"""
+    global _job_runner_pid
+    if _job_runner_pid == os.getpid():
+        return
+    with _job_runner_lock:
+        if _job_runner_pid != os.getpid():
+            threading.Thread(target=_job_runner, name='job-runner', daemon=True).start()
+            _job_runner_pid = os.getpid()
+
+
+@app.before_request
+def _start_job_runner():
+    # Also resumes jobs queued before a restart
+    ensure_job_runner()
+
+
+# ----------------------
+# Rate limiting
+# ----------------------
+
+RATE_LIMITS = {
+    'default': (RATE_LIMIT_PER_MINUTE, RATE_LIMIT_PER_HOUR),
+    'ai': (AI_RATE_LIMIT_PER_MINUTE, AI_RATE_LIMIT_PER_HOUR),
+    'auth': (AUTH_RATE_LIMIT_PER_MINUTE, AUTH_RATE_LIMIT_PER_HOUR),
+}
+
+# Machine-to-machine and monitoring endpoints are never limited
+RATE_LIMIT_EXEMPT = ('/api/payments/webhook', '/api/status')
+
+
+def rate_limit_class(path):
+    if not path.startswith('/api/') or path.startswith(RATE_LIMIT_EXEMPT):
+        return None
+    if path.startswith('/api/ai/'):
+        return 'ai'
+    if path.startswith('/api/auth/') and not path.startswith('/api/auth/logout'):
+        return 'auth'
+    return 'default'
+
+
+def _take_tokens(state, now, limits, factor):
+    """
+    Refill then spend one token from every bucket of `state` ([tokens..., updated_at]).
+    Returns (new state, seconds until the request would be allowed; 0 = allowed).
+    """
+    buckets = []
+    for i, (limit, window) in enumerate(((limits[0], 60), (limits[1], 3600))):
+        capacity = limit * factor
+        rate = capacity / window
+        tokens = capacity if state is None else min(capacity, state[i] + (now - state[-1]) * rate)
+        buckets.append((tokens, rate))
+
+    retry_after = max((1 - tokens) / rate if tokens < 1 else 0.0 for tokens, rate in buckets)
+    spent = 0 if retry_after else 1
+    return [tokens - spent for tokens, _ in buckets] + [now], retry_after
+
+
+class MemoryBucketStore:
+    """Buckets in this worker's memory, least-recently-used keys dropped past maxsize"""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, limits, factor):
+        now = time.monotonic()
+        with self._lock:
+            state, retry_after = _take_tokens(self._buckets.get(key), now, limits, factor)
+            self._buckets[key] = state
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+
+class SQLiteBucketStore:
+    """Buckets in a SQLite file so every worker on the host spends from the same budget"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._takes = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = connect_sqlite(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Losing a few seconds of bucket state in a crash is harmless
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def take(self, key, limits, factor):
+        now = time.time()
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT state FROM buckets WHERE key = ?", (key,)).fetchone()
+            state, retry_after = _take_tokens(json.loads(row[0]) if row else None, now, limits, factor)
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (key, state, updated_at) VALUES (?, ?, ?)",
+                (key, json.dumps(state), now)
+            )
+            self._takes += 1
+            if self._takes % 1000 == 0:
+                # Idle for an hour means every bucket is full again, so the row carries no information
+                conn.execute("DELETE FROM buckets WHERE updated_at < ?", (now - 3600,))
+            conn.execute("COMMIT")
+            return retry_after
+        except sqlite3.Error as e:
+            # Fail open: a broken store must not take the API down with it
+            print(f"Rate limit store error: {e}")
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            return 0.0
+
+
+rate_limit_store = SQLiteBucketStore(RATE_LIMIT_STORE) if RATE_LIMIT_STORE else MemoryBucketStore()
+
+if TRUSTED_PROXIES:
+    # request.remote_addr becomes the client address the trusted proxy saw, not the proxy itself
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
+
+def rate_limited_response(route_class, scope, key, factor=1):
+    """429 response if `key` has spent its budget for this route class, else None"""
+    if not RATE_LIMIT_ENABLED or route_class is None:
+        return None
+    retry_after = rate_limit_store.take(f"{scope}:{route_class}:{key}", RATE_LIMITS[route_class], factor)
+    if not retry_after:
+        return None
 
-                # Enhance prompt for health context
-                enhanced_prompt = f"""As a health education assistant, respond to this health-related question with accurate, helpful information: {prompt}
+    if METRICS_ENABLED:
+        RATE_LIMITED.labels(route_class, scope).inc()
+    response = jsonify({'error': 'Rate limit exceeded', 'retry_after': math.ceil(retry_after)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(math.ceil(retry_after))
+    return response
 
-Please provide clear, actionable guidance while emphasizing the importance of professional medical consultation."""
 
-                payload = {
-                    "inputs": enhanced_prompt,
-                    "parameters": {
-                        "max_length": max_length,
-                        "temperature": 0.7,
-                        "do_sample": True,
-                        "return_full_text": False,
-                        "pad_token_id": 50256
-                    },
-                    "options": {
-                        "wait_for_model": True,
-                        "use_cache": False
-                    }
-                }
+@app.before_request
+def _rate_limit_by_ip():
+    if request.method == 'OPTIONS':
+        return None
+    # Only routes behind token_required get the shared-NAT allowance; anonymous ones
+    # (login, /api/ai/test) are held to the plain limit per address
+    view = app.view_functions.get(request.endpoint)
+    factor = RATE_LIMIT_IP_FACTOR if getattr(view, 'requires_auth', False) else 1
+    return rate_limited_response(rate_limit_class(request.path), 'ip', request.remote_addr, factor)
 
-                response = requests.post(url, headers=headers, json=payload, timeout=30)
-
-                if response.status_code == 200:
-                    result = response.json()
-                    ai_text = None
-
-                    if isinstance(result, list) and len(result) > 0:
-                        ai_text = result[0].get("generated_text", "").strip()
-                    elif isinstance(result, dict):
-                        ai_text = result.get("generated_text", "").strip()
-
-                    if ai_text and len(ai_text) > 10:  # Valid response
-                        # Clean up the response
-                        if ai_text.startswith(enhanced_prompt):
-                            ai_text = ai_text[len(enhanced_prompt):].strip()
-                        
-                        print(f"Hugging Face API request successful with model {model}")
-                        # Add health disclaimer
-                        return ai_text + "\n\n⚠️ Disclaimer: This information is for educational purposes only. Always consult a licensed healthcare professional for medical advice."
-                    
-                elif response.status_code == 503:
-                    print(f"Model {model} loading, trying next...")
-                    continue  # Try next model
-                else:
-                    print(f"Model {model} failed with {response.status_code}: {response.text}")
-                    continue  # Try next model
-                    
-            except requests.RequestException as e:
-                print(f"Request error with model {model}: {e}")
-                continue  # Try next model
-    
-    # Step 4: Final fallback - provide helpful generic response
-    print("All AI services unavailable, using fallback response")
-    return f"""I understand you're asking about: "{prompt[:100]}{'...' if len(prompt) > 100 else ''}"
 
-**For health-related questions, I recommend:**
-• Consulting with a qualified healthcare professional
-• Visiting your local health facility
-• Calling your country's health helpline
-• Using official health organization resources (WHO, CDC, local health ministry)
+# ----------------------
+# Auth Middleware
+# ----------------------
 
-**Common health topics I can help with:**
-• Malaria prevention and symptoms
-• Fever management
-• Diabetes basics
-• Diarrhea treatment
-• Cough care
-• Basic first aid
-• Nutrition guidelines
-• Hygiene practices
+class RevocationStore:
+    """
+    Revoked tokens and per-user not-before times in a SQLite file, so a logout or
+    password reset handled by one worker is honoured by every worker on the host.
+    Each row is kept only as long as the tokens it can reject.
+    """
 
-**To enable AI-powered responses:**
-1. Set OPENAI_API_KEY in your .env file for OpenAI (primary)
-2. Set HF_API_KEY in your .env file for Hugging Face (fallback)
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = connect_sqlite(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS revocations ("
+                "key TEXT PRIMARY KEY, not_before REAL NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def revoke(self, key, not_before, ttl):
+        """Reject tokens under `key` issued before not_before, for the next ttl seconds"""
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO revocations (key, not_before, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET not_before = max(not_before, excluded.not_before), "
+                "expires_at = max(expires_at, excluded.expires_at)",
+                (key, not_before, now + ttl)
+            )
+            self._writes += 1
+            if self._writes % 100 == 0:
+                conn.execute("DELETE FROM revocations WHERE expires_at <= ?", (now,))
 
-⚠️ Disclaimer: This is educational information only. Always consult a licensed healthcare professional for medical advice."""
+    def not_before(self, *keys):
+        """Latest live not-before among keys, or None"""
+        try:
+            row = self._conn().execute(
+                f"SELECT max(not_before) FROM revocations WHERE key IN ({','.join('?' * len(keys))}) "
+                "AND expires_at > ?",
+                (*keys, time.time())
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Revocation store read error: {e}")
+            return None
+        return row[0]
 
 
-# Replace your existing supabase_request function with this enhanced version:
+# token hash -> (user_id, iat); entries never outlive the token's own exp
+_token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL, name='token')
+# 'token:<hash>' rows revoke one token (logout), 'user:<id>' rows every older token (password reset)
+revocation_store = RevocationStore(REVOCATION_STORE)
 
-def supabase_request(method, endpoint, data=None, params=None, use_service_key=False, user_token=None):
-    """Enhanced Supabase request function that handles both service key and user token authentication"""
-    url = f"{SUPABASE_URL}/rest/v1/{endpoint}"
-    
-    if use_service_key:
-        # Use service key (bypasses RLS)
-        api_key = SUPABASE_SERVICE_KEY
-        headers = {
-            'apikey': api_key,
-            'Authorization': f'Bearer {api_key}',
-            'Content-Type': 'application/json',
-            'Prefer': 'return=representation'
-        }
-    elif user_token:
-        # Use user JWT token (works with RLS policies)
-        headers = {
-            'apikey': SUPABASE_KEY,  # anon key
-            'Authorization': f'Bearer {user_token}',  # user's JWT token
-            'Content-Type': 'application/json',
-            'Prefer': 'return=representation'
-        }
+_jwks = None
+_jwks_fetched_at = 0
+_jwks_lock = threading.Lock()
+
+
+class TokenUnverifiable(Exception):
+    """Local verification isn't possible for this token; use remote introspection"""
+
+
+def _token_key(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _get_jwks():
+    """Fetch and cache the project's JWKS (used for asymmetric signing keys)"""
+    global _jwks, _jwks_fetched_at
+    if _jwks is not None and time.time() - _jwks_fetched_at < JWKS_CACHE_TTL:
+        return _jwks
+    with _jwks_lock:
+        if _jwks is None or time.time() - _jwks_fetched_at >= JWKS_CACHE_TTL:
+            try:
+                resp = get_http_session().get(f"{SUPABASE_URL}/auth/v1/.well-known/jwks.json", timeout=5)
+                resp.raise_for_status()
+                _jwks = jwt.PyJWKSet.from_dict(resp.json())
+            except (requests.RequestException, ValueError, jwt.PyJWKSetError, jwt.PyJWKError) as e:
+                print(f"JWKS fetch failed: {e}")
+                _jwks = None
+            _jwks_fetched_at = time.time()
+    return _jwks
+
+
+def verify_access_token_locally(token):
+    """Verify signature, expiry and audience of a Supabase access token without a network call.
+
+    Returns the decoded claims, raises jwt.InvalidTokenError for a bad token and
+    TokenUnverifiable when no matching key is configured.
+    """
+    header = jwt.get_unverified_header(token)
+    alg = header.get('alg')
+
+    if alg == 'HS256':
+        if not SUPABASE_JWT_SECRET:
+            raise TokenUnverifiable('SUPABASE_JWT_SECRET not configured')
+        key = SUPABASE_JWT_SECRET
     else:
-        # Default behavior (unchanged from your original)
-        api_key = SUPABASE_KEY
-        headers = {
-            'apikey': api_key,
-            'Authorization': f'Bearer {api_key}',
-            'Content-Type': 'application/json',
-            'Prefer': 'return=representation'
-        }
+        jwks = _get_jwks() if SUPABASE_URL else None
+        kid = header.get('kid')
+        match = next((k for k in jwks.keys if k.key_id == kid), None) if jwks else None
+        if match is None:
+            raise TokenUnverifiable(f'no JWKS key for kid={kid}')
+        key = match.key
+
+    return jwt.decode(
+        token, key,
+        algorithms=[alg],
+        audience=SUPABASE_JWT_AUDIENCE,
+        options={'require': ['exp', 'sub']}
+    )
 
-    try:
-        if method == 'GET':
-            resp = requests.get(url, headers=headers, params=params, timeout=10)
-        elif method == 'POST':
-            resp = requests.post(url, headers=headers, json=data, timeout=10)
-        elif method == 'PATCH':
-            resp = requests.patch(url, headers=headers, json=data, timeout=10)
-        elif method == 'DELETE':
-            resp = requests.delete(url, headers=headers, timeout=10)
-        else:
-            return None
 
-        if resp.status_code < 400:
-            if resp.text.strip():
-                return resp.json()
-            return []
-        else:
-            print(f"Supabase error {resp.status_code}: {resp.text}")
+def fetch_auth_user(token):
+    """Supabase's record (id, email, user_metadata...) of the user this token belongs to, or None"""
+    url = f"{SUPABASE_URL}/auth/v1/user"
+    headers = {"apikey": SUPABASE_KEY, "Authorization": f"Bearer {token}"}
+    resp = get_http_session().get(url, headers=headers, timeout=10)
+    if resp.status_code >= 400:
+        return None
+    return resp.json()
+
+
+def _introspect_token_remotely(token):
+    """Ask Supabase who owns this token (the slow path)"""
+    user = fetch_auth_user(token)
+    return user["id"] if user else None
+
+
+def _is_revoked(key, user_id, issued_at):
+    not_before = revocation_store.not_before(f'token:{key}', f'user:{user_id}')
+    return not_before is not None and (issued_at or 0) < not_before
+
+
+def resolve_token_user(token):
+    """Return the user id for a valid access token, or None"""
+    key = _token_key(token)
+    cached = _token_cache.get(key)
+    if cached is not None:
+        user_id, issued_at = cached
+        return None if _is_revoked(key, user_id, issued_at) else user_id
+
+    ttl = TOKEN_CACHE_TTL
+    try:
+        claims = verify_access_token_locally(token)
+        user_id, issued_at = claims['sub'], claims.get('iat')
+        ttl = min(ttl, max(0, claims['exp'] - time.time()))
+    except jwt.InvalidTokenError:
+        return None
+    except TokenUnverifiable:
+        user_id = _introspect_token_remotely(token)
+        if not user_id:
             return None
-    except requests.RequestException as e:
-        print(f"Supabase request error: {e}")
+        # Supabase vouched for the token, so its unverified claims are trustworthy enough:
+        # iat to compare against a password reset (without one it counts as issued at 0),
+        # exp so the cache entry doesn't outlive the token
+        claims = jwt.decode(token, options={'verify_signature': False})
+        issued_at = claims.get('iat')
+        if claims.get('exp') is not None:
+            ttl = min(ttl, max(0, claims['exp'] - time.time()))
+
+    if _is_revoked(key, user_id, issued_at):
         return None
-# ----------------------
-# Auth Middleware
-# ----------------------
+    _token_cache.set(key, (user_id, issued_at), ttl=ttl)
+    return user_id
+
+
+def revoke_token(token):
+    """Forget a single access token (logout); it stays rejected until it would have expired"""
+    key = _token_key(token)
+    try:
+        exp = jwt.decode(token, options={'verify_signature': False}).get('exp')
+    except jwt.InvalidTokenError:
+        exp = None
+    _token_cache.pop(key)
+    # Every iat is before the token's own exp, so this rejects it whatever it claims
+    ttl = max(0, exp - time.time()) if exp else REVOCATION_TTL
+    revocation_store.revoke(f'token:{key}', time.time() + ttl, ttl)
+
+
+def revoke_user_tokens(user_id):
+    """Reject every token issued to user_id before now (password reset)"""
+    revocation_store.revoke(f'user:{user_id}', int(time.time()), REVOCATION_TTL)
+    _token_cache.pop_where(lambda k, v: v[0] == user_id)
+
 
 def token_required(f):
     @wraps(f)
@@ -405,21 +2237,32 @@ def token_required(f):
         try:
             token = auth_header.split(' ')[1]
 
-            # Validate token with Supabase
-            url = f"{SUPABASE_URL}/auth/v1/user"
-            headers = {"apikey": SUPABASE_KEY, "Authorization": f"Bearer {token}"}
-            resp = requests.get(url, headers=headers, timeout=10)
-
-            if resp.status_code >= 400:
+            with trace_span('auth'):
+                current_user_id = resolve_token_user(token)
+            if not current_user_id:
                 return jsonify({'error': 'Invalid Supabase token'}), 401
 
-            user = resp.json()
-            current_user_id = user["id"]
-
         except Exception as e:
             return jsonify({'error': f'Invalid token: {str(e)}'}), 401
 
-        return f(current_user_id, *args, **kwargs)
+        limited = rate_limited_response(rate_limit_class(request.path), 'user', current_user_id)
+        if limited is not None:
+            return limited
+
+        with trace_span('handler'):
+            return f(current_user_id, *args, **kwargs)
+    decorated.requires_auth = True
+    return decorated
+
+
+def admin_required(f):
+    """Guard operational endpoints with the X-Admin-Key header (disabled when ADMIN_API_KEY is unset)"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        supplied = request.headers.get('X-Admin-Key', '')
+        if not ADMIN_API_KEY or not hmac.compare_digest(supplied, ADMIN_API_KEY):
+            return jsonify({'error': 'Admin access required'}), 403
+        return f(*args, **kwargs)
     return decorated
 
 
@@ -438,6 +2281,113 @@ def index():
     })
 
 
+# user ids whose profile this worker has already queued or confirmed, so logins skip the job
+_profiles_ensured = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=3600)
+
+
+@background_job('upsert_profile')
+def _upsert_profile_job(payload):
+    """Create the profile row; registration data overwrites, login metadata only fills a missing row"""
+    resolution = 'merge-duplicates' if payload.get('merge') else 'ignore-duplicates'
+    result = supabase_request(
+        'POST', 'profiles?on_conflict=id', [payload['profile']],
+        use_service_key=True, prefer=f'resolution={resolution},return=minimal'
+    )
+    if result is None:
+        raise RuntimeError('Profile upsert failed')
+
+
+def _profile_from_auth_user(user):
+    """Profile row for a Supabase auth user, from the metadata given at signup"""
+    user_metadata = user.get("user_metadata") or {}
+    return {
+        "id": user["id"],
+        "name": user_metadata.get("name", ""),
+        "location": user_metadata.get("location", ""),
+        "role": user_metadata.get("role", "health_worker")
+    }
+
+
+def create_missing_profile(user_id, user_token):
+    """
+    Write the profile inline when the deferred upsert_profile job hasn't landed yet
+    (backing off, or dead-lettered), so a signed-in user always has one. Returns the
+    row, or None; raises RuntimeError if Supabase won't take the write.
+    """
+    user = fetch_auth_user(user_token) if user_token else None
+    if not user or user.get("id") != user_id:
+        user = {"id": user_id}
+    _upsert_profile_job({'profile': _profile_from_auth_user(user)})
+    profiles = supabase_request('GET', f'profiles?id=eq.{user_id}', use_service_key=True)
+    return profiles[0] if profiles else None
+
+
+def create_intasend_customer(user_id):
+    """Create the IntaSend customer behind a user's paid subscriptions; returns its id"""
+    fake_email = f"{user_id}@yourapp.local"
+    customer_resp = get_http_session().post(
+        f"{API_BASE}/subscriptions-customers/",
+        headers={
+            "Authorization": f"Bearer {INTASEND_SECRET_KEY.strip()}",
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        },
+        json={
+            "email": fake_email,
+            "first_name": "User",
+            "last_name": str(user_id)[:8],
+        },
+        timeout=20,
+    )
+    customer_resp.raise_for_status()
+    return customer_resp.json().get("customer_id")
+
+
+# Concurrent checkouts by one user in this worker share one customer creation
+_customer_singleflight = SingleFlight(timeout=30, name='intasend_customer')
+
+
+def _stored_customer_id(user_id):
+    profiles = supabase_request(
+        'GET', f'profiles?id=eq.{user_id}&select=intasend_customer_id', use_service_key=True
+    )
+    return profiles[0].get('intasend_customer_id') if profiles else None
+
+
+def _create_and_store_customer(user_id):
+    customer_id = _stored_customer_id(user_id)
+    if customer_id:
+        return customer_id  # a checkout that just finished stored one
+
+    customer_id = create_intasend_customer(user_id)
+    # Only fills an empty column, so two workers racing can't both keep their own customer
+    stored = supabase_request(
+        "PATCH",
+        f"profiles?id=eq.{user_id}&intasend_customer_id=is.null",
+        {"intasend_customer_id": customer_id},
+        use_service_key=True,
+    )
+    if stored is None:
+        raise RuntimeError(f'Saving IntaSend customer {customer_id} for {user_id} failed')
+    if stored:
+        return customer_id
+
+    winner = _stored_customer_id(user_id)
+    if not winner:
+        raise RuntimeError(f'IntaSend customer {customer_id} for {user_id} could not be stored')
+    print(f"IntaSend customer {customer_id} for {user_id} lost a race to {winner}; it is left unused")
+    return winner
+
+
+def ensure_intasend_customer(user_id):
+    """
+    The user's IntaSend customer id, created at their first paid checkout and stored on
+    the profile before anything uses it, so a retried checkout finds it rather than
+    creating another.
+    """
+    return _customer_singleflight.do(user_id, lambda: _create_and_store_customer(user_id))
+
+
 # Auth: Register user
 @app.route('/api/auth/register', methods=['POST'])
 def register():
@@ -473,7 +2423,7 @@ def register():
         "redirect_to": "http://127.0.0.1:5500/frontend/login.html?status=verified"
     }
 
-    resp = requests.post(url, headers=headers, json=payload, timeout=10)
+    resp = get_http_session().post(url, headers=headers, json=payload, timeout=10)
 
     if resp.status_code >= 400:
         return jsonify({'error': resp.text}), resp.status_code
@@ -489,15 +2439,17 @@ def register():
             "supabase_response": resp_json
         }), 201
 
-    # Insert into profiles table with correct ID + email
-    supabase_request('POST', 'profiles', {
-        'id': user["id"],
-        'name': name,
-        'location': location,
-        'role': role,
-        'email': email,                  # 👈 now saved
-        'intasend_customer_id': None     # 👈 placeholder for later
-    }, use_service_key=True)
+    # Insert into profiles table with correct ID + email (deferred; retried until it lands)
+    enqueue_job('upsert_profile', {
+        'profile': {
+            'id': user["id"],
+            'name': name,
+            'location': location,
+            'role': role,
+            'email': email                   # 👈 now saved
+        },
+        'merge': True
+    }, dedupe_key=f'register-profile:{user["id"]}')
 
     return jsonify({
         'message': 'User registered successfully. Please check your email to confirm.',
@@ -523,7 +2475,7 @@ def login():
         "Content-Type": "application/json"
     }
     payload = {"email": email, "password": password}
-    resp = requests.post(url, headers=headers, json=payload, timeout=10)
+    resp = get_http_session().post(url, headers=headers, json=payload, timeout=10)
 
     if resp.status_code >= 400:
         return jsonify({'error': resp.text}), resp.status_code
@@ -538,22 +2490,10 @@ def login():
 
     user_id = user["id"]
 
-    # --- Check if profile exists ---
-    profile_resp = supabase_request('GET', f'profiles?id=eq.{user_id}', use_service_key=True)
-
-    if isinstance(profile_resp, list) and len(profile_resp) == 0:
-        # Profile does not exist -> create it
-        user_metadata = user.get("user_metadata", {})
-        name = user_metadata.get("name", "")
-        location = user_metadata.get("location", "")
-        role = user_metadata.get("role", "health_worker")
-
-        supabase_request('POST', 'profiles', {
-            "id": user_id,
-            "name": name,
-            "location": location,
-            "role": role
-        }, use_service_key=True)
+    # --- Make sure the profile exists, off the response path ---
+    if _profiles_ensured.get(user_id) is None:
+        enqueue_job('upsert_profile', {'profile': _profile_from_auth_user(user)}, dedupe_key=f'profile:{user_id}')
+        _profiles_ensured.set(user_id, True)
 
     return jsonify({
         "access_token": access_token,
@@ -561,6 +2501,24 @@ def login():
         "user": user
     }), 200
 
+@app.route('/api/auth/logout', methods=['POST'])
+@token_required
+def logout(current_user_id):
+    token = request.headers.get('Authorization', '').replace('Bearer ', '')
+
+    # Best effort: end the Supabase session, but always drop our cached verification
+    try:
+        get_http_session().post(
+            f"{SUPABASE_URL}/auth/v1/logout",
+            headers={"apikey": SUPABASE_KEY, "Authorization": f"Bearer {token}"},
+            timeout=10
+        )
+    except requests.RequestException as e:
+        print(f"Supabase logout error: {e}")
+
+    revoke_token(token)
+    return jsonify({"success": True, "message": "Logged out"}), 200
+
 @app.route('/api/auth/forgot-password', methods=['POST'])
 def forgot_password():
     data = request.get_json()
@@ -583,7 +2541,7 @@ def forgot_password():
             }
         }
         
-        resp = requests.post(url, headers=headers, json=payload, timeout=10)
+        resp = get_http_session().post(url, headers=headers, json=payload, timeout=10)
         
         if resp.status_code == 200:
             return jsonify({
@@ -626,9 +2584,14 @@ def reset_password():
             "password": new_password
         }
         
-        resp = requests.put(url, headers=headers, json=payload, timeout=10)
+        resp = get_http_session().put(url, headers=headers, json=payload, timeout=10)
         
         if resp.status_code == 200:
+            # Sessions from before the reset must not keep riding the token cache
+            revoke_token(access_token)
+            user_id = (resp.json() or {}).get("id")
+            if user_id:
+                revoke_user_tokens(user_id)
             return jsonify({
                 "success": True,
                 "message": "Password updated successfully"
@@ -666,22 +2629,30 @@ def get_profile(current_user_id):
     # Extract token from request headers
     user_token = request.headers.get('Authorization', '').replace('Bearer ', '')
     
-    # Try with user token first (proper RLS)
-    profile = supabase_request('GET', f'profiles?id=eq.{current_user_id}', user_token=user_token)
-    
-    # Fall back to service key if needed
-    if not profile or len(profile) == 0:
-        profile = supabase_request('GET', f'profiles?id=eq.{current_user_id}', use_service_key=True)
-    
-    if not profile or len(profile) == 0:
-        return jsonify({'error': 'Profile not found'}), 404
-    
-    return jsonify({'profile': profile[0]}), 200
+    # Ask with the user token (proper RLS) and the service key at once;
+    # the service-key row is only used if the RLS lookup comes back empty
+    results = fan_out({
+        'user': lambda: supabase_request('GET', f'profiles?id=eq.{current_user_id}', user_token=user_token),
+        'service': lambda: supabase_request('GET', f'profiles?id=eq.{current_user_id}', use_service_key=True)
+    })
+    profile = results['user'] or results['service']
+
+    if not profile:
+        # Created at register/login by a background job that may not have run yet
+        try:
+            profile = [create_missing_profile(current_user_id, user_token)]
+        except RuntimeError as e:
+            print(f"Profile creation failed: {e}")
+            return jsonify({'error': 'Failed to load profile'}), 502
+        if profile[0] is None:
+            return jsonify({'error': 'Profile not found'}), 404
+
+    return conditional_rows_json({'profile': profile[0]}, profile[0])
 
 @app.route("/api/payments/test-intasend", methods=["GET"])
 def test_intasend():
     try:
-        resp = requests.get(
+        resp = get_http_session().get(
             f"{API_BASE}/plans/",
             headers={"Authorization": f"Bearer {INTASEND_SECRET_KEY}"}
         )
@@ -696,7 +2667,7 @@ def test_intasend():
 @token_required
 def list_plans(current_user_id):
     try:
-        resp = requests.get(
+        resp = get_http_session().get(
             f"{API_BASE}/subscriptions-plans/",
             headers={"Authorization": f"Bearer {INTASEND_SECRET_KEY}"}
         )
@@ -715,6 +2686,138 @@ PLAN_MAP = {
     "B0X2DK5": "premium",  # IntaSend Premium plan
 }
 
+# Feature gates compare plans by tier
+PLAN_RANK = {"free": 0, "basic": 1, "premium": 2}
+
+
+# ----------------------
+# Subscription entitlements
+# ----------------------
+
+class EntitlementVersions:
+    """
+    Per-user change counters in a SQLite file shared by every worker on the host. Cached
+    entitlements remember the counter they were built at, so bumping it in one worker (a
+    webhook, a cancel) makes every local worker's copy stale without cross-process messaging.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = connect_sqlite(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS entitlement_versions (user_id TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, user_id):
+        """Current counter (0 if never bumped); None if the store is unreadable, meaning don't trust the cache"""
+        try:
+            row = self._conn().execute(
+                "SELECT version FROM entitlement_versions WHERE user_id = ?", (str(user_id),)
+            ).fetchone()
+            return row[0] if row else 0
+        except sqlite3.Error as e:
+            print(f"Entitlement store read error: {e}")
+            return None
+
+    def bump(self, user_id):
+        try:
+            with self._conn() as conn:
+                conn.execute(
+                    "INSERT INTO entitlement_versions (user_id, version) VALUES (?, 1) "
+                    "ON CONFLICT(user_id) DO UPDATE SET version = version + 1",
+                    (str(user_id),)
+                )
+        except sqlite3.Error as e:
+            print(f"Entitlement store write error: {e}")
+
+
+entitlement_versions = EntitlementVersions(ENTITLEMENT_STORE)
+_entitlement_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=ENTITLEMENT_CACHE_TTL, name='entitlement')
+
+
+def invalidate_entitlement(user_id):
+    """Call after anything that changes a user's subscriptions rows"""
+    _entitlement_cache.pop(user_id)
+    entitlement_versions.bump(user_id)
+
+
+def _expiry(subscription):
+    value = subscription.get('expires_at') or subscription.get('current_period_end')
+    return _parse_timestamp(value) if value else None
+
+
+def get_entitlement(user_id):
+    """
+    {plan, status, expires_at, active_subscription, latest_subscription} for a user,
+    served from memory until invalidated or expired; None if Supabase can't be reached.
+    """
+    version = entitlement_versions.get(user_id)  # read before fetching, so a concurrent bump wins
+    cached = _entitlement_cache.get(user_id)
+    if cached is not None and version is not None and cached['version'] == version:
+        return cached
+
+    # Active rows are asked for on their own, so a long pending/cancelled history can't hide one
+    results = fan_out({
+        'latest': lambda: supabase_request(
+            "GET", f"subscriptions?user_id=eq.{user_id}&order=created_at.desc&limit=1", use_service_key=True
+        ),
+        'active': lambda: supabase_request(
+            "GET", f"subscriptions?user_id=eq.{user_id}&status=eq.active&order=created_at.desc&limit=20",
+            use_service_key=True
+        ),
+    })
+    subs, actives = results['latest'], results['active']
+    if subs is None or actives is None:
+        return None
+
+    now = datetime.now(timezone.utc)
+    active = next((sub for sub in actives if _expiry(sub) is None or _expiry(sub) > now), None)
+    expires_at = _expiry(active) if active else None
+    entitlement = {
+        'version': version,
+        'plan': PLAN_MAP.get(active.get('plan'), active.get('plan')) if active else 'free',
+        'status': 'active' if active else 'inactive',
+        'expires_at': expires_at.isoformat() if expires_at else None,
+        'active_subscription': active,
+        'latest_subscription': subs[0] if subs else None,
+    }
+    if version is not None:
+        ttl = ENTITLEMENT_CACHE_TTL
+        if expires_at:
+            # Never serve an entitlement past the moment it lapses
+            ttl = max(0, min(ttl, (expires_at - now).total_seconds()))
+        _entitlement_cache.set(user_id, entitlement, ttl=ttl)
+    return entitlement
+
+
+def plan_required(minimum_plan):
+    """
+    Gate a route on the caller's plan (use below @token_required). Served from the
+    entitlement cache, so an allowed request normally makes no upstream call.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(current_user_id, *args, **kwargs):
+            entitlement = get_entitlement(current_user_id)
+            if entitlement is None:
+                return jsonify({'error': 'Could not verify subscription'}), 503
+            if PLAN_RANK.get(entitlement['plan'], 0) < PLAN_RANK[minimum_plan]:
+                return jsonify({
+                    'error': 'Upgrade required',
+                    'required_plan': minimum_plan,
+                    'current_plan': entitlement['plan']
+                }), 403
+            return f(current_user_id, *args, **kwargs)
+        return decorated
+    return decorator
+
 
 @app.route("/api/payments/create-subscription", methods=["POST"])
 @token_required
@@ -740,6 +2843,7 @@ def create_subscription(current_user_id):
                 },
                 use_service_key=True,
             )
+            invalidate_entitlement(current_user_id)
             return jsonify({
                 "status": "active",
                 "plan": "free",
@@ -752,41 +2856,20 @@ def create_subscription(current_user_id):
         profiles = supabase_request(
             "GET", f"profiles?id=eq.{current_user_id}", use_service_key=True
         )
-        if not profiles:
-            return jsonify({"error": "Profile not found"}), 404
-        profile = profiles[0]
-        customer_id = profile.get("intasend_customer_id")
-
-        if not customer_id:
-            fake_email = f"{current_user_id}@yourapp.local"
-            customer_resp = requests.post(
-                f"{API_BASE}/subscriptions-customers/",
-                headers={
-                    "Authorization": f"Bearer {INTASEND_SECRET_KEY.strip()}",
-                    "Content-Type": "application/json",
-                    "Accept": "application/json",
-                },
-                json={
-                    "email": fake_email,
-                    "first_name": "User",
-                    "last_name": str(current_user_id)[:8],
-                },
-                timeout=20,
-            )
-            customer_resp.raise_for_status()
-            customer_data = customer_resp.json()
-            customer_id = customer_data.get("customer_id")
+        if profiles:
+            profile = profiles[0]
+        else:
+            # The deferred register/login upsert hasn't landed yet
+            user_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+            profile = create_missing_profile(current_user_id, user_token)
+            if not profile:
+                return jsonify({"error": "Profile not found"}), 404
 
-            supabase_request(
-                "PATCH",
-                f"profiles?id=eq.{current_user_id}",
-                {"intasend_customer_id": customer_id},
-                use_service_key=True,
-            )
+        customer_id = profile.get("intasend_customer_id") or ensure_intasend_customer(current_user_id)
 
         # Create IntaSend subscription
         payload = {"customer_id": customer_id, "plan_id": plan_id}
-        resp = requests.post(
+        resp = get_http_session().post(
             f"{API_BASE}/subscriptions/",
             headers={
                 "Authorization": f"Bearer {INTASEND_SECRET_KEY.strip()}",
@@ -812,6 +2895,7 @@ def create_subscription(current_user_id):
             },
             use_service_key=True,
         )
+        invalidate_entitlement(current_user_id)
 
         return jsonify({
             "status": "pending",
@@ -826,49 +2910,315 @@ def create_subscription(current_user_id):
         return jsonify({"error": str(e)}), 500
 
 
+# ----------------------
+# IntaSend webhook journal
+# ----------------------
+
+class WebhookJournal:
+    """
+    Durable, deduplicating log of IntaSend subscription events (SQLite in WAL mode).
+    Events are keyed by IntaSend's event id (or a hash of the payload), so retried
+    deliveries are stored once. Consumers claim pending rows with a lease, so any
+    number of worker processes can drain the same file without double-applying;
+    every later update is conditional on still holding that lease.
+    """
+
+    LEASE_SECONDS = 60
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = connect_sqlite(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # The 200 we send IntaSend is a promise the event survives a crash
+            conn.execute("PRAGMA synchronous=FULL")
+            self._create_schema(conn)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @staticmethod
+    def _create_schema(conn):
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS webhook_events ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, event_key TEXT NOT NULL UNIQUE, "
+                "subscription_id TEXT NOT NULL, status TEXT NOT NULL, event_time TEXT, "
+                "received_at REAL NOT NULL, payload TEXT NOT NULL, "
+                "state TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_attempt_at REAL NOT NULL DEFAULT 0, claimed_until REAL NOT NULL DEFAULT 0, "
+                "claimed_by TEXT, last_error TEXT)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(webhook_events)")}
+            if 'claimed_by' not in columns:  # journals created before leases had owners
+                conn.execute("ALTER TABLE webhook_events ADD COLUMN claimed_by TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS webhook_events_pending ON webhook_events (state, next_attempt_at)")
+            # Newest status applied per subscription, so a late retry of an older event can't roll it back
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS webhook_applied ("
+                "subscription_id TEXT PRIMARY KEY, event_time TEXT, event_id INTEGER NOT NULL)"
+            )
+
+    @staticmethod
+    def event_key(event, data):
+        event_id = event.get('event_id') or event.get('id') or data.get('event_id')
+        if event_id:
+            return f"id:{event_id}"
+        return 'sha256:' + hashlib.sha256(json.dumps(event, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def event_time(event, data):
+        """IntaSend's timestamp as a sortable UTC string, or None when it sent none we can read"""
+        raw = data.get('updated_at') or data.get('created_at') or event.get('created_at')
+        stamp = _parse_timestamp(raw) if isinstance(raw, str) else None
+        return stamp.astimezone(timezone.utc).isoformat(timespec='microseconds') if stamp else None
+
+    def append(self, event, data, subscription_id, status):
+        """Store an event; False if it was already journaled (an IntaSend retry)"""
+        with self._conn() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO webhook_events "
+                "(event_key, subscription_id, status, event_time, received_at, payload) VALUES (?, ?, ?, ?, ?, ?)",
+                (self.event_key(event, data), str(subscription_id), status.lower(), self.event_time(event, data),
+                 time.time(), json.dumps(event))
+            )
+        return cursor.rowcount == 1
+
+    def claim(self, limit):
+        """Lease up to `limit` due events to a fresh owner token, oldest first"""
+        now = time.time()
+        owner = f"{os.getpid()}:{secrets.token_hex(6)}"
+        with self._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id, subscription_id, status, event_time, attempts FROM webhook_events "
+                "WHERE state = 'pending' AND next_attempt_at <= ? AND claimed_until <= ? ORDER BY id LIMIT ?",
+                (now, now, limit)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE webhook_events SET claimed_until = ?, claimed_by = ? WHERE id = ?",
+                [(now + self.LEASE_SECONDS, owner, row[0]) for row in rows]
+            )
+        return [
+            {**dict(zip(('id', 'subscription_id', 'status', 'event_time', 'attempts'), row)), 'claimed_by': owner}
+            for row in rows
+        ]
+
+    @staticmethod
+    def _update_held(conn, assignments, events, now):
+        """Apply `assignments` to the events whose lease this consumer still holds; returns those events"""
+        held = []
+        for event, params in events:
+            cursor = conn.execute(
+                f"UPDATE webhook_events SET {assignments}, claimed_until = 0, claimed_by = NULL "
+                "WHERE id = ? AND claimed_by = ? AND claimed_until > ?",
+                (*params, event['id'], event['claimed_by'], now)
+            )
+            if cursor.rowcount:
+                held.append(event)
+        return held
+
+    def last_applied(self, subscription_ids):
+        with self._conn() as conn:
+            rows = conn.execute(
+                f"SELECT subscription_id, event_time, event_id FROM webhook_applied "
+                f"WHERE subscription_id IN ({','.join('?' * len(subscription_ids))})",
+                list(subscription_ids)
+            ).fetchall()
+        return {row[0]: (row[1], row[2]) for row in rows}
+
+    def mark(self, events, state, error=None):
+        with self._conn() as conn:
+            self._update_held(conn, "state = ?, last_error = ?", [(e, (state, error)) for e in events], time.time())
+
+    def record_applied(self, events):
+        with self._conn() as conn:
+            held = self._update_held(
+                conn, "state = 'applied', last_error = NULL", [(e, ()) for e in events], time.time()
+            )
+            # A consumer whose lease lapsed mid-PATCH must not move the ordering guard
+            conn.executemany(
+                "INSERT OR REPLACE INTO webhook_applied (subscription_id, event_time, event_id) VALUES (?, ?, ?)",
+                [(e['subscription_id'], e['event_time'], e['id']) for e in held]
+            )
+
+    def retry_later(self, events, error):
+        """Back off exponentially; events out of attempts are parked as 'failed' for inspection"""
+        now = time.time()
+        updates = []
+        for e in events:
+            attempts = e['attempts'] + 1
+            state = 'failed' if attempts >= WEBHOOK_MAX_ATTEMPTS else 'pending'
+            delay = min(WEBHOOK_RETRY_BASE * 2 ** (attempts - 1), 600)
+            updates.append((e, (state, attempts, now + delay, error)))
+        with self._conn() as conn:
+            self._update_held(conn, "state = ?, attempts = ?, next_attempt_at = ?, last_error = ?", updates, now)
+
+    def prune(self, older_than_days):
+        # Finished rows double as the dedupe window for IntaSend retries, so keep them a while
+        with self._conn() as conn:
+            conn.execute(
+                "DELETE FROM webhook_events WHERE state IN ('applied', 'superseded') AND received_at < ?",
+                (time.time() - older_than_days * 86400,)
+            )
+
+    def stats(self):
+        with self._conn() as conn:
+            counts = dict(conn.execute("SELECT state, COUNT(*) FROM webhook_events GROUP BY state").fetchall())
+            oldest = conn.execute(
+                "SELECT MIN(received_at) FROM webhook_events WHERE state = 'pending'"
+            ).fetchone()[0]
+        return {
+            'pending': counts.get('pending', 0),
+            'applied': counts.get('applied', 0),
+            'superseded': counts.get('superseded', 0),
+            'failed': counts.get('failed', 0),
+            'oldest_pending_age': round(time.time() - oldest, 1) if oldest else None
+        }
+
+
+webhook_journal = WebhookJournal(WEBHOOK_JOURNAL)
+_webhook_consumer_pid = None
+_webhook_consumer_lock = threading.Lock()
+_webhook_wakeup = threading.Event()
+
+
+def _is_newer(event_time, event_id, than_time, than_id):
+    """
+    Whether an event comes after another: by IntaSend's timestamps when both have one,
+    else by arrival order in the journal, so a delivery without a timestamp is never
+    ranked behind everything that had one.
+    """
+    if event_time and than_time:
+        return (event_time, event_id) > (than_time, than_id)
+    return event_id > than_id
+
+
+def apply_webhook_events(events):
+    """
+    Apply one claimed batch: keep only the newest status per subscription, skip events
+    older than what is already applied, then PATCH every subscription that ends up in
+    the same status with a single request.
+    """
+    latest = {}
+    for event in sorted(events, key=lambda e: e['id']):
+        current = latest.get(event['subscription_id'])
+        if current is None or _is_newer(event['event_time'], event['id'], current['event_time'], current['id']):
+            latest[event['subscription_id']] = event
+    winners = set(e['id'] for e in latest.values())
+    webhook_journal.mark([e for e in events if e['id'] not in winners], 'superseded')
+
+    applied = webhook_journal.last_applied(list(latest))
+    stale = [e for sub_id, e in latest.items()
+             if sub_id in applied and not _is_newer(e['event_time'], e['id'], *applied[sub_id])]
+    webhook_journal.mark(stale, 'superseded')
+    stale_ids = {e['id'] for e in stale}
+
+    by_status = {}
+    for event in latest.values():
+        if event['id'] not in stale_ids:
+            by_status.setdefault(event['status'], []).append(event)
+
+    for status, group in by_status.items():
+        ids = ','.join('"' + e['subscription_id'].replace('"', '') + '"' for e in group)
+        result = supabase_request(
+            "PATCH",
+            f"subscriptions?intasend_subscription_id=in.({ids})",
+            {"status": status, "updated_at": datetime.now(timezone.utc).isoformat()},
+            use_service_key=True,
+        )
+        if result is None:
+            webhook_journal.retry_later(group, 'Supabase PATCH failed')
+        else:
+            webhook_journal.record_applied(group)
+            for user_id in {row.get('user_id') for row in result if row.get('user_id')}:
+                invalidate_entitlement(user_id)
+
+
+def _webhook_consumer():
+    pruned_at = time.monotonic()
+    while True:
+        _webhook_wakeup.wait(WEBHOOK_POLL_INTERVAL)
+        _webhook_wakeup.clear()
+        try:
+            events = webhook_journal.claim(WEBHOOK_BATCH_SIZE)
+            while events:
+                apply_webhook_events(events)
+                events = webhook_journal.claim(WEBHOOK_BATCH_SIZE) if len(events) == WEBHOOK_BATCH_SIZE else []
+            if time.monotonic() - pruned_at > 3600:
+                webhook_journal.prune(WEBHOOK_RETENTION_DAYS)
+                pruned_at = time.monotonic()
+        except Exception as e:
+            print(f"Webhook consumer error: {e}")
+
+
+def ensure_webhook_consumer():
+    """Start this worker's journal consumer (once per process); every worker drains the same file"""
+    global _webhook_consumer_pid
+    if _webhook_consumer_pid == os.getpid() or not SUPABASE_URL:
+        return
+    with _webhook_consumer_lock:
+        if _webhook_consumer_pid != os.getpid():
+            threading.Thread(target=_webhook_consumer, name='webhook-consumer', daemon=True).start()
+            _webhook_consumer_pid = os.getpid()
+
+
+@app.before_request
+def _start_webhook_consumer():
+    # Also drains events journaled before a restart, not just ones arriving now
+    ensure_webhook_consumer()
+
+
 @app.route("/api/payments/webhook", methods=["POST"])
 def intasend_webhook():
-    try:
-        event = request.get_json() or {}
-        print("DEBUG Webhook received:", event)
+    """Acknowledge once the event is durably journaled; the consumer applies it to subscriptions"""
+    if not INTASEND_WEBHOOK_CHALLENGE:
+        print("Webhook refused: INTASEND_WEBHOOK_CHALLENGE is not configured")
+        return jsonify({"error": "Webhook verification not configured"}), 503
+    if request.content_length is None or request.content_length > WEBHOOK_MAX_BYTES:
+        return jsonify({"error": "Payload too large or missing Content-Length"}), 413
+
+    event = request.get_json(silent=True)
+    if not isinstance(event, dict) or not isinstance(event.get("challenge"), str) or not hmac.compare_digest(
+            event["challenge"].encode(), INTASEND_WEBHOOK_CHALLENGE.encode()):
+        return jsonify({"error": "Invalid webhook challenge"}), 401
+    # The shared secret has done its job; keep it out of the journal
+    event = {k: v for k, v in event.items() if k != "challenge"}
+
+    data = event.get("data") if isinstance(event.get("data"), dict) else event
+    sub_id = data.get("subscription_id")
+    status = data.get("status")
+
+    if not (isinstance(sub_id, (str, int)) and sub_id and isinstance(status, str) and status):
+        # Nothing we act on; acknowledge so IntaSend doesn't keep retrying it
+        return jsonify({"ok": True, "ignored": True}), 200
 
-        data = event.get("data") if "data" in event else event
-        sub_id = data.get("subscription_id")
-        status = data.get("status")
-
-        if sub_id and status:
-            supabase_request(
-                "PATCH",
-                f"subscriptions?intasend_subscription_id=eq.{sub_id}",
-                {
-                    "status": status.lower(),
-                    "updated_at": datetime.now(timezone.utc).isoformat(),
-                },
-                use_service_key=True,
-            )
+    try:
+        stored = webhook_journal.append(event, data, sub_id, status)
+    except sqlite3.Error as e:
+        print(f"Webhook journal write failed: {e}")
+        # Not stored, so let IntaSend retry the delivery
+        return jsonify({"error": "Temporarily unavailable"}), 503
 
-        return jsonify({"ok": True}), 200
-    except Exception as e:
-        traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
+    _webhook_wakeup.set()
+    return jsonify({"ok": True, "duplicate": not stored}), 200
 
 
 @app.route("/api/payments/my-subscription", methods=["GET"])
 @token_required
 def get_my_subscription(current_user_id):
-    subs = supabase_request(
-        "GET",
-        f"subscriptions?user_id=eq.{current_user_id}&order=created_at.desc&limit=1",
-        use_service_key=True,
-    )
-    if not subs:
-        return jsonify({"status": "free"}), 200
+    entitlement = get_entitlement(current_user_id)
+    sub = entitlement and entitlement['latest_subscription']
+    if not sub:
+        return conditional_rows_json({"status": "free"})
 
-    sub = subs[0]
-    return jsonify({
+    return conditional_rows_json({
         **sub,
         "plan": PLAN_MAP.get(sub.get("plan"), sub.get("plan"))
-    }), 200
+    }, sub)
 
 
 @app.route("/api/payments/cancel-subscription", methods=["POST"])
@@ -897,9 +3247,10 @@ def cancel_subscription(current_user_id):
                 params={"and": f"(user_id.eq.{current_user_id},status.eq.active)"},
                 use_service_key=True,
             )
+            invalidate_entitlement(current_user_id)
             return jsonify({"message": "Free subscription cancelled"}), 200
 
-        resp = requests.post(
+        resp = get_http_session().post(
             f"{API_BASE}/subscriptions/{intasend_id}/cancel/",
             headers={
                 "Authorization": f"Bearer {INTASEND_SECRET_KEY.strip()}",
@@ -922,6 +3273,7 @@ def cancel_subscription(current_user_id):
             use_service_key=True,
         )
 
+        invalidate_entitlement(current_user_id)
         return jsonify({"message": "Subscription cancelled successfully"}), 200
 
     except Exception as e:
@@ -933,15 +3285,11 @@ def cancel_subscription(current_user_id):
 @token_required
 def subscription_status(current_user_id):
     try:
-        subs = supabase_request(
-            "GET",
-            f"subscriptions?user_id=eq.{current_user_id}&status=eq.active",
-            use_service_key=True,
-        )
-        if not subs:
+        entitlement = get_entitlement(current_user_id)
+        if not entitlement or not entitlement["active_subscription"]:
             return jsonify({"status": "inactive"}), 200
 
-        subscription = subs[0]
+        subscription = entitlement["active_subscription"]
         plan_id = subscription.get("plan", "free")
         return jsonify({
             "status": "active",
@@ -958,16 +3306,253 @@ def subscription_status(current_user_id):
         return jsonify({"status": "inactive", "error": str(e)}), 200
 
 
+# ----------------------
+# Conditional GET
+# ----------------------
+
+def conditional_json(payload, etag, last_modified=None, status=200, body=None):
+    """
+    JSON response carrying a strong ETag (and Last-Modified when known), or an empty
+    304 when the client's If-None-Match / If-Modified-Since shows it already has it.
+    `body` is the payload already serialised, when the caller had to for the ETag.
+    """
+    if request.if_none_match:
+        # Compressed responses carry an encoding-suffixed ETag (see compress_response)
+        not_modified = any(request.if_none_match.contains(tag) for tag in _etag_variants(etag))
+    elif last_modified is not None and request.if_modified_since is not None:
+        # HTTP dates have one-second resolution
+        not_modified = last_modified.replace(microsecond=0) <= request.if_modified_since
+    else:
+        not_modified = False
+
+    if not_modified:
+        response = Response(status=304)
+    elif body is not None:
+        response = app.response_class(f"{body}\n", status=status, mimetype=app.json.mimetype)
+    else:
+        response = jsonify(payload)
+        response.status_code = status
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def _parse_timestamp(value):
+    try:
+        stamp = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return stamp if stamp.tzinfo else stamp.replace(tzinfo=timezone.utc)
+
+
+def _row_versions(value, versioned):
+    """
+    `value` with every row that has an updated_at reduced to its id, updated_at and
+    embeds: what the ETag needs to see, without the rows' text. Rows without one
+    (an embedded author's name, pagination) are kept whole. Sets versioned[0] if any
+    row was reduced.
+    """
+    if isinstance(value, list):
+        return [_row_versions(item, versioned) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if value.get('updated_at'):
+        versioned[0] = True
+        return [value.get('id'), value['updated_at'], {
+            key: _row_versions(item, versioned) for key, item in value.items() if isinstance(item, (dict, list))
+        }]
+    return {key: _row_versions(item, versioned) for key, item in value.items()}
+
+
+def conditional_rows_json(payload, row=None, status=200):
+    """
+    conditional_json whose ETag is derived from the versions of the rows in the
+    payload: each row's id and updated_at, every embed, and the shape of every list,
+    so a renamed author or a row dropping out of a list still changes the tag. A
+    304 is decided before the body is serialised. Only a payload with no versioned
+    rows has its full JSON hashed (and that serialisation reused as the body).
+    Last-Modified is sent only for a single resource (`row`) with its own
+    updated_at and nothing embedded: a list's newest updated_at does not move when
+    a row is deleted, and an embed's changes do not touch the parent's timestamp.
+    """
+    versioned = [False]
+    fingerprint = json.dumps(_row_versions(payload, versioned), sort_keys=True, default=str)
+    body = None
+    if not versioned[0]:
+        body = fingerprint = app.json.dumps(payload)
+    etag = hashlib.sha256(fingerprint.encode()).hexdigest()[:32]
+    last_modified = None
+    if row is not None and not any(isinstance(value, (dict, list)) for value in row.values()):
+        last_modified = _parse_timestamp(row['updated_at']) if row.get('updated_at') else None
+    return conditional_json(payload, etag, last_modified, status, body=body)
+
+
+# ----------------------
+# Response compression
+# ----------------------
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/')
+
+# (sha256 of the uncompressed body, encoding) -> compressed body, for responses with a validator
+_compressed_cache = TTLCache(maxsize=COMPRESS_CACHE_SIZE, ttl=3600, name='compressed_response')
+
+
+def _etag_variants(etag):
+    return (etag, f"{etag}-gzip", f"{etag}-br")
+
+
+def _negotiate_encoding():
+    """Preferred content coding the client accepts: br (if available), then gzip, else None"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted.quality('br') > 0:
+        return 'br'
+    if accepted.quality('gzip') > 0:
+        return 'gzip'
+    return None
+
+
+def _compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=COMPRESS_GZIP_LEVEL, mtime=0)
+
+
+def _compress_stream(chunks, encoding):
+    """Compress a streamed body chunk by chunk, flushing each so events (SSE) are not held back"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+        process, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = process(chunk) + flush()
+        if data:
+            yield data
+    yield finish()
+
+
+@app.after_request
+def compress_response(response):
+    """gzip/brotli per Accept-Encoding for JSON/text bodies over COMPRESS_MIN_SIZE, and for streams"""
+    if response.status_code == 304:
+        # Echo back the encoding-suffixed validator the client revalidated with
+        etag, _ = response.get_etag()
+        encoding = _negotiate_encoding()
+        if etag and encoding and request.if_none_match.contains(f"{etag}-{encoding}"):
+            response.set_etag(f"{etag}-{encoding}")
+        return response
+
+    if (request.method == 'HEAD' or response.status_code in (204, 206) or response.status_code < 200
+            or 'Content-Encoding' in response.headers
+            or not response.mimetype.startswith(COMPRESSIBLE_MIMETYPES)):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = _negotiate_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+        response.headers['Content-Encoding'] = encoding
+        return response
+    if response.direct_passthrough:
+        return response
+
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+
+    etag, _ = response.get_etag()
+    # Keyed on the bytes themselves, so a validator that fails to change can't serve stale output
+    key = (hashlib.sha256(body).digest(), encoding) if etag else None
+    compressed = _compressed_cache.get(key) if key else None
+    if compressed is None:
+        compressed = _compress(body, encoding)
+        if key:
+            _compressed_cache.set(key, compressed)
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        # A strong ETag must differ between encodings of the same resource
+        response.set_etag(f"{etag}-{encoding}")
+    return response
+
+
+# ----------------------
+# Module catalog cache
+# ----------------------
+
+_module_catalog = {'version': None, 'modules': [], 'checked_at': 0.0}
+_module_catalog_lock = threading.Lock()
+
+
+def _module_catalog_version():
+    """Cheap change marker for the published catalog: newest updated_at plus row count"""
+    rows, total = supabase_get_with_total(
+        'modules?select=updated_at&is_published=eq.true&order=updated_at.desc.nullslast&limit=1'
+    )
+    if rows is None:
+        return None
+    return f"{rows[0].get('updated_at') if rows else ''}|{total}"
+
+
+def get_module_catalog():
+    """
+    Published modules (list-view columns only), shared by all users of this worker.
+    Within MODULE_CATALOG_TTL nothing goes upstream; after that a one-row probe
+    decides whether the catalog must be refetched.
+    """
+    global _module_catalog
+    catalog = _module_catalog
+    if catalog['version'] is not None and time.monotonic() - catalog['checked_at'] < MODULE_CATALOG_TTL:
+        return catalog
+
+    with _module_catalog_lock:
+        catalog = _module_catalog
+        if catalog['version'] is not None and time.monotonic() - catalog['checked_at'] < MODULE_CATALOG_TTL:
+            return catalog
+
+        version = _module_catalog_version()
+        if version is not None and version == catalog['version']:
+            _module_catalog = {**catalog, 'checked_at': time.monotonic()}
+            return _module_catalog
+
+        modules = supabase_request(
+            'GET', 'modules?select=id,title,slug,difficulty,estimated_time&is_published=eq.true'
+        )
+        if modules is None or version is None:
+            # Supabase trouble: keep serving the last good catalog, retry on the next request
+            return catalog if catalog['version'] is not None else {**catalog, 'modules': modules or []}
+
+        _module_catalog = {'version': version, 'modules': modules, 'checked_at': time.monotonic()}
+        return _module_catalog
+
+
 # Training modules list
 @app.route('/api/training/modules', methods=['GET'])
 @token_required
 def get_training_modules(current_user_id):
-    modules = supabase_request('GET', 'modules?is_published=eq.true') or []
-    progress = supabase_request('GET', f'user_progress?user_id=eq.{current_user_id}') or []
-    completed_ids = [p['module_id'] for p in progress]
+    results = fan_out({
+        'catalog': get_module_catalog,
+        'progress': lambda: supabase_request('GET', f'user_progress?user_id=eq.{current_user_id}')
+    })
+    catalog = results['catalog']
+    if catalog is None:
+        return jsonify({'error': 'Failed to load training modules'}), 502
+    progress = results['progress'] or []
+    completed_ids = {p['module_id'] for p in progress}
 
     data = []
-    for m in modules:
+    for m in catalog['modules']:
         data.append({
             'id': m['id'],
             'title': m['title'],
@@ -976,7 +3561,18 @@ def get_training_modules(current_user_id):
             'estimated_time': m.get('estimated_time'),
             'completed': m['id'] in completed_ids
         })
-    return jsonify({'modules': data}), 200
+
+    if catalog['version'] is None:
+        # Fetched while the version probe was failing: nothing to revalidate against later
+        response = jsonify({'modules': data})
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    # The body is fully determined by the catalog version and the user's completed set
+    etag = hashlib.sha256(
+        f"{catalog['version']}|{sorted(completed_ids, key=str)}".encode()
+    ).hexdigest()[:32]
+    return conditional_json({'modules': data}, etag)
 
 
 # Training module details
@@ -993,7 +3589,7 @@ def get_training_module(current_user_id, identifier):
         return jsonify({'error': 'Module not found'}), 404
 
     module = modules[0]
-    return jsonify({
+    return conditional_rows_json({
         'id': module['id'],
         'title': module['title'],
         'description': module.get('description'),
@@ -1003,7 +3599,7 @@ def get_training_module(current_user_id, identifier):
         'estimated_time': module.get('estimated_time'),
         'created_at': module.get('created_at'),
         'updated_at': module.get('updated_at')
-    }), 200
+    }, module)
 
 
 
@@ -1013,7 +3609,68 @@ def get_training_module(current_user_id, identifier):
 @token_required
 def get_progress(current_user_id):
     progress = supabase_request('GET', f'user_progress?user_id=eq.{current_user_id}') or []
-    return jsonify({'progress': progress}), 200
+    return conditional_rows_json({'progress': progress})
+
+
+def _progress_row(user_id, module_id, progress, updated_at):
+    # Map progress → score. Partial progress leaves completed/completed_at out of the
+    # row, so merging it into an existing row can't undo an earlier completion.
+    row = {
+        "user_id": user_id,
+        "module_id": module_id,
+        "score": progress,  # use score column instead of progress
+        "updated_at": updated_at
+    }
+    if progress >= 100:  # auto-complete if full progress
+        row.update(completed=True, completed_at=updated_at)
+    return row
+
+
+def upsert_progress(user_id, rows):
+    """
+    Bulk upsert user_progress rows; returns the written rows, or None. user_progress
+    references profiles, which register/login only queue, so a failed write is retried
+    once after creating a missing profile inline.
+    """
+    result = supabase_upsert('user_progress', rows, on_conflict='user_id,module_id')
+    if result is not None:
+        return result
+    user_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    try:
+        if create_missing_profile(user_id, user_token) is None:
+            return None
+    except RuntimeError as e:
+        print(f"Profile creation failed: {e}")
+        return None
+    return supabase_upsert('user_progress', rows, on_conflict='user_id,module_id')
+
+
+def _module_id(value):
+    """Integer module id from JSON (int or digit string); ValueError otherwise"""
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError('moduleId must be an integer')
+    try:
+        return int(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError('moduleId must be an integer')
+
+
+def _parse_client_timestamp(value, now):
+    """ISO-8601 string or epoch milliseconds; clamped to now so a fast device clock can't win forever"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        try:
+            stamp = datetime.fromtimestamp(value / 1000, tz=timezone.utc)
+        except (OverflowError, OSError, ValueError):  # out of range, inf or NaN
+            raise ValueError('Invalid clientTimestamp')
+    elif isinstance(value, str):
+        stamp = _parse_timestamp(value)
+        if stamp is None:
+            raise ValueError('Invalid clientTimestamp')
+    elif value is None:
+        return now
+    else:
+        raise ValueError('Invalid clientTimestamp')
+    return min(stamp, now)
 
 
 @app.route('/api/training/progress', methods=['POST'])
@@ -1025,26 +3682,15 @@ def update_progress(current_user_id):
 
     if not module_id:
         return jsonify({'error': 'Module ID required'}), 400
-
-    # Map progress → score
-    progress_data = {
-        "user_id": current_user_id,
-        "module_id": module_id,
-        "score": progress,  # use score column instead of progress
-        "completed": progress >= 100,  # auto-complete if full progress
-        "updated_at": datetime.now(timezone.utc).isoformat()
-    }
-
-    # Optional: add completed_at only when fully done
-    if progress >= 100:
-        progress_data["completed_at"] = datetime.now(timezone.utc).isoformat()
-
-    # Upsert ensures (user_id, module_id) is unique
-    result = supabase_request(
-        "POST",
-        "user_progress",
-        progress_data,
-        use_service_key=True
+    try:
+        module_id = _module_id(module_id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Upsert on (user_id, module_id) so repeated saves update one row
+    result = upsert_progress(
+        current_user_id,
+        [_progress_row(current_user_id, module_id, progress, datetime.now(timezone.utc).isoformat())]
     )
 
     if not result:
@@ -1052,71 +3698,132 @@ def update_progress(current_user_id):
 
     return jsonify({"progress": result[0]}), 200
 
+
+@app.route('/api/training/progress/batch', methods=['POST'])
+@token_required
+def update_progress_batch(current_user_id):
+    """
+    Sync many {moduleId, progress, clientTimestamp} entries at once (e.g. after a day offline).
+    Last writer wins by clientTimestamp, both within the batch and against what is stored;
+    winners are written with one bulk upsert per row shape (completions, partial progress).
+    Returns a result per entry.
+    """
+    data = request.get_json() or {}
+    entries = data.get('entries')
+    if not isinstance(entries, list) or not entries:
+        return jsonify({'error': 'entries must be a non-empty list'}), 400
+    if len(entries) > PROGRESS_BATCH_MAX:
+        return jsonify({'error': f'At most {PROGRESS_BATCH_MAX} entries per batch'}), 400
+
+    # Ids end up in an in.() filter sent with the service key, so only integers get that far;
+    # coercing also makes "1" and 1 the same module rather than two clashing upsert rows
+    module_ids = []
+    for entry in entries:
+        raw = entry.get('moduleId') if isinstance(entry, dict) else None
+        try:
+            module_ids.append(_module_id(raw) if raw is not None else None)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+    now = datetime.now(timezone.utc)
+    results = [None] * len(entries)
+    latest = {}  # module_id -> (timestamp, entry index, progress)
+
+    for i, (entry, module_id) in enumerate(zip(entries, module_ids)):
+        progress = entry.get('progress', 0) if isinstance(entry, dict) else None
+        if module_id is None or not isinstance(progress, (int, float)) or isinstance(progress, bool):
+            results[i] = {'moduleId': module_id, 'status': 'invalid', 'error': 'moduleId and numeric progress required'}
+            continue
+        try:
+            stamp = _parse_client_timestamp(entry.get('clientTimestamp'), now)
+        except ValueError as e:
+            results[i] = {'moduleId': module_id, 'status': 'invalid', 'error': str(e)}
+            continue
+
+        previous = latest.get(module_id)
+        if previous is None or stamp >= previous[0]:
+            if previous is not None:
+                results[previous[1]] = {'moduleId': module_id, 'status': 'superseded'}
+            latest[module_id] = (stamp, i, progress)
+        else:
+            results[i] = {'moduleId': module_id, 'status': 'superseded'}
+
+    # Drop entries older than what the server already has
+    if latest:
+        module_list = ','.join(str(m) for m in latest)
+        stored = supabase_request(
+            'GET', f'user_progress?select=module_id,updated_at&user_id=eq.{current_user_id}&module_id=in.({module_list})',
+            use_service_key=True
+        ) or []
+        for row in stored:
+            key = int(row['module_id'])
+            stored_at = _parse_timestamp(row.get('updated_at')) if row.get('updated_at') else None
+            if key in latest and stored_at and stored_at > latest[key][0]:
+                results[latest.pop(key)[1]] = {'moduleId': key, 'status': 'stale'}
+
+    # PostgREST needs the same keys in every row of a bulk upsert, so completions
+    # and partial progress (which leaves completion alone) go up as separate statements
+    shapes = {}
+    for module_id, (stamp, _, progress) in latest.items():
+        row = _progress_row(current_user_id, module_id, progress, stamp.isoformat())
+        shapes.setdefault(tuple(row), []).append(row)
+    for rows in shapes.values():
+        written = upsert_progress(current_user_id, rows)
+        by_module = {int(row['module_id']): row for row in written or []}
+        for row in rows:
+            i = latest[row['module_id']][1]
+            if written is None:
+                results[i] = {'moduleId': row['module_id'], 'status': 'error', 'error': 'Failed to update progress'}
+            else:
+                results[i] = {'moduleId': row['module_id'], 'status': 'applied', 'progress': by_module.get(row['module_id'])}
+
+    return jsonify({
+        'results': results,
+        'applied': sum(1 for r in results if r['status'] == 'applied')
+    }), 200
+
 # Mark training module complete
 
 @app.route('/api/training/modules/<int:module_id>/complete', methods=['POST'])
 @token_required
 def mark_module_complete(current_user_id, module_id):
     """Mark a training module as complete for the current user (idempotent logic)"""
-
-    # Ensure profile exists
-    user_check = supabase_request(
-        "GET",
-        "profiles",
-        {"id": current_user_id},
-        use_service_key=True
+    # One atomic upsert on (user_id, module_id)
+    result = upsert_progress(
+        current_user_id,
+        [_progress_row(current_user_id, module_id, 100, datetime.now(timezone.utc).isoformat())]
     )
-    if not user_check:
-        profile_data = {
-            "id": current_user_id,
-            "name": f"User {current_user_id[:8]}",
-            "location": "Unknown",
-            "role": "health_worker",
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        }
-        supabase_request("POST", "profiles", profile_data, use_service_key=True)
 
-    # Completion payload
-    completion_data = {
-        "score": 100,
-        "completed": True,
-        "completed_at": datetime.now(timezone.utc).isoformat(),
-        "updated_at": datetime.now(timezone.utc).isoformat()
-    }
+    if not result:
+        return jsonify({"error": "Failed to mark module as complete"}), 500
 
-    # 1. Try update first (⚡ use and= filter)
-    updated = supabase_request(
-        "PATCH",
-        "user_progress",
-        completion_data,
-        params={
-            "and": f"(user_id.eq.{current_user_id},module_id.eq.{module_id})"
-        },
-        use_service_key=True
-    )
+    return jsonify({"success": True, "progress": result[0]}), 200
 
-    if updated and len(updated) > 0:
-        return jsonify({"success": True, "progress": updated[0]}), 200
 
-    # 2. If no row updated → insert new
-    inserted = supabase_request(
-        "POST",
-        "user_progress",
-        {
-            "user_id": current_user_id,
-            "module_id": module_id,
-            **completion_data
-        },
-        use_service_key=True
-    )
 
-    if not inserted:
-        return jsonify({"error": "Failed to mark module as complete"}), 500
 
-    return jsonify({"success": True, "progress": inserted[0]}), 200
+def _sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
 
+def _stream_chat_response(message, current_user_id):
+    """Server-Sent Events response: one `data` event per text delta, then a `done` event"""
+    def generate():
+        provider = 'fallback'
+        for provider, text in ai_stream_with_fallback(message):
+            yield _sse_event({'delta': text})
+        yield _sse_event({
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'user_id': current_user_id,
+            'model_used': provider
+        }, event='done')
 
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 
 # AI Chat
@@ -1129,6 +3836,10 @@ def ai_chat(current_user_id):
     if not message:
         return jsonify({'error': 'Message required'}), 400
 
+    # Opt-in streaming for clients that ask for SSE
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        return _stream_chat_response(message, current_user_id)
+
     # Get AI response using enhanced multi-provider system
     ai_response = ai_request_with_fallback(message)
     
@@ -1147,6 +3858,19 @@ def ai_chat(current_user_id):
     }), 200
 
 
+# AI Chat (streaming)
+@app.route('/api/ai/chat/stream', methods=['POST'])
+@token_required
+def ai_chat_stream(current_user_id):
+    data = request.get_json() or {}
+    message = data.get('message', '')
+
+    if not message:
+        return jsonify({'error': 'Message required'}), 400
+
+    return _stream_chat_response(message, current_user_id)
+
+
 # Test AI Chat (no auth required for testing)
 @app.route('/api/ai/test', methods=['POST'])
 def test_ai_chat():
@@ -1279,30 +4003,100 @@ Please provide:
 
 # ==================== COMMUNITY FEATURES ====================
 
+# ----------------------
+# Keyset pagination
+# ----------------------
+
+PAGINATION_COUNT_MODES = ('exact', 'estimated', 'planned')
+
+
+def encode_cursor(row, direction):
+    """Opaque cursor pointing just past `row` on the (created_at, id) ordering"""
+    raw = json.dumps({'c': row['created_at'], 'i': row['id'], 'd': direction}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Returns (created_at, id, direction); raises ValueError for anything malformed"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        created_at, row_id, direction = str(data['c']), int(data['i']), data['d']
+    except (TypeError, KeyError, ValueError) as e:
+        raise ValueError('Invalid cursor') from e
+    if direction not in ('next', 'prev') or '"' in created_at:
+        raise ValueError('Invalid cursor')
+    return created_at, row_id, direction
+
+
+def keyset_page(table, select, filters='', limit=20, cursor=None, page=1, count='exact'):
+    """
+    One page of `table` newest-first on (created_at, id).
+    With a cursor the page is fetched by keyset (cost independent of depth) and the
+    total comes from a concurrent count; without one, classic page/offset paging is
+    used. Returns (rows, pagination).
+    """
+    filter_qs = f"&{filters}" if filters else ""
+    base = f"{table}?select={select}{filter_qs}"
+    pagination = {'limit': limit}
+
+    if cursor:
+        created_at, row_id, direction = decode_cursor(cursor)
+        op, order = ('lt', 'desc') if direction == 'next' else ('gt', 'asc')
+        params = {'or': f'(created_at.{op}."{created_at}",and(created_at.eq."{created_at}",id.{op}.{row_id}))'}
+        total_future = get_io_executor().submit(
+            in_current_context(supabase_count, f"{table}?select=id{filter_qs}", count=count))
+
+        rows = supabase_request('GET', f"{base}&order=created_at.{order},id.{order}&limit={limit + 1}", params=params) or []
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if direction == 'prev':
+            rows.reverse()
+        has_next, has_prev = (more, True) if direction == 'next' else (True, more)
+        total = total_future.result()
+    else:
+        offset = (page - 1) * limit
+        rows, total = supabase_get_with_total(
+            f"{base}&order=created_at.desc,id.desc&limit={limit + 1}&offset={offset}", count=count
+        )
+        rows = rows or []
+        has_next, has_prev = len(rows) > limit, offset > 0
+        rows = rows[:limit]
+        pagination['page'] = page
+
+    pagination.update({
+        'total': total,
+        'has_more': has_next,
+        'next_cursor': encode_cursor(rows[-1], 'next') if rows and has_next else None,
+        'prev_cursor': encode_cursor(rows[0], 'prev') if rows and has_prev else None
+    })
+    return rows, pagination
+
+
+def _pagination_args(default_limit, max_limit):
+    page = int(request.args.get('page', 1))
+    limit = min(int(request.args.get('limit', default_limit)), max_limit)
+    count = request.args.get('count', 'exact')
+    if count not in PAGINATION_COUNT_MODES:
+        count = 'exact'
+    return {'page': page, 'limit': limit, 'cursor': request.args.get('cursor'), 'count': count}
+
+
 # Get all forum posts
 @app.route('/api/community/posts', methods=['GET'])
 @token_required
 def get_forum_posts(current_user_id):
-    """Get paginated forum posts with author details"""
-    page = int(request.args.get('page', 1))
-    limit = min(int(request.args.get('limit', 20)), 50)  # Max 50 posts per page
-    offset = (page - 1) * limit
+    """Get paginated forum posts with author details (?cursor= for keyset paging, ?page= still works)"""
+    paging = _pagination_args(default_limit=20, max_limit=50)  # Max 50 posts per page
 
-    # Get posts with author information
-    posts = supabase_request('GET', 
-        f'forum_posts?select=*,profiles(name,location)&order=created_at.desc&limit={limit}&offset={offset}') or []
-    
-    # Get total count for pagination (simplified - just return what we have)
-    total_count = len(posts) + offset  # Rough estimate
+    try:
+        # Get posts with author information
+        posts, pagination = keyset_page('forum_posts', '*,profiles(name,location)', **paging)
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
 
     return jsonify({
         'posts': posts,
-        'pagination': {
-            'page': page,
-            'limit': limit,
-            'total': total_count,
-            'has_more': len(posts) == limit  # If we got full page, assume there might be more
-        }
+        'pagination': pagination
     }), 200
 
 
@@ -1342,6 +4136,10 @@ def create_forum_post(current_user_id):
     if not result:
         return jsonify({"error": "Failed to create post"}), 500
 
+    # Make the post searchable right away (author details arrive with the next reconcile)
+    if forum_search_index is not None:
+        forum_search_index.add(result[0])
+
     return jsonify({"post": result[0] if result else {}, "message": "Post created successfully"}), 201
 
 
@@ -1350,21 +4148,24 @@ def create_forum_post(current_user_id):
 @token_required
 def get_forum_post(current_user_id, post_id):
     """Get single post with comments"""
-    # Get the post with author info
-    post = supabase_request('GET', 
-        f'forum_posts?select=*,profiles(name,location)&id=eq.{post_id}')
-    
+    # Post with author info and its comments, fetched concurrently
+    results = fan_out({
+        'post': lambda: supabase_request('GET',
+            f'forum_posts?select=*,profiles(name,location)&id=eq.{post_id}'),
+        'comments': lambda: supabase_request('GET',
+            f'forum_comments?select=*,profiles(name,location)&post_id=eq.{post_id}&order=created_at.asc')
+    })
+    post = results['post']
+
     if not post:
         return jsonify({'error': 'Post not found'}), 404
 
-    # Get comments for this post
-    comments = supabase_request('GET', 
-        f'forum_comments?select=*,profiles(name,location)&post_id=eq.{post_id}&order=created_at.asc') or []
+    comments = results['comments'] or []
 
-    return jsonify({
+    return conditional_rows_json({
         'post': post[0],
         'comments': comments
-    }), 200
+    })
 
 
 # Add comment to forum post
@@ -1406,15 +4207,15 @@ def add_comment(current_user_id, post_id):
 @app.route('/api/community/success-stories', methods=['GET'])
 @token_required
 def get_success_stories(current_user_id):
-    """Get paginated success stories"""
-    page = int(request.args.get('page', 1))
-    limit = min(int(request.args.get('limit', 10)), 20)  # Max 20 stories per page
-    offset = (page - 1) * limit
+    """Get paginated success stories (?cursor= for keyset paging, ?page= still works)"""
+    paging = _pagination_args(default_limit=10, max_limit=20)  # Max 20 stories per page
 
-    stories = supabase_request('GET', 
-        f'success_stories?select=*,profiles(name,location)&is_approved=eq.true&order=created_at.desc&limit={limit}&offset={offset}') or []
+    try:
+        stories, pagination = keyset_page('success_stories', '*,profiles(name,location)', 'is_approved=eq.true', **paging)
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
 
-    return jsonify({'stories': stories}), 200
+    return conditional_rows_json({'stories': stories, 'pagination': pagination})
 
 
 # Submit success story
@@ -1465,7 +4266,7 @@ def get_local_events(current_user_id):
     events = supabase_request('GET', 
         f'local_events?event_date=gte.{today}&is_active=eq.true&order=event_date.asc&limit=20') or []
 
-    return jsonify({'events': events}), 200
+    return conditional_rows_json({'events': events})
 
 
 # Create local event
@@ -1509,50 +4310,450 @@ def create_local_event(current_user_id):
     return jsonify({'event': result[0] if result else {}, 'message': 'Event created successfully'}), 201
 
 
-# Get community stats
-@app.route('/api/community/stats', methods=['GET'])
-@token_required
-def get_community_stats(current_user_id):
-    """Get community statistics"""
+# ----------------------
+# Community stats cache
+# ----------------------
+
+_community_stats = None
+_community_stats_refresher_pid = None
+_community_stats_lock = threading.Lock()
+
+
+def compute_community_stats():
+    """Exact counts for the community dashboard, fetched concurrently as HEAD requests (None = failed)"""
+    today = datetime.now(timezone.utc).date().isoformat()
     # Count active discussions (posts from last 7 days)
     seven_days_ago = (datetime.now(timezone.utc).date() - timedelta(days=7)).isoformat()
-    
-    stats = {
-        'active_discussions': 0,
-        'total_members': 0,
-        'success_stories': 0,
-        'upcoming_events': 0
+
+    queries = {
+        'active_discussions': f'forum_posts?select=id&created_at=gte.{seven_days_ago}T00:00:00',
+        'total_members': 'profiles?select=id',
+        'success_stories': 'success_stories?select=id&is_approved=eq.true',
+        'upcoming_events': f'local_events?select=id&event_date=gte.{today}&is_active=eq.true'
     }
+    return fan_out({name: (lambda endpoint=endpoint: supabase_count(endpoint)) for name, endpoint in queries.items()})
+
+
+def refresh_community_stats():
+    """Recompute the cached stats, keeping the last good value for any count that failed"""
+    global _community_stats
+    fresh = compute_community_stats()
+    previous = _community_stats or {}
+    _community_stats = {name: value if value is not None else previous.get(name, 0) for name, value in fresh.items()}
+    return _community_stats
 
-    try:
-        # Get active discussions
-        recent_posts = supabase_request('GET', f'forum_posts?created_at=gte.{seven_days_ago}T00:00:00') or []
-        stats['active_discussions'] = len(recent_posts)
 
-        # Get total members (simplified count)
-        profiles = supabase_request('GET', 'profiles?select=id&limit=1000') or []
-        stats['total_members'] = len(profiles)
+def _community_stats_refresher():
+    while True:
+        time.sleep(COMMUNITY_STATS_REFRESH)
+        try:
+            refresh_community_stats()
+        except Exception as e:
+            print(f"Error refreshing community stats: {e}")
 
-        # Get success stories count
-        stories = supabase_request('GET', 'success_stories?select=id&is_approved=eq.true&limit=1000') or []
-        stats['success_stories'] = len(stories)
 
-        # Get upcoming events
-        today = datetime.now(timezone.utc).date().isoformat()
-        events = supabase_request('GET', f'local_events?select=id&event_date=gte.{today}&is_active=eq.true&limit=1000') or []
-        stats['upcoming_events'] = len(events)
+def get_community_stats_cached():
+    """Serve stats from memory; the first call in each worker fills the cache and starts the refresher"""
+    global _community_stats_refresher_pid
+    if _community_stats is None or _community_stats_refresher_pid != os.getpid():
+        with _community_stats_lock:
+            if _community_stats is None:
+                refresh_community_stats()
+            if _community_stats_refresher_pid != os.getpid():
+                threading.Thread(target=_community_stats_refresher, name='community-stats', daemon=True).start()
+                _community_stats_refresher_pid = os.getpid()
+    return _community_stats
 
+
+# Get community stats
+@app.route('/api/community/stats', methods=['GET'])
+@token_required
+def get_community_stats(current_user_id):
+    """Get community statistics"""
+    try:
+        stats = dict(get_community_stats_cached())
     except Exception as e:
         print(f"Error fetching community stats: {e}")
+        stats = {
+            'active_discussions': 0,
+            'total_members': 0,
+            'success_stories': 0,
+            'upcoming_events': 0
+        }
 
     return jsonify({'stats': stats}), 200
 
 
+# ----------------------
+# Forum search index
+# ----------------------
+
+class ForumSearchIndex:
+    """
+    Inverted index over forum posts (title, content, category) with BM25 ranking,
+    prefix expansion of the last query word and <mark> highlighting.
+
+    Queries don't score every posting. Short postings lists are read whole; long ones
+    are also kept in impact order (best BM25 term score first) and walked best-first,
+    scoring each newly seen post in full, until the limit-th best score beats what
+    any unseen post could still reach (Fagin's threshold algorithm). Common terms
+    thus cost about `limit` postings rather than their whole list, and no query
+    reads more than MAX_PREFIX_POSTINGS + MAX_POSTINGS_READ postings past its own
+    short lists.
+    """
+    _WORD_RE = re.compile(r"[a-z0-9]+")
+    STOPWORDS = frozenset(
+        "a an and are as at be but by for from has have how i in is it its of on or that the "
+        "this to was what when where which who why will with you your".split()
+    )
+    FIELD_WEIGHTS = {'title': 3, 'category': 1, 'content': 1}
+    K1 = 1.2
+    B = 0.75
+    MAX_PREFIX_TERMS = 30
+    # Postings the prefix expansions of one query may add, most frequent expansion first
+    MAX_PREFIX_POSTINGS = 2000
+    # Lists this short are read whole; longer ones are walked in impact order
+    SMALL_POSTINGS = 256
+    # Impact-ordered postings a query may read before it settles for the best posts found so far
+    MAX_POSTINGS_READ = 2000
+    # Impact lists hold scores taken at one average post length, so pruning is exact to
+    # within this drift of it; beyond that they are rebuilt on next use
+    MAX_LENGTH_DRIFT = 0.01
+
+    def __init__(self):
+        self._docs = {}        # post id -> (post, term frequencies, weighted length)
+        self._postings = {}    # term -> {post id: weighted tf}
+        self._impacts = {}     # term -> [(-term score at _impact_avg, post id)], ascending; built on use
+        self._impact_avg = None
+        self._vocab = []       # sorted terms, for prefix lookups
+        self._total_length = 0
+        self._lock = threading.RLock()
+
+    @classmethod
+    def tokenize(cls, text):
+        return [t for t in cls._WORD_RE.findall((text or '').lower()) if t not in cls.STOPWORDS]
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _term_score(self, freq, length, avg_length):
+        """BM25 term-frequency component, before idf"""
+        return freq * (self.K1 + 1) / (freq + self.K1 * (1 - self.B + self.B * length / avg_length))
+
+    def add(self, post):
+        """Insert or replace a post"""
+        tf = {}
+        for field, weight in self.FIELD_WEIGHTS.items():
+            for term in self.tokenize(post.get(field)):
+                tf[term] = tf.get(term, 0) + weight
+        length = sum(tf.values())
+
+        with self._lock:
+            self._remove_locked(post['id'])
+            self._docs[post['id']] = (post, tf, length)
+            self._total_length += length
+            for term, freq in tf.items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = {}
+                    bisect.insort(self._vocab, term)
+                postings[post['id']] = freq
+                impacts = self._impacts.get(term)
+                if impacts is not None:
+                    bisect.insort(impacts, (-self._term_score(freq, length, self._impact_avg), post['id']))
+            self._check_drift_locked()
+
+    def remove(self, post_id):
+        with self._lock:
+            self._remove_locked(post_id)
+            self._check_drift_locked()
+
+    def _remove_locked(self, post_id):
+        entry = self._docs.pop(post_id, None)
+        if entry is None:
+            return
+        _, tf, length = entry
+        self._total_length -= length
+        for term, freq in tf.items():
+            postings = self._postings.get(term)
+            postings.pop(post_id, None)
+            impacts = self._impacts.get(term)
+            if impacts is not None:
+                key = (-self._term_score(freq, length, self._impact_avg), post_id)
+                i = bisect.bisect_left(impacts, key)
+                if i < len(impacts) and impacts[i] == key:
+                    del impacts[i]
+            if not postings:
+                del self._postings[term]
+                self._impacts.pop(term, None)
+                del self._vocab[bisect.bisect_left(self._vocab, term)]
+
+    def _check_drift_locked(self):
+        if not self._docs:
+            self._impacts.clear()
+            self._impact_avg = None
+            return
+        avg_length = self._total_length / len(self._docs)
+        if self._impact_avg is None or abs(avg_length / self._impact_avg - 1) > self.MAX_LENGTH_DRIFT:
+            self._impacts.clear()
+            self._impact_avg = avg_length or 1.0
+
+    def _impact_list(self, term):
+        impacts = self._impacts.get(term)
+        if impacts is None:
+            docs, avg_length = self._docs, self._impact_avg
+            impacts = self._impacts[term] = sorted(
+                (-self._term_score(freq, docs[post_id][2], avg_length), post_id)
+                for post_id, freq in self._postings[term].items()
+            )
+        return impacts
+
+    def hot_terms(self):
+        """Terms whose impact lists have been built (i.e. queried), to warm a replacement index"""
+        with self._lock:
+            return list(self._impacts)
+
+    def warm(self, terms):
+        with self._lock:
+            for term in terms:
+                if term in self._postings:
+                    self._impact_list(term)
+
+    def _expand_prefix(self, prefix):
+        start = bisect.bisect_left(self._vocab, prefix)
+        terms = []
+        for term in self._vocab[start:start + self.MAX_PREFIX_TERMS]:
+            if not term.startswith(prefix):
+                break
+            terms.append(term)
+        return terms
+
+    def search(self, query, limit=20):
+        """Best-matching posts as (post, matched terms) pairs, highest BM25 score first"""
+        tokens = self.tokenize(query)
+        if not tokens or limit <= 0:
+            return []
+
+        with self._lock:
+            n_docs = len(self._docs)
+            if not n_docs:
+                return []
+
+            # Exact terms score in full; the last word also matches as a prefix, at half weight.
+            # Long expansions are walked like any long list; short ones are read whole, so
+            # they are taken most frequent first while they fit MAX_PREFIX_POSTINGS
+            weighted_terms = {t: 1.0 for t in tokens if t in self._postings}
+            budget = self.MAX_PREFIX_POSTINGS
+            expansions = sorted(self._expand_prefix(tokens[-1]), key=lambda t: -len(self._postings[t]))
+            for term in expansions:
+                size = len(self._postings[term])
+                if term in weighted_terms:
+                    continue
+                if size <= self.SMALL_POSTINGS:
+                    if size > budget:
+                        continue
+                    budget -= size
+                weighted_terms[term] = 0.5
+            if not weighted_terms:
+                return []
+
+            avg_length = self._total_length / n_docs
+            docs = self._docs
+            small, large = [], []
+            for term, boost in weighted_terms.items():
+                postings = self._postings[term]
+                weight = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5)) * boost
+                (small if len(postings) <= self.SMALL_POSTINGS else large).append((term, weight, postings))
+
+            # Short lists are read whole, term at a time, so every post they hold is seen
+            k1, b = self.K1, self.B
+            partial = {}
+            for _, weight, postings in small:
+                for post_id, freq in postings.items():
+                    norm = k1 * (1 - b + b * docs[post_id][2] / avg_length)
+                    partial[post_id] = partial.get(post_id, 0.0) + weight * freq * (k1 + 1) / (freq + norm)
+
+            def full_score(post_id):
+                length = docs[post_id][2]
+                score = partial.get(post_id, 0.0)
+                for _, weight, postings in large:
+                    freq = postings.get(post_id)
+                    if freq:
+                        score += weight * self._term_score(freq, length, avg_length)
+                return score
+
+            if large:
+                partial = {post_id: full_score(post_id) for post_id in partial}
+            best = [(score, post_id) for post_id, score in partial.items()]  # min-heap, at most `limit`
+            if len(best) > limit:
+                best = heapq.nlargest(limit, best)
+            heapq.heapify(best)
+
+            def offer(post_id):
+                score = full_score(post_id)
+                if len(best) < limit:
+                    heapq.heappush(best, (score, post_id))
+                elif score > best[0][0]:
+                    heapq.heapreplace(best, (score, post_id))
+
+            # Long lists are walked best-first until no unseen post (which, having been in
+            # no short list, scores from long lists alone) could enter the top `limit`
+            frontier = []  # heap of (-bound of the list's next posting, list number, position)
+            lists = []
+            for n, (term, weight, _) in enumerate(large):
+                impacts = self._impact_list(term)
+                lists.append((weight, impacts))
+                frontier.append((weight * impacts[0][0], n, 0))
+            heapq.heapify(frontier)
+            threshold = -sum(bound for bound, _, _ in frontier)
+
+            # Bounds were taken at _impact_avg; a post's score at today's average is within
+            # this factor of them, so stopping here misses nothing by more than that drift
+            drift = max(avg_length / self._impact_avg, self._impact_avg / avg_length)
+            seen = set(partial)
+            reads = 0
+            while frontier and reads < self.MAX_POSTINGS_READ:
+                if len(best) == limit and best[0][0] * drift >= threshold:
+                    break
+                bound, n, position = heapq.heappop(frontier)
+                threshold += bound  # this list's posting is about to be seen
+                weight, impacts = lists[n]
+                post_id = impacts[position][1]
+                reads += 1
+                if position + 1 < len(impacts):
+                    bound = weight * impacts[position + 1][0]
+                    heapq.heappush(frontier, (bound, n, position + 1))
+                    threshold -= bound
+                if post_id not in seen:
+                    seen.add(post_id)
+                    offer(post_id)
+
+            best.sort(reverse=True)
+            return [(docs[post_id][0], list(weighted_terms)) for _, post_id in best]
+
+    @classmethod
+    def highlight(cls, text, terms, max_chars=None):
+        """HTML-escaped text with matched words wrapped in <mark>; optionally a window around the first hit"""
+        text = text or ''
+        term_set = set(terms)
+        matches = [m for m in re.finditer(r"[A-Za-z0-9]+", text) if m.group().lower() in term_set]
+        if max_chars and len(text) > max_chars:
+            start = max(0, matches[0].start() - max_chars // 4) if matches else 0
+            end = start + max_chars
+            matches = [m for m in matches if m.start() >= start and m.end() <= end]
+            prefix, suffix = ('…' if start else ''), ('…' if end < len(text) else '')
+        else:
+            start, end, prefix, suffix = 0, len(text), '', ''
+
+        out, pos = [], start
+        for m in matches:
+            out.append(html.escape(text[pos:m.start()]))
+            out.append(f"<mark>{html.escape(m.group())}</mark>")
+            pos = m.end()
+        out.append(html.escape(text[pos:end]))
+        return prefix + ''.join(out) + suffix
+
+
+forum_search_index = None
+_search_index_pid = None
+_search_index_lock = threading.Lock()
+_search_watermark = None
+
+
+def _stream_forum_posts(updated_after=None):
+    """Yield forum posts page by page in id order (optionally only those updated after a timestamp)"""
+    last_id = 0
+    while True:
+        params = {'id': f'gt.{last_id}'}
+        if updated_after:
+            params['updated_at'] = f'gt.{updated_after}'
+        page = supabase_request(
+            'GET', f'forum_posts?select=*,profiles(name,location)&order=id.asc&limit={SEARCH_PAGE_SIZE}',
+            params=params
+        )
+        if page is None:
+            raise RuntimeError('Supabase error while streaming forum posts')
+        yield from page
+        if len(page) < SEARCH_PAGE_SIZE:
+            return
+        last_id = page[-1]['id']
+
+
+def _advance_watermark(post):
+    global _search_watermark
+    stamp = post.get('updated_at') or post.get('created_at')
+    if stamp and (_search_watermark is None or stamp > _search_watermark):
+        _search_watermark = stamp
+
+
+def rebuild_search_index():
+    """Build a fresh index from Supabase and swap it in (also drops deleted posts)"""
+    global forum_search_index, _search_watermark
+    started = time.monotonic()
+    index = ForumSearchIndex()
+    previous = forum_search_index
+    watermark_before = _search_watermark
+    _search_watermark = None
+    try:
+        for post in _stream_forum_posts():
+            index.add(post)
+            _advance_watermark(post)
+    except Exception:
+        _search_watermark = watermark_before
+        raise
+    if previous is not None:
+        index.warm(previous.hot_terms())  # so the swap doesn't make common queries build impact lists
+    forum_search_index = index
+    print(f"Forum search index built: {len(index)} posts in {time.monotonic() - started:.1f}s")
+
+
+def reconcile_search_index():
+    """Pull posts created or edited since the last sync into the live index"""
+    for post in _stream_forum_posts(updated_after=_search_watermark):
+        forum_search_index.add(post)
+        _advance_watermark(post)
+
+
+def _search_index_maintainer():
+    last_rebuild = time.monotonic()
+    try:
+        rebuild_search_index()
+    except Exception as e:
+        print(f"Forum search index build failed: {e}")
+    while True:
+        time.sleep(SEARCH_RECONCILE_INTERVAL)
+        try:
+            if forum_search_index is None or time.monotonic() - last_rebuild >= SEARCH_REBUILD_INTERVAL:
+                rebuild_search_index()
+                last_rebuild = time.monotonic()
+            else:
+                reconcile_search_index()
+        except Exception as e:
+            print(f"Forum search index sync failed: {e}")
+
+
+def ensure_search_index():
+    """Start this worker's background index build (once per process)"""
+    global _search_index_pid, forum_search_index
+    if not SEARCH_INDEX_ENABLED or not SUPABASE_URL or _search_index_pid == os.getpid():
+        return
+    with _search_index_lock:
+        if _search_index_pid != os.getpid():
+            forum_search_index = None  # never serve an index inherited across a fork
+            threading.Thread(target=_search_index_maintainer, name='forum-search-index', daemon=True).start()
+            _search_index_pid = os.getpid()
+
+
+@app.before_request
+def _start_background_indexing():
+    ensure_search_index()
+
+
 # Search forum posts
 @app.route('/api/community/search', methods=['GET'])
 @token_required
 def search_forum_posts(current_user_id):
-    """Search forum posts by title or content"""
+    """Search forum posts by title, content and category (BM25-ranked, in-process index)"""
     query = request.args.get('q', '').strip()
     if not query:
         return jsonify({'error': 'Search query is required'}), 400
@@ -1560,10 +4761,22 @@ def search_forum_posts(current_user_id):
     if len(query) < 3:
         return jsonify({'error': 'Search query must be at least 3 characters'}), 400
 
-    # Use text search (this depends on your database setup)
-    # For basic search, we'll use ilike (case-insensitive like)
-    posts = supabase_request('GET', 
-        f'forum_posts?select=*,profiles(name,location)&or=(title.ilike.%25{query}%25,content.ilike.%25{query}%25)&order=created_at.desc&limit=20') or []
+    index = forum_search_index
+    if index is None or not ForumSearchIndex.tokenize(query):
+        # Index still building, or a query of only stopwords ("how to") that the index
+        # never stores: fall back to ilike (case-insensitive like) in the database
+        posts = supabase_request('GET', 
+            f'forum_posts?select=*,profiles(name,location)&or=(title.ilike.%25{query}%25,content.ilike.%25{query}%25)&order=created_at.desc&limit=20') or []
+    else:
+        posts = []
+        for post, terms in index.search(query, limit=20):
+            posts.append({
+                **post,
+                'highlight': {
+                    'title': ForumSearchIndex.highlight(post.get('title'), terms),
+                    'content': ForumSearchIndex.highlight(post.get('content'), terms, max_chars=240)
+                }
+            })
 
     return jsonify({
         'posts': posts,
@@ -1574,19 +4787,20 @@ def search_forum_posts(current_user_id):
 @app.route("/api/users/community-activity", methods=["GET"])
 @token_required
 def user_community_activity(current_user_id):
-    posts = supabase_request(
-        "GET", f"forum_posts?user_id=eq.{current_user_id}&order=created_at.desc", 
-        use_service_key=True
-    ) or []
-    
-    comments = supabase_request(
-        "GET", f"forum_comments?user_id=eq.{current_user_id}&order=created_at.desc", 
-        use_service_key=True
-    ) or []
-    
+    results = fan_out({
+        "posts": lambda: supabase_request(
+            "GET", f"forum_posts?user_id=eq.{current_user_id}&order=created_at.desc",
+            use_service_key=True
+        ),
+        "comments": lambda: supabase_request(
+            "GET", f"forum_comments?user_id=eq.{current_user_id}&order=created_at.desc",
+            use_service_key=True
+        )
+    })
+
     return jsonify({
-        "posts": posts,
-        "comments": comments
+        "posts": results["posts"] or [],
+        "comments": results["comments"] or []
     }), 200
 
 
@@ -1609,10 +4823,76 @@ def api_status():
         'api_status': 'active',
         'ai_enabled': bool(HF_API_KEY),
         'database_connected': bool(SUPABASE_URL and SUPABASE_KEY),
+        'ai_providers': ai_breakers.snapshot(),
+        'coalescing': {
+            'supabase': supabase_singleflight.stats(),
+            'ai': ai_singleflight.stats()
+        },
         'timestamp': datetime.now(timezone.utc).isoformat()
     })
 
 
+# Prometheus scrape endpoint, aggregated over every gunicorn worker
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if not METRICS_ENABLED:
+        return jsonify({'error': 'Metrics are disabled'}), 503
+    if METRICS_TOKEN and not hmac.compare_digest(
+            request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = prometheus_client.CollectorRegistry()
+        prometheus_multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return Response(prometheus_client.generate_latest(registry), content_type=prometheus_client.CONTENT_TYPE_LATEST)
+
+
+# AI response cache stats / purge
+@app.route('/api/admin/ai-cache', methods=['GET'])
+@admin_required
+def ai_cache_stats():
+    return jsonify({'ai_cache': ai_response_cache.stats()}), 200
+
+
+@app.route('/api/admin/ai-cache', methods=['DELETE'])
+@admin_required
+def purge_ai_cache():
+    ai_response_cache.clear()
+    return jsonify({'message': 'AI response cache purged'}), 200
+
+
+# IntaSend webhook journal backlog
+@app.route('/api/admin/webhooks', methods=['GET'])
+@admin_required
+def webhook_journal_stats():
+    return jsonify({'webhooks': webhook_journal.stats()}), 200
+
+
+# Background job queue: pending counts and dead letters
+@app.route('/api/admin/jobs', methods=['GET'])
+@admin_required
+def job_queue_stats():
+    return jsonify({'jobs': job_queue.stats()}), 200
+
+
+@app.route('/api/admin/jobs/retry-dead', methods=['POST'])
+@admin_required
+def retry_dead_jobs():
+    requeued = job_queue.retry_dead()
+    _job_wakeup.set()
+    return jsonify({'requeued': requeued}), 200
+
+
+# Force a knowledge base reload (it is also picked up automatically on change)
+@app.route('/api/admin/knowledge-base/reload', methods=['POST'])
+@admin_required
+def reload_knowledge_base():
+    kb = load_knowledge_base(force=True)
+    return jsonify({'topics': len(kb.topics)}), 200
+
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
     print(f"Starting HealthGuide Community API on port {port}")
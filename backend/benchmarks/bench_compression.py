@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Bytes on the wire and CPU cost of response compression for typical payloads.
+
+Usage:
+    cd backend && python benchmarks/bench_compression.py [--iterations 200]
+
+Reports raw vs gzip vs brotli size and per-response compression time, then the
+end-to-end cost of serving a large training module through the Flask app with
+the compressed-body cache cold and warm.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+
+import jwt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('SUPABASE_JWT_SECRET', 'bench-secret-bench-secret-bench-secret')
+import app  # noqa: E402
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _payloads():
+    paragraph = ("Community health workers should check for danger signs such as fever above 39C, "
+                 "convulsions, inability to drink or breastfeed, and refer immediately. ")
+    module = {
+        'id': 1, 'title': 'Integrated management of childhood illness', 'slug': 'imci',
+        'content': '\n\n'.join(f"## Section {i}\n" + paragraph * 6 for i in range(40)),
+        'difficulty': 'intermediate', 'estimated_time': 45,
+        'created_at': '2024-05-01T10:00:00+00:00', 'updated_at': '2024-05-01T10:00:00+00:00'
+    }
+    profile = {'name': 'Amina Wanjiru', 'location': 'Kisumu'}
+    forum_page = {
+        'posts': [{'id': i, 'title': f'Post {i} about ORS stock-outs', 'content': paragraph * 3,
+                   'category': 'questions', 'created_at': '2024-05-01T10:00:00+00:00', 'profiles': profile}
+                  for i in range(20)],
+        'pagination': {'page': 1, 'limit': 20, 'total': 3573, 'has_more': True}
+    }
+    kb_answer = {'response': app.knowledge_base_answer('malaria'), 'model_used': 'knowledge_base',
+                 'timestamp': '2024-05-01T10:00:00+00:00'}
+    return {'training module': module, 'forum page': forum_page, 'KB answer': kb_answer}
+
+
+def _time(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        result = fn()
+    return (time.perf_counter() - start) / iterations * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'payload':<16}{'raw':>9}{'gzip':>9}{'gzip ms':>9}{'br':>9}{'br ms':>9}")
+    for name, payload in _payloads().items():
+        raw = json.dumps(payload).encode()
+        gz_ms, gz = _time(lambda: gzip.compress(raw, compresslevel=app.COMPRESS_GZIP_LEVEL, mtime=0), args.iterations)
+        row = f"{name:<16}{len(raw):>9}{len(gz):>9}{gz_ms:>9.3f}"
+        if brotli is not None:
+            br_ms, br = _time(lambda: brotli.compress(raw, quality=app.COMPRESS_BROTLI_QUALITY), args.iterations)
+            row += f"{len(br):>9}{br_ms:>9.3f}"
+        print(row)
+
+    module = _payloads()['training module']
+    app.supabase_request = lambda *a, **k: [dict(module)]
+    token = jwt.encode({'sub': 'bench', 'aud': 'authenticated', 'exp': int(time.time()) + 3600},
+                       os.environ['SUPABASE_JWT_SECRET'], algorithm='HS256')
+    client = app.app.test_client()
+    headers = {'Authorization': f'Bearer {token}', 'Accept-Encoding': 'gzip, br'}
+
+    def fetch():
+        return client.get('/api/training/modules/1', headers=headers)
+
+    def fetch_cold():
+        app._compressed_cache.clear()
+        return fetch()
+
+    cold_ms, response = _time(fetch_cold, args.iterations)
+    warm_ms, _ = _time(fetch, args.iterations)
+    print(f"\nGET /api/training/modules/1 ({response.headers.get('Content-Encoding')}, "
+          f"{len(response.data)} bytes on the wire): cold cache {cold_ms:.3f} ms, warm cache {warm_ms:.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
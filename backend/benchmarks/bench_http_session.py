@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Per-call latency of module-level requests vs the pooled keep-alive session.
+
+Usage:
+    cd backend && python benchmarks/bench_http_session.py [--calls 200] [--url URL]
+
+Without --url a local HTTP/1.1 server is started, which only shows the TCP
+setup cost. Point --url at your Supabase project (e.g. .../auth/v1/health)
+to include the TLS handshake, which is where most of the saving is.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from app import get_http_session  # noqa: E402
+
+
+class _OkHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = b'[]'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _time_calls(get, url, calls):
+    samples = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        get(url, timeout=10).content
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def _report(label, samples):
+    samples = sorted(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    print(f"{label:<22} mean={statistics.mean(samples):7.2f}ms  "
+          f"p50={statistics.median(samples):7.2f}ms  p95={p95:7.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--url', help='Remote URL to benchmark instead of a local server')
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if not url:
+        server = ThreadingHTTPServer(('127.0.0.1', 0), _OkHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/rest/v1/modules"
+
+    print(f"{args.calls} sequential GETs against {url}")
+    _report('requests.get (before)', _time_calls(requests.get, url, args.calls))
+    _report('pooled session (after)', _time_calls(get_http_session().get, url, args.calls))
+
+    if server:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+p50/p99 of POST /api/training/modules/<id>/complete against a slow PostgREST stand-in.
+
+Usage:
+    cd backend && python benchmarks/bench_module_complete.py [--calls 200] [--upstream-ms 40] [--baseline REF]
+
+Every /rest/v1 call sleeps --upstream-ms, so latency is dominated by the number
+of sequential upstream round trips. The stand-in models a first completion:
+GET returns a profile, PATCH matches no row, POST echoes the inserted row.
+--baseline REF also times backend/app.py as of that git revision (e.g. the
+commit before the single-upsert rewrite) for a before/after comparison.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+JWT_SECRET = 'bench-secret-bench-secret-bench-secret'
+
+
+def _fake_postgrest(latency, counter):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def _reply(self, body):
+            time.sleep(latency)
+            counter[self.command] = counter.get(self.command, 0) + 1
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return json.loads(self.rfile.read(length) or b'null')
+
+        def do_GET(self):
+            self._reply([{'id': 'bench-user'}])
+
+        def do_PATCH(self):
+            self._body()
+            self._reply([])
+
+        def do_POST(self):
+            body = self._body()
+            self._reply(body if isinstance(body, list) else [body])
+
+        def log_message(self, *args):
+            pass
+
+    ThreadingHTTPServer.daemon_threads = True
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _load_app(path, name):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _baseline_app(ref):
+    """Copy the backend as of `ref` into a temp dir so both versions can be imported side by side"""
+    tmp = tempfile.mkdtemp(prefix='bench-baseline-')
+    source = subprocess.run(
+        ['git', 'show', f'{ref}:backend/app.py'], cwd=BACKEND_DIR,
+        check=True, capture_output=True, text=True
+    ).stdout
+    with open(os.path.join(tmp, 'app.py'), 'w') as f:
+        f.write(source)
+    if os.path.isdir(os.path.join(BACKEND_DIR, 'data')):
+        shutil.copytree(os.path.join(BACKEND_DIR, 'data'), os.path.join(tmp, 'data'))
+    return tmp
+
+
+def _time_calls(module, token, calls):
+    client = module.app.test_client()
+    headers = {'Authorization': f'Bearer {token}'}
+    samples = []
+    for i in range(calls):
+        start = time.perf_counter()
+        resp = client.post(f'/api/training/modules/{i % 50 + 1}/complete', headers=headers)
+        samples.append((time.perf_counter() - start) * 1000)
+        if resp.status_code != 200:
+            raise RuntimeError(f"unexpected {resp.status_code}: {resp.get_data(as_text=True)}")
+    return sorted(samples)
+
+
+def _report(label, samples, counter, calls):
+    p99 = samples[int(len(samples) * 0.99) - 1]
+    trips = sum(counter.values()) / calls
+    print(f"{label:<10} p50={statistics.median(samples):7.1f}ms  p99={p99:7.1f}ms  "
+          f"upstream calls/request={trips:.1f} {dict(sorted(counter.items()))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--upstream-ms', type=float, default=40)
+    parser.add_argument('--baseline', help='git revision to compare against')
+    args = parser.parse_args()
+
+    counter = {}
+    upstream = _fake_postgrest(args.upstream_ms / 1000, counter)
+    os.environ.update(
+        SUPABASE_URL=f"http://127.0.0.1:{upstream.server_address[1]}",
+        SUPABASE_KEY='anon',
+        SUPABASE_SERVICE_KEY='service',
+        SUPABASE_JWT_SECRET=JWT_SECRET,
+        SEARCH_INDEX_ENABLED='false',
+    )
+    token = jwt.encode(
+        {'sub': 'bench-user', 'aud': 'authenticated', 'exp': int(time.time()) + 3600, 'iat': int(time.time())},
+        JWT_SECRET, algorithm='HS256'
+    )
+
+    targets = []
+    if args.baseline:
+        targets.append(('before', os.path.join(_baseline_app(args.baseline), 'app.py')))
+    targets.append(('after', os.path.join(BACKEND_DIR, 'app.py')))
+
+    print(f"{args.calls} sequential completions, upstream latency {args.upstream_ms:.0f}ms")
+    for label, path in targets:
+        module = _load_app(path, f'bench_app_{label}')
+        _time_calls(module, token, 5)  # warm-up
+        counter.clear()
+        _report(label, _time_calls(module, token, args.calls), counter, args.calls)
+
+    upstream.shutdown()
+
+
+if __name__ == '__main__':
+    main()
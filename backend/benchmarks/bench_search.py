@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Forum search latency on a synthetic 100k-post index.
+
+Usage:
+    cd backend && python benchmarks/bench_search.py [--posts 100000] [--iterations 50]
+
+Builds a ForumSearchIndex over generated posts (a Zipf-distributed vocabulary plus
+health terms planted at known document frequencies), then reports per-query latency
+for common, rare, multi-word and prefix-expanded queries. Each query is also scored
+exhaustively over the same terms, as the index did before impact-ordered postings,
+to report that baseline's latency and how many of the pruned top 20 belong to the
+exact top 20 (posts tied at the 20th score count as members).
+"""
+
+import argparse
+import heapq
+import itertools
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('SEARCH_INDEX_ENABLED', 'False')
+from app import ForumSearchIndex  # noqa: E402
+
+# term -> share of posts whose content mentions it
+PLANTED = {'child': 0.73, 'vaccine': 0.31, 'malaria': 0.2, 'nutrition': 0.075, 'cholera': 0.01}
+PREFIX_WORDS = [f'vacc{suffix}' for suffix in
+                ('ination', 'inations', 'inated', 'inator', 'ines', 'inia')] + [f'vacc{n}' for n in range(40)]
+CATEGORIES = ('general', 'questions', 'maternal health', 'outbreaks', 'training')
+QUERIES = ['child', 'vaccine', 'malaria', 'cholera', 'vaccine child nutrition', 'malaria child', 'vacc', 'child vacc']
+
+
+def build_corpus(n_posts, seed=7):
+    rng = random.Random(seed)
+    vocab = [f'w{i}' for i in range(30000)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocab))))
+    posts = []
+    for post_id in range(1, n_posts + 1):
+        words = rng.choices(vocab, cum_weights=cum_weights, k=60)
+        words += [term for term, share in PLANTED.items() if rng.random() < share]
+        if rng.random() < 0.05:
+            words.append(rng.choice(PREFIX_WORDS))
+        rng.shuffle(words)
+        posts.append({
+            'id': post_id,
+            'title': ' '.join(rng.choices(vocab, cum_weights=cum_weights, k=6) + words[:2]),
+            'content': ' '.join(words),
+            'category': rng.choice(CATEGORIES),
+        })
+    return posts
+
+
+def exhaustive_scores(index, query, terms):
+    """The pre-pruning algorithm: score every posting of every term, {post id: score}"""
+    tokens = index.tokenize(query)
+    n_docs = len(index._docs)
+    avg_length = index._total_length / n_docs
+    scores = {}
+    for term in terms:
+        postings = index._postings[term]
+        boost = 1.0 if term in tokens else 0.5
+        idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5)) * boost
+        for post_id, freq in postings.items():
+            score = idf * index._term_score(freq, index._docs[post_id][2], avg_length)
+            scores[post_id] = scores.get(post_id, 0.0) + score
+    return scores
+
+
+def _time_ms(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        result = fn()
+    return (time.perf_counter() - start) / iterations * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    posts = build_corpus(args.posts)
+    index = ForumSearchIndex()
+    started = time.perf_counter()
+    for post in posts:
+        index.add(post)
+    print(f"indexed {len(index)} posts in {time.perf_counter() - started:.1f}s")
+
+    # A long list is sorted into impact order on first use; rebuilds warm the terms already queried
+    started = time.perf_counter()
+    for query in QUERIES:
+        index.search(query)
+    print(f"first run of every query (builds impact lists): {(time.perf_counter() - started) * 1000:.0f} ms\n")
+
+    print(f"{'query':<26}{'terms':>6}{'postings':>10}{'pruned ms':>11}{'full ms':>9}{'exact top 20':>14}")
+    for query in QUERIES:
+        pruned_ms, pruned = _time_ms(lambda: index.search(query, limit=20), args.iterations)
+        terms = pruned[0][1] if pruned else []
+        postings = sum(len(index._postings[term]) for term in terms)
+        full_ms, scores = _time_ms(lambda: exhaustive_scores(index, query, terms), max(1, args.iterations // 10))
+        cutoff = heapq.nlargest(20, scores.values())[-1]
+        exact = sum(1 for post, _ in pruned if scores[post['id']] >= cutoff - 1e-9)
+        print(f"{query:<26}{len(terms):>6}{postings:>10}{pruned_ms:>11.2f}{full_ms:>9.1f}{exact:>11}/{len(pruned)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Load comparison of SERVING_MODE=sync vs SERVING_MODE=async (gevent) gunicorn workers.
+
+Usage:
+    cd backend && python benchmarks/bench_serving_modes.py [--requests 400] [--concurrency 100]
+
+A local stand-in for Supabase answers every /rest/v1 call after --upstream-ms,
+and tokens are verified locally (SUPABASE_JWT_SECRET), so each request to
+/api/community/events costs exactly one slow upstream round trip. Requires
+gunicorn and gevent (pip install -r requirements.txt).
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+import requests
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+JWT_SECRET = 'bench-secret-bench-secret-bench-secret'
+
+
+def _slow_upstream(latency):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            time.sleep(latency)
+            body = b'[]'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    ThreadingHTTPServer.daemon_threads = True
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.request_queue_size = 1024
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _start_app(mode, port, upstream_url, workers):
+    env = dict(
+        os.environ,
+        SERVING_MODE=mode,
+        PORT=str(port),
+        SUPABASE_URL=upstream_url,
+        SUPABASE_KEY='anon',
+        SUPABASE_JWT_SECRET=JWT_SECRET,
+        WEB_CONCURRENCY=str(workers),
+    )
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    for _ in range(100):
+        try:
+            requests.get(f"http://127.0.0.1:{port}/health", timeout=1)
+            return proc
+        except requests.RequestException:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"gunicorn ({mode}) did not start")
+
+
+def _load(url, token, total, concurrency):
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    headers = {'Authorization': f'Bearer {token}'}
+
+    def one(_):
+        start = time.perf_counter()
+        try:
+            ok = session.get(url, headers=headers, timeout=60).status_code == 200
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(total)))
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--upstream-ms', type=float, default=200)
+    args = parser.parse_args()
+
+    upstream = _slow_upstream(args.upstream_ms / 1000)
+    upstream_url = f"http://127.0.0.1:{upstream.server_address[1]}"
+    token = jwt.encode(
+        {'sub': 'bench-user', 'aud': 'authenticated', 'exp': int(time.time()) + 3600, 'iat': int(time.time())},
+        JWT_SECRET, algorithm='HS256'
+    )
+
+    print(f"{args.requests} requests, concurrency {args.concurrency}, {args.workers} workers, "
+          f"upstream latency {args.upstream_ms:.0f}ms")
+    for port, mode in ((5101, 'sync'), (5102, 'async')):
+        proc = _start_app(mode, port, upstream_url, args.workers)
+        try:
+            url = f"http://127.0.0.1:{port}/api/community/events"
+            _load(url, token, args.concurrency, args.concurrency)  # warm-up
+            elapsed, results = _load(url, token, args.requests, args.concurrency)
+        finally:
+            proc.terminate()
+            proc.wait()
+
+        latencies = sorted(r[0] * 1000 for r in results)
+        errors = sum(1 for r in results if not r[1])
+        print(f"{mode:<6} {len(results) / elapsed:8.1f} req/s  "
+              f"p50={statistics.median(latencies):8.1f}ms  "
+              f"p99={latencies[int(len(latencies) * 0.99) - 1]:8.1f}ms  errors={errors}")
+
+    upstream.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Local stand-ins for every upstream the API talks to, for load tests.
+
+    supabase  PostgREST /rest/v1/<table> (GET/HEAD/POST/PATCH/DELETE) and /auth/v1
+    openai    /v1/chat/completions (plain and stream=true)
+    hf        /models/<model> inference
+    intasend  /api/v1 subscription customers, subscriptions, plans, cancel
+
+Each service has its own latency and error rate (a failed call returns 503).
+GET /__stats on any service returns its call counts; POST /__stats/reset zeroes them.
+
+Usage:
+    cd backend && python benchmarks/fakes.py [--latency supabase=20,openai=400] [--errors openai=0.1]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import jwt
+
+SERVICES = ('supabase', 'openai', 'hf', 'intasend')
+DEFAULT_LATENCY_MS = {'supabase': 20, 'openai': 400, 'hf': 600, 'intasend': 150}
+JWT_SECRET = 'bench-secret-bench-secret-bench-secret'
+TABLE_ROWS = 25
+TABLE_TOTAL = 1200
+
+_EPOCH = '2024-01-01T00:00:00+00:00'
+
+
+def _fake_row(table, row_id):
+    row = {'id': row_id, 'created_at': _EPOCH, 'updated_at': _EPOCH}
+    author = {'name': f'Health Worker {row_id % 40}', 'location': 'Nairobi'}
+    if table == 'modules':
+        row.update(title=f'Module {row_id}', slug=f'module-{row_id}', description='Community health basics',
+                   content='Lesson text ' * 50, difficulty='beginner', estimated_time=15, is_published=True)
+    elif table == 'forum_posts':
+        row.update(title=f'Vaccination outreach question {row_id}', content='How do you plan outreach days? ' * 8,
+                   category='general', user_id=f'user-{row_id % 40}', author_id=f'user-{row_id % 40}', profiles=author)
+    elif table == 'forum_comments':
+        row.update(post_id=row_id % 50 + 1, content='We start with the village elders. ' * 3,
+                   user_id=f'user-{row_id % 40}', author_id=f'user-{row_id % 40}', profiles=author)
+    elif table == 'user_progress':
+        row.update(user_id='bench-user', module_id=row_id, score=100, completed=True, completed_at=_EPOCH)
+    elif table == 'profiles':
+        row.update(id=f'user-{row_id}', name=author['name'], location='Nairobi', role='health_worker',
+                   email=f'user-{row_id}@example.org', intasend_customer_id=f'cus_{row_id}')
+    elif table == 'subscriptions':
+        row.update(user_id=f'user-{row_id}', status='active', plan='basic', intasend_subscription_id=f'sub_{row_id}')
+    elif table in ('success_stories', 'local_events'):
+        row.update(title=f'{table} {row_id}', content='Story text ' * 20, description='Event details',
+                   event_date='2030-01-01', location='Kisumu', is_approved=True, is_active=True, profiles=author)
+    return row
+
+
+def _rows_for(table, query):
+    """Rows shaped like the table; filters are honoured only as far as load tests need"""
+    for value in (v[0] for v in query.values()):
+        if value.startswith(('gt.', 'lt.')):
+            return []  # past the single page of synthetic rows: end keyset paging
+    ids = query.get('id', [''])[0]
+    if ids.startswith('eq.'):
+        key = ids[3:]
+        return [{**_fake_row(table, int(key) if key.isdigit() else 1), 'id': int(key) if key.isdigit() else key}]
+    limit = query.get('limit', [str(TABLE_ROWS)])[0]
+    count = min(int(limit) if limit.isdigit() else TABLE_ROWS, TABLE_ROWS)
+    return [_fake_row(table, i) for i in range(1, count + 1)]
+
+
+def _completion(text, stream):
+    if not stream:
+        return 'application/json', json.dumps({
+            'id': 'chatcmpl-bench', 'object': 'chat.completion', 'created': int(time.time()),
+            'model': 'gpt-3.5-turbo',
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 50, 'completion_tokens': 50, 'total_tokens': 100}
+        })
+    events = []
+    for word in text.split(' '):
+        events.append(json.dumps({
+            'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+            'model': 'gpt-3.5-turbo',
+            'choices': [{'index': 0, 'delta': {'content': word + ' '}, 'finish_reason': None}]
+        }))
+    return 'text/event-stream', ''.join(f'data: {e}\n\n' for e in events) + 'data: [DONE]\n\n'
+
+
+class FakeService:
+    """One upstream on its own port, with injected latency/errors and per-route call counts"""
+
+    def __init__(self, name, latency_ms=0.0, error_rate=0.0, host='127.0.0.1'):
+        self.name = name
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self.counts = {}
+        self._lock = threading.Lock()
+
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body=b'', content_type='application/json', headers=None):
+                if isinstance(body, str):
+                    body = body.encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def _handle(self):
+                parts = urlsplit(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+
+                if parts.path.startswith('/__stats'):
+                    if parts.path.endswith('/reset'):
+                        service.reset()
+                    return self._send(200, json.dumps(service.stats()))
+
+                service.count(self.command, parts.path)
+                if service.latency:
+                    time.sleep(service.latency)
+                if service.error_rate and random.random() < service.error_rate:
+                    return self._send(503, json.dumps({'message': 'injected failure'}))
+
+                try:
+                    body = json.loads(raw) if raw else None
+                except ValueError:
+                    body = None
+                status, payload, content_type, headers = service.route(
+                    self.command, parts.path, parse_qs(parts.query), body, self.headers
+                )
+                self._send(status, payload, content_type, headers)
+
+            do_GET = do_HEAD = do_POST = do_PATCH = do_DELETE = _handle
+
+        self.server = ThreadingHTTPServer((host, 0), Handler)
+        self.server.daemon_threads = True
+        self.server.request_queue_size = 1024
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name=f'fake-{self.name}', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def count(self, method, path):
+        key = f'{method} {self._route_label(path)}'
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self.counts = {}
+
+    def stats(self):
+        with self._lock:
+            return {'service': self.name, 'total': sum(self.counts.values()), 'by_route': dict(self.counts)}
+
+    def _route_label(self, path):
+        segments = [s for s in path.split('/') if s]
+        if self.name == 'supabase':
+            return '/'.join(segments[:3])  # rest/v1/<table> or auth/v1/<action>
+        if self.name == 'intasend':
+            return '/'.join(s if not s.startswith('sub_') else '<id>' for s in segments[2:])
+        return '/'.join(segments)
+
+    def route(self, method, path, query, body, headers):
+        """Return (status, body, content type, extra headers) for a non-failed call"""
+        handler = getattr(self, f'_route_{self.name}')
+        result = handler(method, path, query, body, headers)
+        return result + ({},) if len(result) == 3 else result
+
+    def _route_supabase(self, method, path, query, body, headers):
+        segments = [s for s in path.split('/') if s]
+        if segments[:2] == ['auth', 'v1']:
+            return self._route_auth(method, segments[2] if len(segments) > 2 else '', body, headers)
+        table = segments[2] if len(segments) > 2 else ''
+
+        if method == 'HEAD':
+            return 200, '', 'application/json', {'Content-Range': f'*/{TABLE_TOTAL}'}
+        if method == 'GET':
+            rows = _rows_for(table, query)
+            extra = {}
+            if 'count=' in headers.get('Prefer', ''):
+                extra['Content-Range'] = f'0-{max(len(rows) - 1, 0)}/{TABLE_TOTAL}'
+            return 200, json.dumps(rows), 'application/json', extra
+        if method in ('POST', 'PATCH'):
+            rows = body if isinstance(body, list) else [body or {}]
+            return (201 if method == 'POST' else 200), json.dumps(
+                [{'id': i + 1, 'created_at': _EPOCH, **row} for i, row in enumerate(rows)]
+            ), 'application/json'
+        return 204, '', 'application/json'
+
+    def _route_auth(self, method, action, body, headers):
+        if action in ('token', 'signup'):
+            email = (body or {}).get('email', 'bench@example.org')
+            user_id = 'user-' + hashlib.sha256(email.encode()).hexdigest()[:12]
+            user = {'id': user_id, 'email': email, 'user_metadata': {'name': 'Bench', 'location': 'Nairobi'}}
+            now = int(time.time())
+            token = jwt.encode({'sub': user_id, 'aud': 'authenticated', 'iat': now, 'exp': now + 3600},
+                               JWT_SECRET, algorithm='HS256')
+            return 200, json.dumps({'access_token': token, 'refresh_token': 'refresh', 'user': user}), 'application/json'
+        if action == 'user':
+            token = headers.get('Authorization', '').replace('Bearer ', '')
+            try:
+                claims = jwt.decode(token, JWT_SECRET, algorithms=['HS256'], audience='authenticated')
+            except jwt.InvalidTokenError:
+                return 401, json.dumps({'message': 'invalid token'}), 'application/json'
+            return 200, json.dumps({'id': claims['sub']}), 'application/json'
+        if action == 'logout':
+            return 204, '', 'application/json'
+        return 200, '{}', 'application/json'
+
+    def _route_openai(self, method, path, query, body, headers):
+        prompt = ((body or {}).get('messages') or [{}])[-1].get('content', '')
+        text = f'Here is some practical guidance on "{prompt[:60]}". ' * 4
+        content_type, payload = _completion(text.strip(), bool((body or {}).get('stream')))
+        return 200, payload, content_type
+
+    def _route_hf(self, method, path, query, body, headers):
+        prompt = (body or {}).get('inputs', '')
+        return 200, json.dumps([{'generated_text': prompt + ' Rest, fluids, and see a clinician if it persists.'}]), \
+            'application/json'
+
+    def _route_intasend(self, method, path, query, body, headers):
+        if path.rstrip('/').endswith('subscriptions-customers'):
+            return 201, json.dumps({'customer_id': f'cus_{random.randint(1, 10 ** 6)}'}), 'application/json'
+        if path.rstrip('/').endswith('/cancel'):
+            return 200, '{}', 'application/json'
+        if path.rstrip('/').endswith('subscriptions') and method == 'POST':
+            sub_id = f'sub_{random.randint(1, 10 ** 6)}'
+            return 201, json.dumps({'subscription_id': sub_id, 'setup_url': f'https://pay.example/{sub_id}'}), \
+                'application/json'
+        return 200, json.dumps({'results': [{'id': 'basic'}, {'id': 'premium'}]}), 'application/json'
+
+
+def parse_service_map(spec, cast=float):
+    """'supabase=20,openai=400' -> {'supabase': 20.0, 'openai': 400.0}"""
+    result = {}
+    for item in filter(None, (spec or '').split(',')):
+        name, _, value = item.partition('=')
+        if name not in SERVICES:
+            raise ValueError(f'Unknown service {name!r}; expected one of {", ".join(SERVICES)}')
+        result[name] = cast(value)
+    return result
+
+
+def start_fakes(latency_ms=None, error_rates=None):
+    latency_ms = {**DEFAULT_LATENCY_MS, **(latency_ms or {})}
+    error_rates = error_rates or {}
+    return {name: FakeService(name, latency_ms[name], error_rates.get(name, 0.0)).start() for name in SERVICES}
+
+
+def app_environment(fakes):
+    """Environment that points the API at the stand-ins"""
+    state_dir = tempfile.mkdtemp(prefix='bench-state-')
+    return {
+        'SUPABASE_URL': fakes['supabase'].url,
+        'SUPABASE_KEY': 'bench-anon',
+        'SUPABASE_SERVICE_KEY': 'bench-service',
+        'SUPABASE_JWT_SECRET': JWT_SECRET,
+        'OPENAI_API_KEY': 'bench-openai',
+        'OPENAI_BASE_URL': f"{fakes['openai'].url}/v1",
+        'HF_API_KEY': 'bench-hf',
+        'HF_API_BASE': fakes['hf'].url,
+        'INTASEND_SECRET_KEY': 'bench-intasend',
+        'INTASEND_API_BASE': f"{fakes['intasend'].url}/api/v1",
+        'ADMIN_API_KEY': 'bench-admin',
+        'FLASK_DEBUG': 'False',
+        # Load tests deliberately exceed per-user budgets; measure the API, not the limiter
+        'RATE_LIMIT_ENABLED': 'False',
+        'WEBHOOK_JOURNAL': os.path.join(state_dir, 'webhook_journal.sqlite3'),
+        'JOB_QUEUE_DB': os.path.join(state_dir, 'jobs.sqlite3'),
+        'ENTITLEMENT_STORE': os.path.join(state_dir, 'entitlements.sqlite3'),
+    }
+
+
+def serve_fakes(latency_ms, error_rates, ready):
+    """multiprocessing target: run the stand-ins in their own process and report their URLs"""
+    fakes = start_fakes(latency_ms, error_rates)
+    ready.put({name: fake.url for name, fake in fakes.items()})
+    threading.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--latency', help='per-service latency in ms, e.g. supabase=20,openai=400')
+    parser.add_argument('--errors', help='per-service error rate, e.g. openai=0.1')
+    args = parser.parse_args()
+
+    fakes = start_fakes(parse_service_map(args.latency), parse_service_map(args.errors))
+    for name, value in app_environment(fakes).items():
+        print(f'{name}={value}')
+    print('Serving; Ctrl-C to stop')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Throughput/latency load test of the real API against local stand-ins for every upstream.
+
+Usage:
+    cd backend && python benchmarks/loadtest.py [--duration 20] [--concurrency 32]
+        [--serving-mode sync|async] [--workers 2] [--routes modules,posts,chat]
+        [--latency supabase=20,openai=400] [--errors openai=0.1]
+
+Starts the fakes (benchmarks/fakes.py) in a child process, runs the app under
+gunicorn with gunicorn.conf.py pointed at them, drives a weighted mix of routes
+from --concurrency clients (each signed in as one of --users users), then reports
+req/s, p50/p95/p99 per route and overall, and upstream calls per request by service.
+Requires only requirements.txt on a plain Linux box.
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import jwt
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakes import JWT_SECRET, SERVICES, app_environment, parse_service_map, serve_fakes  # noqa: E402
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# name: (weight, method, path, json body); {n} is a random small id, {user} the caller's index
+ROUTES = {
+    'modules':       (10, 'GET', '/api/training/modules', None),
+    'module':        (5, 'GET', '/api/training/modules/{n}', None),
+    'progress':      (5, 'GET', '/api/training/progress', None),
+    'save-progress': (4, 'POST', '/api/training/progress', {'moduleId': '{n}', 'progress': 60}),
+    'complete':      (2, 'POST', '/api/training/modules/{n}/complete', None),
+    'posts':         (10, 'GET', '/api/community/posts', None),
+    'post':          (8, 'GET', '/api/community/posts/{n}', None),
+    'search':        (4, 'GET', '/api/community/search?q=vaccination outreach', None),
+    'stats':         (4, 'GET', '/api/community/stats', None),
+    'events':        (3, 'GET', '/api/community/events', None),
+    'profile':       (6, 'GET', '/api/users/profile', None),
+    'subscription':  (4, 'GET', '/api/payments/my-subscription', None),
+    'chat':          (3, 'POST', '/api/ai/chat', {'message': 'Tips for organising community outreach day {n}'}),
+    'subscribe':     (1, 'POST', '/api/payments/create-subscription', {'plan': 'basic'}),
+    'login':         (1, 'POST', '/api/auth/login', {'email': 'user{user}@example.org', 'password': 'bench'}),
+}
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _start_fakes(latency, errors):
+    ready = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=serve_fakes, args=(latency, errors, ready), daemon=True)
+    proc.start()
+    return proc, ready.get(timeout=30)
+
+
+def _start_app(port, urls, serving_mode, workers):
+    fakes = {name: type('Fake', (), {'url': url}) for name, url in urls.items()}
+    env = dict(os.environ, **app_environment(fakes),
+               PORT=str(port), SERVING_MODE=serving_mode, WEB_CONCURRENCY=str(workers))
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    for _ in range(150):
+        try:
+            requests.get(f'http://127.0.0.1:{port}/health', timeout=1)
+            return proc
+        except requests.RequestException:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('gunicorn did not start')
+
+
+def _tokens(users):
+    now = int(time.time())
+    return [
+        jwt.encode({'sub': f'user-{i}', 'aud': 'authenticated', 'iat': now, 'exp': now + 3600},
+                   JWT_SECRET, algorithm='HS256')
+        for i in range(users)
+    ]
+
+
+def _fill(value, n, user):
+    if isinstance(value, str):
+        filled = value.format(n=n, user=user)
+        return int(filled) if filled.isdigit() else filled
+    if isinstance(value, dict):
+        return {k: _fill(v, n, user) for k, v in value.items()}
+    return value
+
+
+def _drive(base_url, routes, tokens, concurrency, duration):
+    """Run clients until the deadline; returns [(route, seconds, status or None)]"""
+    names = list(routes)
+    weights = [routes[name][0] for name in names]
+    results = []
+    results_lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(index):
+        session = requests.Session()
+        rng = random.Random(index)
+        user = index % len(tokens)
+        headers = {'Authorization': f'Bearer {tokens[user]}'}
+        local = []
+        while time.monotonic() < deadline:
+            name = rng.choices(names, weights)[0]
+            _, method, path, body = routes[name]
+            n = rng.randint(1, 20)
+            start = time.perf_counter()
+            try:
+                resp = session.request(method, base_url + _fill(path, n, user), headers=headers,
+                                       json=_fill(body, n, user), timeout=60)
+                status = resp.status_code
+            except requests.RequestException:
+                status = None
+            local.append((name, time.perf_counter() - start, status))
+        with results_lock:
+            results.extend(local)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(client, range(concurrency)))
+    return results, time.perf_counter() - started
+
+
+def _percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def _row(label, samples, elapsed):
+    latencies = sorted(s[1] * 1000 for s in samples)
+    failed = sum(1 for s in samples if s[2] is None or s[2] >= 500)
+    rejected = sum(1 for s in samples if s[2] is not None and 400 <= s[2] < 500)
+    return (f"{label:<14} {len(samples):>7} {len(samples) / elapsed:>9.1f} "
+            f"{statistics.median(latencies):>9.1f} {_percentile(latencies, 0.95):>9.1f} "
+            f"{_percentile(latencies, 0.99):>9.1f} {rejected:>7} {failed:>7}")
+
+
+def _upstream_stats(urls, reset=False):
+    stats = {}
+    for name, url in urls.items():
+        resp = requests.post(f'{url}/__stats/reset') if reset else requests.get(f'{url}/__stats')
+        stats[name] = resp.json()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--duration', type=float, default=20, help='seconds of measured load')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds of unmeasured load first')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--serving-mode', choices=('sync', 'async'), default='sync')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--routes', help=f"comma-separated subset of: {', '.join(ROUTES)}")
+    parser.add_argument('--latency', help='per-service latency in ms, e.g. supabase=20,openai=400')
+    parser.add_argument('--errors', help='per-service error rate 0-1, e.g. openai=0.1')
+    parser.add_argument('--verbose', action='store_true', help='print upstream calls per route')
+    args = parser.parse_args()
+
+    routes = ROUTES
+    if args.routes:
+        unknown = set(args.routes.split(',')) - set(ROUTES)
+        if unknown:
+            parser.error(f"unknown routes: {', '.join(sorted(unknown))}")
+        routes = {name: ROUTES[name] for name in args.routes.split(',')}
+
+    fakes_proc, urls = _start_fakes(parse_service_map(args.latency), parse_service_map(args.errors))
+    port = _free_port()
+    app_proc = _start_app(port, urls, args.serving_mode, args.workers)
+    base_url = f'http://127.0.0.1:{port}'
+    tokens = _tokens(args.users)
+
+    try:
+        if args.warmup:
+            _drive(base_url, routes, tokens, args.concurrency, args.warmup)
+        _upstream_stats(urls, reset=True)
+        results, elapsed = _drive(base_url, routes, tokens, args.concurrency, args.duration)
+        upstream = _upstream_stats(urls)
+    finally:
+        app_proc.terminate()
+        app_proc.wait()
+        fakes_proc.terminate()
+
+    print(f"{args.serving_mode} x{args.workers} workers, concurrency {args.concurrency}, "
+          f"{elapsed:.1f}s, {len(routes)} routes")
+    print(f"{'route':<14} {'requests':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'4xx':>7} {'failed':>7}")
+    for name in routes:
+        samples = [r for r in results if r[0] == name]
+        if samples:
+            print(_row(name, samples, elapsed))
+    print(_row('TOTAL', results, elapsed))
+
+    print('\nupstream calls per request')
+    for name in SERVICES:
+        total = upstream[name]['total']
+        print(f"  {name:<9} {total / max(len(results), 1):6.2f}  ({total} calls)")
+        if args.verbose:
+            for label, count in sorted(upstream[name]['by_route'].items(), key=lambda item: -item[1]):
+                print(f"      {count:>7}  {label}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Gunicorn configuration for the HealthGuide Community API.
+
+SERVING_MODE=sync  (default) classic pre-fork workers, one request per worker thread
+SERVING_MODE=async gevent workers: sockets are cooperative, so every upstream call
+                   (Supabase, OpenAI, Hugging Face, IntaSend) yields while it waits
+                   and one process can hold hundreds of in-flight requests
+
+Prometheus metrics from every worker are aggregated through PROMETHEUS_MULTIPROC_DIR
+(a fresh temp dir unless set), so /metrics reports the whole server whichever worker
+answers the scrape.
+
+Usage: cd backend && gunicorn -c gunicorn.conf.py app:app
+"""
+
+import glob
+import os
+import tempfile
+
+SERVING_MODE = os.getenv('SERVING_MODE', 'sync').lower()
+
+# Worker count comes from WEB_CONCURRENCY / --workers as before
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+
+if SERVING_MODE == 'async':
+    worker_class = 'gevent'
+    worker_connections = int(os.getenv('WORKER_CONNECTIONS', 1000))
+    # Each in-flight request may hold an upstream socket; size the pool to match
+    os.environ.setdefault('HTTP_POOL_SIZE', str(worker_connections))
+else:
+    worker_class = 'sync'
+
+# Must be set before the app (and prometheus_client) is imported in the workers
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', tempfile.mkdtemp(prefix='healthguide-metrics-'))
+
+
+def on_starting(server):
+    # Samples left by a previous run would otherwise be summed into this one
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, '*.db')):
+        os.remove(path)
+
+
+def child_exit(server, worker):
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,33 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py reads its configuration at import time: keep stores out of the tree and
+# every background thread and upstream switched off before it is imported
+os.environ.update(
+    DATA_DIR=tempfile.mkdtemp(prefix='health-dev-tests-'),
+    SUPABASE_URL='http://supabase.invalid',
+    SUPABASE_KEY='test-anon',
+    SUPABASE_SERVICE_KEY='test-service',
+    SUPABASE_JWT_SECRET='test-secret-test-secret-test-secret',
+    SEARCH_INDEX_ENABLED='False',
+    RATE_LIMIT_ENABLED='False',
+    METRICS_ENABLED='False',
+    TRACING_ENABLED='False',
+    FLASK_DEBUG='False',
+    INTASEND_WEBHOOK_CHALLENGE='test-challenge',
+)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as backend  # noqa: E402
+
+# Tests drive the journal consumer and job queue directly; don't let requests start threads
+backend._webhook_consumer_pid = os.getpid()
+backend._job_runner_pid = os.getpid()
+
+
+@pytest.fixture
+def app_module():
+    return backend
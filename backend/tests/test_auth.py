@@ -0,0 +1,17 @@
+import time
+
+import jwt
+
+
+def test_introspected_token_is_cached_no_longer_than_its_exp(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'SUPABASE_JWT_SECRET', None)  # forces remote introspection
+    calls = []
+    monkeypatch.setattr(app_module, '_introspect_token_remotely', lambda token: calls.append(token) or 'user-1')
+    now = int(time.time())
+    token = jwt.encode({'sub': 'user-1', 'iat': now, 'exp': now + 2}, 'elsewhere-secret-elsewhere-secret', algorithm='HS256')
+
+    assert app_module.resolve_token_user(token) == 'user-1'
+    _, expires_at = app_module._token_cache._data[app_module._token_key(token)]
+    assert expires_at - time.monotonic() <= 2
+    assert app_module.resolve_token_user(token) == 'user-1'
+    assert len(calls) == 1
@@ -0,0 +1,35 @@
+import json
+
+POST = {'id': 1, 'title': 'Malaria', 'content': 'x' * 500, 'updated_at': '2025-06-01T10:00:00+00:00',
+        'profiles': {'name': 'Amina', 'location': 'Kisumu'}}
+
+
+def _etag(app_module, payload, **headers):
+    with app_module.app.test_request_context(headers=headers):
+        response = app_module.conditional_rows_json(payload)
+        return response.status_code, response.get_etag()[0], response.get_data()
+
+
+def test_unchanged_rows_answer_304_without_a_body(app_module):
+    _, etag, body = _etag(app_module, {'posts': [POST]})
+    assert json.loads(body) == {'posts': [POST]}
+
+    status, _, body = _etag(app_module, {'posts': [POST]}, **{'If-None-Match': f'"{etag}"'})
+    assert status == 304 and body == b''
+
+
+def test_tag_follows_row_versions_not_row_text(app_module):
+    _, etag, _ = _etag(app_module, {'posts': [POST]})
+    assert _etag(app_module, {'posts': [{**POST, 'content': 'same version'}]})[1] == etag
+    assert _etag(app_module, {'posts': [{**POST, 'updated_at': '2025-06-02T00:00:00+00:00'}]})[1] != etag
+
+
+def test_embeds_and_list_shape_change_the_tag(app_module):
+    _, etag, _ = _etag(app_module, {'posts': [POST, {**POST, 'id': 2}]})
+    renamed = {**POST, 'profiles': {'name': 'Amina W.', 'location': 'Kisumu'}}
+    assert _etag(app_module, {'posts': [renamed, {**POST, 'id': 2}]})[1] != etag
+    assert _etag(app_module, {'posts': [POST]})[1] != etag
+
+
+def test_unversioned_payload_hashes_the_body(app_module):
+    assert _etag(app_module, {'status': 'free'})[1] != _etag(app_module, {'status': 'active'})[1]
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+
+def _sub(n, status, days=30):
+    expires = datetime.now(timezone.utc) + timedelta(days=days)
+    return {'id': n, 'status': status, 'plan': 'B0X2DK5', 'expires_at': expires.isoformat(),
+            'created_at': f'2025-06-{n:02d}T00:00:00+00:00'}
+
+
+@pytest.fixture
+def upstream(app_module, tmp_path, monkeypatch):
+    """Fake subscriptions table, newest first, and the queries sent to it"""
+    state = {'rows': [], 'queries': []}
+
+    def fake_request(method, endpoint, data=None, **kwargs):
+        state['queries'].append(endpoint)
+        rows = state['rows']
+        if 'status=eq.active' in endpoint:
+            rows = [row for row in rows if row['status'] == 'active']
+        limit = int(endpoint.rsplit('limit=', 1)[1])
+        return rows[:limit]
+
+    monkeypatch.setattr(app_module, 'supabase_request', fake_request)
+    monkeypatch.setattr(app_module, 'entitlement_versions',
+                        app_module.EntitlementVersions(str(tmp_path / 'entitlements.sqlite3')))
+    app_module._entitlement_cache.clear()
+    yield state
+    app_module._entitlement_cache.clear()
+
+
+def test_entitlement_is_served_from_cache(app_module, upstream):
+    upstream['rows'] = [_sub(1, 'active')]
+    assert app_module.get_entitlement('user-1')['plan'] == 'premium'
+    queries = len(upstream['queries'])
+
+    assert app_module.get_entitlement('user-1')['status'] == 'active'
+    assert len(upstream['queries']) == queries
+
+
+def test_bump_from_another_worker_makes_the_cache_stale(app_module, upstream):
+    upstream['rows'] = [_sub(1, 'active')]
+    assert app_module.get_entitlement('user-1')['status'] == 'active'
+
+    # Another worker cancels: only the shared counter moves, this worker's cache is untouched
+    upstream['rows'] = [_sub(2, 'cancelled')]
+    app_module.entitlement_versions.bump('user-1')
+
+    entitlement = app_module.get_entitlement('user-1')
+    assert entitlement['status'] == 'inactive' and entitlement['plan'] == 'free'
+    assert entitlement['latest_subscription']['id'] == 2
+
+
+def test_active_plan_behind_a_long_history_is_found(app_module, upstream):
+    upstream['rows'] = [_sub(n, 'pending') for n in range(28, 3, -1)] + [_sub(3, 'active')]
+
+    entitlement = app_module.get_entitlement('user-1')
+    assert entitlement['status'] == 'active'
+    assert entitlement['active_subscription']['id'] == 3
+    assert entitlement['latest_subscription']['id'] == 28
+
+
+def test_expired_active_row_is_not_an_entitlement(app_module, upstream):
+    upstream['rows'] = [_sub(1, 'active', days=-1)]
+    assert app_module.get_entitlement('user-1')['status'] == 'inactive'
+
+
+def test_unreachable_supabase_is_not_cached(app_module, upstream, monkeypatch):
+    monkeypatch.setattr(app_module, 'supabase_request', lambda *args, **kwargs: None)
+    assert app_module.get_entitlement('user-1') is None
+    assert app_module._entitlement_cache.get('user-1') is None
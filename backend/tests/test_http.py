@@ -0,0 +1,53 @@
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+
+@pytest.fixture
+def upstream():
+    """Local server: /slow stalls past the client timeout, /reset drops its first connection"""
+    hits = {'/slow': 0, '/reset': 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            hits[self.path] += 1
+            if self.path == '/reset' and hits['/reset'] == 1:
+                self.connection.shutdown(socket.SHUT_RDWR)
+                self.close_connection = True
+                return
+            if self.path == '/slow':
+                time.sleep(0.6)
+            try:
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'ok')
+            except OSError:
+                pass  # the client gave up waiting
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}', hits
+    server.shutdown()
+
+
+def test_read_timeout_is_not_retried(app_module, upstream):
+    base, hits = upstream
+    with pytest.raises(requests.exceptions.Timeout):
+        app_module._build_http_session().get(f'{base}/slow', timeout=0.2)
+    assert hits['/slow'] == 1
+
+
+def test_dropped_connection_is_retried(app_module, upstream):
+    base, hits = upstream
+    resp = app_module._build_http_session().get(f'{base}/reset', timeout=2)
+    assert resp.text == 'ok' and hits['/reset'] == 2
@@ -0,0 +1,148 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def queue(app_module, tmp_path):
+    return app_module.JobQueue(str(tmp_path / 'jobs.sqlite3'))
+
+
+def _make_due(queue):
+    with queue._conn() as conn:
+        conn.execute("UPDATE jobs SET next_attempt_at = 0")
+
+
+class TestJobQueue:
+    def test_pending_dedupe_key_is_enqueued_once(self, queue):
+        assert queue.enqueue('upsert_profile', {'n': 1}, dedupe_key='profile:u1')
+        assert not queue.enqueue('upsert_profile', {'n': 2}, dedupe_key='profile:u1')
+        assert queue.enqueue('upsert_profile', {'n': 3})
+        assert queue.stats()['pending'] == {'upsert_profile': 2}
+
+    def test_claim_leases_jobs_oldest_first(self, queue):
+        queue.enqueue('a', {'n': 1})
+        queue.enqueue('b', {'n': 2})
+
+        first = queue.claim(1)
+        assert [(job['kind'], job['payload'], job['attempts']) for job in first] == [('a', {'n': 1}, 0)]
+        assert [job['kind'] for job in queue.claim(5)] == ['b']
+        assert queue.claim(5) == []  # both leased
+
+    def test_expired_lease_is_claimable_again(self, queue):
+        queue.enqueue('a', {})
+        queue.claim(1)
+        with queue._conn() as conn:
+            conn.execute("UPDATE jobs SET claimed_until = ?", (time.time() - 1,))
+        assert len(queue.claim(1)) == 1
+
+    def test_complete_removes_the_job(self, queue):
+        queue.enqueue('a', {})
+        queue.complete(queue.claim(1)[0])
+        assert queue.stats() == {'pending': {}, 'dead': 0, 'recent_dead': []}
+
+    def test_fail_backs_off_then_dead_letters(self, app_module, queue, monkeypatch):
+        monkeypatch.setattr(app_module, 'JOB_MAX_ATTEMPTS', 3)
+        queue.enqueue('a', {}, dedupe_key='k')
+
+        assert queue.fail(queue.claim(1)[0], 'boom 1') is False
+        assert queue.claim(1) == []  # backing off
+        _make_due(queue)
+        job = queue.claim(1)[0]
+        assert job['attempts'] == 1
+        assert queue.fail(job, 'boom 2') is False
+        _make_due(queue)
+        assert queue.fail(queue.claim(1)[0], 'boom 3') is True
+
+        _make_due(queue)
+        assert queue.claim(1) == []
+        stats = queue.stats()
+        assert stats['dead'] == 1
+        assert stats['recent_dead'][0]['attempts'] == 3
+        assert stats['recent_dead'][0]['last_error'] == 'boom 3'
+        # A dead job no longer holds its dedupe key
+        assert queue.enqueue('a', {}, dedupe_key='k')
+
+    def test_retry_dead_requeues_with_fresh_attempts(self, app_module, queue, monkeypatch):
+        monkeypatch.setattr(app_module, 'JOB_MAX_ATTEMPTS', 1)
+        queue.enqueue('a', {})
+        queue.fail(queue.claim(1)[0], 'boom')
+
+        assert queue.retry_dead() == 1
+        job = queue.claim(1)[0]
+        assert job['attempts'] == 0
+
+    def test_retry_dead_drops_letters_whose_key_is_pending_again(self, app_module, queue, monkeypatch):
+        monkeypatch.setattr(app_module, 'JOB_MAX_ATTEMPTS', 1)
+        queue.enqueue('a', {'n': 1}, dedupe_key='k')
+        queue.enqueue('b', {})
+        for job in queue.claim(5):
+            queue.fail(job, 'boom')
+        queue.enqueue('a', {'n': 2}, dedupe_key='k')  # a newer job for the same key
+
+        assert queue.retry_dead() == 1
+        assert queue.stats()['dead'] == 0
+        assert sorted((job['kind'], job['payload']) for job in queue.claim(5)) == [('a', {'n': 2}), ('b', {})]
+
+
+class TestIntaSendCustomer:
+    @pytest.fixture
+    def upstream(self, app_module, monkeypatch):
+        state = {'stored': None, 'created': [], 'patches': []}
+
+        def fake_request(method, endpoint, data=None, **kwargs):
+            if method == 'GET':
+                return [{'intasend_customer_id': state['stored']}]
+            state['patches'].append(endpoint)
+            if state['stored'] is None:
+                state['stored'] = data['intasend_customer_id']
+                return [{'id': 'user-1'}]
+            return []  # intasend_customer_id=is.null matched nothing
+
+        def fake_create(user_id):
+            state['created'].append(user_id)
+            return f"cus_{len(state['created'])}"
+
+        monkeypatch.setattr(app_module, 'supabase_request', fake_request)
+        monkeypatch.setattr(app_module, 'create_intasend_customer', fake_create)
+        return state
+
+    def test_first_checkout_creates_and_stores_conditionally(self, app_module, upstream):
+        assert app_module.ensure_intasend_customer('user-1') == 'cus_1'
+        assert upstream['patches'] == ['profiles?id=eq.user-1&intasend_customer_id=is.null']
+
+    def test_stored_customer_is_reused(self, app_module, upstream):
+        upstream['stored'] = 'cus_existing'
+        assert app_module.ensure_intasend_customer('user-1') == 'cus_existing'
+        assert upstream['created'] == []
+
+    def test_losing_a_race_uses_the_stored_customer(self, app_module, upstream, monkeypatch):
+        real_create = app_module.create_intasend_customer
+
+        def racing_create(user_id):
+            upstream['stored'] = 'cus_other_worker'  # stored while ours was being created
+            return real_create(user_id)
+
+        monkeypatch.setattr(app_module, 'create_intasend_customer', racing_create)
+        assert app_module.ensure_intasend_customer('user-1') == 'cus_other_worker'
+
+
+def test_profile_missing_after_login_is_created_inline(app_module, monkeypatch):
+    written = []
+    rows = []
+
+    def fake_request(method, endpoint, data=None, **kwargs):
+        if method == 'POST':
+            written.extend(data)
+            rows.extend(data)
+            return []
+        return list(rows)
+
+    monkeypatch.setattr(app_module, 'supabase_request', fake_request)
+    monkeypatch.setattr(app_module, 'fetch_auth_user', lambda token: {
+        'id': 'user-1', 'user_metadata': {'name': 'Amina', 'location': 'Kisumu'}
+    })
+
+    profile = app_module.create_missing_profile('user-1', 'token')
+    assert profile == {'id': 'user-1', 'name': 'Amina', 'location': 'Kisumu', 'role': 'health_worker'}
+    assert written == [profile]
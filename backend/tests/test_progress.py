@@ -0,0 +1,130 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import jwt
+import pytest
+
+NOW = datetime(2025, 6, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def _auth(app_module, user_id='user-1'):
+    now = int(time.time())
+    token = jwt.encode(
+        {'sub': user_id, 'aud': 'authenticated', 'iat': now, 'exp': now + 600},
+        app_module.SUPABASE_JWT_SECRET, algorithm='HS256'
+    )
+    return {'Authorization': f'Bearer {token}'}
+
+
+class TestParseClientTimestamp:
+    def test_epoch_milliseconds(self, app_module):
+        stamp = app_module._parse_client_timestamp(1700000000000, NOW)
+        assert stamp == datetime(2023, 11, 14, 22, 13, 20, tzinfo=timezone.utc)
+
+    def test_iso_string_without_zone_is_utc(self, app_module):
+        stamp = app_module._parse_client_timestamp('2025-05-01T08:30:00', NOW)
+        assert stamp == datetime(2025, 5, 1, 8, 30, tzinfo=timezone.utc)
+
+    def test_missing_means_now(self, app_module):
+        assert app_module._parse_client_timestamp(None, NOW) == NOW
+
+    def test_future_is_clamped_to_now(self, app_module):
+        future = (NOW + timedelta(days=30)).isoformat()
+        assert app_module._parse_client_timestamp(future, NOW) == NOW
+
+    @pytest.mark.parametrize('value', [
+        10 ** 30, -10 ** 30, float('inf'), float('nan'), 'yesterday', True, [1], {'ms': 1}
+    ])
+    def test_rejects_unusable_values(self, app_module, value):
+        with pytest.raises(ValueError, match='Invalid clientTimestamp'):
+            app_module._parse_client_timestamp(value, NOW)
+
+
+class TestModuleId:
+    @pytest.mark.parametrize('value', [7, '7', 7.0])
+    def test_accepts_integers(self, app_module, value):
+        assert app_module._module_id(value) == 7
+
+    @pytest.mark.parametrize('value', ['1)', '1,2', 1.5, True, None, 'abc'])
+    def test_rejects_everything_else(self, app_module, value):
+        with pytest.raises(ValueError):
+            app_module._module_id(value)
+
+
+def test_partial_progress_leaves_completion_alone(app_module):
+    row = app_module._progress_row('user-1', 3, 40, NOW.isoformat())
+    assert 'completed' not in row and 'completed_at' not in row
+
+    done = app_module._progress_row('user-1', 3, 100, NOW.isoformat())
+    assert done['completed'] is True and done['completed_at'] == NOW.isoformat()
+
+
+class TestProgressBatch:
+    @pytest.fixture
+    def upstream(self, app_module, monkeypatch):
+        calls = {'get': [], 'upsert': []}
+
+        def fake_request(method, endpoint, *args, **kwargs):
+            calls['get'].append(endpoint)
+            return [{'module_id': 2, 'updated_at': '2025-06-01T11:00:00+00:00'}]
+
+        def fake_upsert(table, rows, on_conflict):
+            calls['upsert'].append(rows)
+            return rows
+
+        monkeypatch.setattr(app_module, 'supabase_request', fake_request)
+        monkeypatch.setattr(app_module, 'supabase_upsert', fake_upsert)
+        return calls
+
+    def test_rejects_non_integer_module_id(self, app_module, upstream):
+        client = app_module.app.test_client()
+        resp = client.post('/api/training/progress/batch', headers=_auth(app_module), json={
+            'entries': [{'moduleId': '1),user_id.neq.(x', 'progress': 10}]
+        })
+        assert resp.status_code == 400
+        assert upstream['get'] == [] and upstream['upsert'] == []
+
+    def test_string_and_int_ids_are_one_module(self, app_module, upstream):
+        client = app_module.app.test_client()
+        resp = client.post('/api/training/progress/batch', headers=_auth(app_module), json={'entries': [
+            {'moduleId': '1', 'progress': 20, 'clientTimestamp': '2025-06-01T10:00:00Z'},
+            {'moduleId': 1, 'progress': 30, 'clientTimestamp': '2025-06-01T10:05:00Z'},
+        ]})
+        assert resp.status_code == 200
+        assert [r['status'] for r in resp.json['results']] == ['superseded', 'applied']
+        assert upstream['upsert'] == [[{
+            'user_id': 'user-1', 'module_id': 1, 'score': 30, 'updated_at': '2025-06-01T10:05:00+00:00'
+        }]]
+        assert 'module_id=in.(1)' in upstream['get'][0]
+
+    def test_completions_and_partial_progress_upsert_separately(self, app_module, upstream):
+        client = app_module.app.test_client()
+        resp = client.post('/api/training/progress/batch', headers=_auth(app_module), json={'entries': [
+            {'moduleId': 4, 'progress': 100, 'clientTimestamp': '2025-06-01T10:00:00Z'},
+            {'moduleId': 5, 'progress': 50, 'clientTimestamp': '2025-06-01T10:00:00Z'},
+            # older than the stored row for module 2
+            {'moduleId': 2, 'progress': 70, 'clientTimestamp': '2025-06-01T10:00:00Z'},
+        ]})
+        assert [r['status'] for r in resp.json['results']] == ['applied', 'applied', 'stale']
+        assert sorted(len(rows[0]) for rows in upstream['upsert']) == [4, 6]
+
+
+def test_progress_write_creates_a_missing_profile_and_retries(app_module, monkeypatch):
+    profiles = []
+    upserts = []
+
+    def fake_upsert(table, rows, on_conflict):
+        upserts.append(rows)
+        return rows if profiles else None  # user_progress -> profiles foreign key
+
+    def fake_create(user_id, user_token):
+        profiles.append(user_id)
+        return {'id': user_id}
+
+    monkeypatch.setattr(app_module, 'supabase_upsert', fake_upsert)
+    monkeypatch.setattr(app_module, 'create_missing_profile', fake_create)
+
+    client = app_module.app.test_client()
+    resp = client.post('/api/training/modules/3/complete', headers=_auth(app_module))
+    assert resp.status_code == 200
+    assert profiles == ['user-1'] and len(upserts) == 2
@@ -0,0 +1,73 @@
+import math
+import random
+
+import pytest
+
+WORDS = ['malaria', 'vaccine', 'vaccination', 'vaccinated', 'child', 'nutrition', 'cholera', 'water', 'clinic']
+
+
+@pytest.fixture
+def index(app_module, monkeypatch):
+    # Small lists, so a few hundred posts exercise the impact-ordered walk
+    monkeypatch.setattr(app_module.ForumSearchIndex, 'SMALL_POSTINGS', 8)
+    index = app_module.ForumSearchIndex()
+    rng = random.Random(3)
+    for post_id in range(1, 301):
+        index.add(_post(rng, post_id))
+    return index
+
+
+def _post(rng, post_id):
+    return {'id': post_id, 'title': ' '.join(rng.choices(WORDS, k=rng.randint(1, 4))),
+            'content': ' '.join(rng.choices(WORDS + [f'w{n}' for n in range(50)], k=rng.randint(5, 40)))}
+
+
+def _exhaustive(index, query, terms):
+    """{post id: score}, scoring every posting of every term as search() did before pruning"""
+    tokens = index.tokenize(query)
+    n_docs = len(index._docs)
+    avg_length = index._total_length / n_docs
+    scores = {}
+    for term in terms:
+        postings = index._postings[term]
+        idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5)) * (1.0 if term in tokens else 0.5)
+        for post_id, freq in postings.items():
+            scores[post_id] = scores.get(post_id, 0.0) + idf * index._term_score(freq, index._docs[post_id][2], avg_length)
+    return scores
+
+
+def _assert_exact_top(index, query, limit=20):
+    results = index.search(query, limit=limit)
+    scores = _exhaustive(index, query, results[0][1])
+    assert [scores[post['id']] for post, _ in results] == pytest.approx(sorted(scores.values(), reverse=True)[:limit])
+    return results
+
+
+@pytest.mark.parametrize('query', ['malaria', 'child nutrition', 'cholera water clinic', 'vacc', 'child vacc'])
+def test_pruned_search_matches_exhaustive_scoring(index, query):
+    _assert_exact_top(index, query)
+
+
+def test_impact_lists_follow_adds_and_removes(app_module, index):
+    index.search('malaria child')  # builds the impact lists that adds and removes must now maintain
+    rng = random.Random(4)
+    for post_id in range(1, 60):
+        index.remove(post_id)
+    for post_id in range(301, 340):
+        index.add(_post(rng, post_id))
+    index.add({'id': 100, 'title': 'malaria malaria child', 'content': 'malaria'})
+
+    for term, impacts in index._impacts.items():
+        assert sorted(post_id for _, post_id in impacts) == sorted(index._postings[term])
+    assert _assert_exact_top(index, 'malaria child')[0][0]['id'] == 100
+
+
+def test_prefix_expansion_postings_are_capped(app_module, monkeypatch):
+    monkeypatch.setattr(app_module.ForumSearchIndex, 'MAX_PREFIX_POSTINGS', 5)
+    index = app_module.ForumSearchIndex()
+    for post_id in range(1, 11):
+        index.add({'id': post_id, 'title': f'vacc{post_id % 3} outreach', 'content': ''})
+
+    # The most frequent expansion (vacc1, 4 posts) fits; vacc0 and vacc2 (3 each) no longer do
+    _, terms = index.search('vacc')[0]
+    assert terms == ['vacc1']
@@ -0,0 +1,145 @@
+import json
+import time
+
+import pytest
+
+
+@pytest.fixture
+def journal(app_module, tmp_path, monkeypatch):
+    journal = app_module.WebhookJournal(str(tmp_path / 'webhooks.sqlite3'))
+    monkeypatch.setattr(app_module, 'webhook_journal', journal)
+    monkeypatch.setattr(app_module, 'invalidate_entitlement', lambda user_id: None)
+    return journal
+
+
+@pytest.fixture
+def patches(app_module, monkeypatch):
+    """PATCHes sent to Supabase, as (status, endpoint)"""
+    sent = []
+
+    def fake_request(method, endpoint, data=None, **kwargs):
+        sent.append((data['status'], endpoint))
+        return [{'user_id': 'user-1'}]
+
+    monkeypatch.setattr(app_module, 'supabase_request', fake_request)
+    return sent
+
+
+def _deliver(journal, event_id, sub_id, status, updated_at=None):
+    data = {'subscription_id': sub_id, 'status': status}
+    if updated_at:
+        data['updated_at'] = updated_at
+    assert journal.append({'event_id': event_id, 'data': data}, data, sub_id, status)
+
+
+def _states(journal):
+    rows = journal._conn().execute("SELECT event_key, state FROM webhook_events ORDER BY id").fetchall()
+    return {key.split(':', 1)[1]: state for key, state in rows}
+
+
+class TestApplyOrdering:
+    def test_newest_timestamp_wins_within_a_batch(self, app_module, journal, patches):
+        _deliver(journal, 'e1', 'sub_1', 'CANCELLED', '2025-06-01T10:05:00Z')
+        _deliver(journal, 'e2', 'sub_1', 'ACTIVE', '2025-06-01T10:00:00Z')
+
+        app_module.apply_webhook_events(journal.claim(10))
+
+        assert [status for status, _ in patches] == ['cancelled']
+        assert _states(journal) == {'e1': 'applied', 'e2': 'superseded'}
+
+    def test_same_status_is_one_patch(self, app_module, journal, patches):
+        _deliver(journal, 'e1', 'sub_1', 'ACTIVE', '2025-06-01T10:00:00Z')
+        _deliver(journal, 'e2', 'sub_2', 'ACTIVE', '2025-06-01T10:00:00Z')
+
+        app_module.apply_webhook_events(journal.claim(10))
+
+        assert patches == [('active', 'subscriptions?intasend_subscription_id=in.("sub_1","sub_2")')]
+
+    def test_late_retry_of_older_event_is_skipped(self, app_module, journal, patches):
+        _deliver(journal, 'e1', 'sub_1', 'CANCELLED', '2025-06-01T10:05:00Z')
+        app_module.apply_webhook_events(journal.claim(10))
+        _deliver(journal, 'e2', 'sub_1', 'ACTIVE', '2025-06-01T10:00:00Z')
+        app_module.apply_webhook_events(journal.claim(10))
+
+        assert [status for status, _ in patches] == ['cancelled']
+        assert _states(journal)['e2'] == 'superseded'
+
+    def test_event_without_timestamp_orders_by_arrival(self, app_module, journal, patches):
+        _deliver(journal, 'e1', 'sub_1', 'ACTIVE', '2025-06-01T10:00:00Z')
+        app_module.apply_webhook_events(journal.claim(10))
+        _deliver(journal, 'e2', 'sub_1', 'CANCELLED')
+        app_module.apply_webhook_events(journal.claim(10))
+
+        assert [status for status, _ in patches] == ['active', 'cancelled']
+        assert _states(journal) == {'e1': 'applied', 'e2': 'applied'}
+
+    def test_timestamps_compare_across_offsets(self, app_module, journal, patches):
+        # 12:00+03:00 is 09:00Z, so it is older despite sorting later as a raw string
+        _deliver(journal, 'e1', 'sub_1', 'CANCELLED', '2025-06-01T10:00:00Z')
+        _deliver(journal, 'e2', 'sub_1', 'ACTIVE', '2025-06-01T12:00:00+03:00')
+
+        app_module.apply_webhook_events(journal.claim(10))
+
+        assert [status for status, _ in patches] == ['cancelled']
+
+    def test_failed_patch_backs_off(self, app_module, journal, monkeypatch):
+        monkeypatch.setattr(app_module, 'supabase_request', lambda *args, **kwargs: None)
+        _deliver(journal, 'e1', 'sub_1', 'ACTIVE')
+
+        app_module.apply_webhook_events(journal.claim(10))
+
+        assert _states(journal) == {'e1': 'pending'}
+        assert journal.claim(10) == []  # not due yet
+
+
+class TestLeases:
+    def test_expired_claim_cannot_overwrite_new_owner(self, app_module, journal):
+        _deliver(journal, 'e1', 'sub_1', 'ACTIVE', '2025-06-01T10:00:00Z')
+        stale = journal.claim(10)
+        with journal._conn() as conn:
+            conn.execute("UPDATE webhook_events SET claimed_until = ?", (time.time() - 1,))
+        fresh = journal.claim(10)
+        assert fresh and fresh[0]['claimed_by'] != stale[0]['claimed_by']
+
+        journal.mark(stale, 'superseded')
+        journal.record_applied(stale)
+        assert _states(journal) == {'e1': 'pending'}
+        assert journal.last_applied(['sub_1']) == {}
+
+        journal.record_applied(fresh)
+        assert _states(journal) == {'e1': 'applied'}
+        assert journal.last_applied(['sub_1'])['sub_1'][1] == fresh[0]['id']
+
+
+class TestEndpoint:
+    def _post(self, app_module, body, **kwargs):
+        return app_module.app.test_client().post(
+            '/api/payments/webhook', data=json.dumps(body), content_type='application/json', **kwargs
+        )
+
+    def test_wrong_challenge_is_not_journaled(self, app_module, journal):
+        resp = self._post(app_module, {'challenge': 'guess', 'data': {'subscription_id': 's', 'status': 'ACTIVE'}})
+        assert resp.status_code == 401
+        assert journal.stats()['pending'] == 0
+
+    def test_unconfigured_challenge_refuses_everything(self, app_module, journal, monkeypatch):
+        monkeypatch.setattr(app_module, 'INTASEND_WEBHOOK_CHALLENGE', None)
+        resp = self._post(app_module, {'challenge': '', 'data': {'subscription_id': 's', 'status': 'ACTIVE'}})
+        assert resp.status_code == 503
+
+    def test_oversized_body_is_refused(self, app_module, journal):
+        resp = self._post(app_module, {
+            'challenge': 'test-challenge', 'data': {'subscription_id': 's', 'status': 'ACTIVE'},
+            'padding': 'x' * app_module.WEBHOOK_MAX_BYTES
+        })
+        assert resp.status_code == 413
+        assert journal.stats()['pending'] == 0
+
+    def test_valid_delivery_is_journaled_once_without_the_secret(self, app_module, journal):
+        body = {'challenge': 'test-challenge', 'event_id': 'evt_1',
+                'data': {'subscription_id': 'sub_1', 'status': 'ACTIVE'}}
+        assert self._post(app_module, body).json == {'ok': True, 'duplicate': False}
+        assert self._post(app_module, body).json == {'ok': True, 'duplicate': True}
+
+        payload = journal._conn().execute("SELECT payload FROM webhook_events").fetchone()[0]
+        assert 'challenge' not in json.loads(payload)
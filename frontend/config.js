@@ -357,6 +357,8 @@ const API = {
 
   async logout() {
     try {
+      // Let the backend drop its cached token verification (best effort)
+      await this.post("/auth/logout").catch(() => {});
       UTILS.removeFromLocal("auth_token");
       UTILS.removeFromLocal("user_data");
       UTILS.showNotification("Successfully logged out!", "success");
@@ -453,6 +455,17 @@ async getProgress() {
   }
 },
 
+// Sync many offline progress entries in one request:
+// entries = [{ moduleId, progress, clientTimestamp }]
+async syncProgressBatch(entries) {
+  try {
+    return await this.post("/training/progress/batch", { entries });
+  } catch (error) {
+    console.error("Failed to sync progress batch:", error);
+    throw error;
+  }
+},
+
 // ✅ FIXED: define markModuleComplete as a method, not assignment
 async markModuleComplete(moduleId, moduleTitle = "Module") {
   const token = UTILS.getFromLocal("auth_token");
@@ -57,6 +57,11 @@ FLASK_DEBUG=True
 SUPABASE_URL=https://your-project.supabase.co
 SUPABASE_KEY=your-supabase-anon-key-here
 SUPABASE_SERVICE_KEY=your-supabase-service-role-key-here
+# JWT secret (Settings > API) lets the backend verify access tokens locally
+SUPABASE_JWT_SECRET=your-supabase-jwt-secret-here
+TOKEN_CACHE_TTL=300
+# Local SQLite stores (token revocations, webhook journal, jobs...) default to backend/instance
+# DATA_DIR=/var/lib/health-development
 
 # Intrasend Payment Configuration
 INTRASEND_TOKEN=your-intrasend-secret-token-here
@@ -66,6 +71,23 @@ INTRASEND_TEST_MODE=True
 # AI Configuration (Hugging Face)
 HF_API_KEY=your-huggingface-api-key-here
 
+# AI response cache (set AI_CACHE_DB, a file under DATA_DIR, to share answers across workers/restarts)
+AI_CACHE_SIZE=1000
+AI_CACHE_TTL=86400
+AI_CACHE_DB=ai_cache.sqlite3
+
+# Admin endpoints (/api/admin/*) require this in the X-Admin-Key header
+ADMIN_API_KEY=change-this-admin-key
+
+# Prometheus /metrics; leave METRICS_TOKEN empty to allow unauthenticated scrapes
+METRICS_ENABLED=True
+METRICS_TOKEN=
+
+# Requests slower than SLOW_REQUEST_MS are logged as JSON lines to this rotating
+# file under DATA_DIR (SLOW_REQUEST_LOG=- sends them to stderr instead)
+SLOW_REQUEST_MS=1000
+SLOW_REQUEST_LOG=slow_requests.log
+
 # App Configuration
 APP_URL=http://localhost:3000
 API_URL=http://localhost:5000
@@ -76,9 +98,34 @@ SMTP_PORT=587
 SMTP_USER=your-email@gmail.com
 SMTP_PASS=your-app-password
 
-# Rate Limiting
+# Outbound HTTP connection pool (per worker)
+HTTP_POOL_SIZE=20
+HTTP_MAX_RETRIES=2
+HTTP_KEEPALIVE=True
+
+# IntaSend webhooks are journaled here (under DATA_DIR) before being applied; deliveries
+# must carry the challenge string configured for the webhook on the IntaSend dashboard
+WEBHOOK_JOURNAL=webhook_journal.sqlite3
+INTASEND_WEBHOOK_CHALLENGE=your-intasend-webhook-challenge-here
+# Deferred side effects (profile creation at register/login), under DATA_DIR
+JOB_QUEUE_DB=jobs.sqlite3
+# Invalidation counters for cached subscription entitlements (under DATA_DIR); they reach
+# every worker on this host, workers on other hosts only catch up after ENTITLEMENT_CACHE_TTL
+ENTITLEMENT_STORE=entitlements.sqlite3
+ENTITLEMENT_CACHE_TTL=300
+
+# Rate Limiting (per user, and per IP; AI and auth routes have their own budgets)
 RATE_LIMIT_PER_MINUTE=60
 RATE_LIMIT_PER_HOUR=1000
+AI_RATE_LIMIT_PER_MINUTE=10
+AI_RATE_LIMIT_PER_HOUR=100
+AUTH_RATE_LIMIT_PER_MINUTE=10
+AUTH_RATE_LIMIT_PER_HOUR=100
+# Share buckets between gunicorn workers on this host (a file under DATA_DIR; unset = per worker)
+RATE_LIMIT_STORE=rate_limits.sqlite3
+# Reverse proxies whose X-Forwarded-For is trusted for per-IP limits: 1 on Render,
+# 0 when clients connect to gunicorn directly (otherwise they can spoof their address)
+TRUSTED_PROXIES=0
 """
     
     if not os.path.exists('.env'):
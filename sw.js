@@ -84,12 +84,24 @@ async function cacheFirst(request) {
 
 async function networkFirst(request) {
   const cache = await caches.open(API_CACHE);
+  const cached = request.method === "GET" ? await cache.match(request) : undefined;
   try {
-    const fresh = await fetch(request);
-    cache.put(request, fresh.clone());
+    // Revalidate with the cached ETag so unchanged payloads come back as an empty 304
+    const etag = cached && cached.headers.get("ETag");
+    let outgoing = request;
+    if (etag) {
+      const headers = new Headers(request.headers);
+      headers.set("If-None-Match", etag);
+      outgoing = new Request(request, { headers });
+    }
+
+    const fresh = await fetch(outgoing);
+    if (fresh.status === 304 && cached) return cached;
+    if (request.method === "GET" && fresh.ok) {
+      cache.put(request, fresh.clone());
+    }
     return fresh;
   } catch (e) {
-    const cached = await cache.match(request);
     if (cached) return cached;
     return new Response(
       JSON.stringify({ error: "Offline and no cached data available" }),